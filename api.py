@@ -3,15 +3,26 @@ import threading
 import uuid
 import argparse
 import time
+import os
 
-BASE_URL = 'https://watermark-backend.azurewebsites.net/api/'
+# WATERMARK_API_URL points the client to another backend, e.g. a local Functions host
+BASE_URL = os.environ.get('WATERMARK_API_URL', 'https://watermark-backend.azurewebsites.net/api/')
 
-URL_GET_UPLOAD_URL = BASE_URL + 'get-upload-url'
 URL_UPLOAD_FILE = None  # SAS URL will be dynamic
-URL_GET_DOWNLOAD_URL = BASE_URL + 'get-download-url'
-URL_MAIN_PROCESS = BASE_URL + 'main_process_func'
-URL_CHECK_PROGRESS = BASE_URL + 'check_progress_func'
-URL_CLEANUP = BASE_URL + 'cleanup-after-job'
+
+
+def set_base_url(base_url):
+    global BASE_URL, URL_GET_UPLOAD_URL, URL_GET_DOWNLOAD_URL, URL_MAIN_PROCESS, URL_CHECK_PROGRESS, URL_CLEANUP, URL_PREVIEW
+    BASE_URL = base_url if base_url.endswith('/') else base_url + '/'
+    URL_GET_UPLOAD_URL = BASE_URL + 'get-upload-url'
+    URL_GET_DOWNLOAD_URL = BASE_URL + 'get-download-url'
+    URL_MAIN_PROCESS = BASE_URL + 'main_process_func'
+    URL_CHECK_PROGRESS = BASE_URL + 'check_progress_func'
+    URL_CLEANUP = BASE_URL + 'cleanup-after-job'
+    URL_PREVIEW = BASE_URL + 'preview'
+
+
+set_base_url(BASE_URL)
 
 
 # ==== API functions =========
@@ -31,12 +42,13 @@ def upload_file(sas_url, filepath):
         raise Exception(f"Upload failed: {response.status_code} - {response.text}")
 
 
-def start_process_async(video_sas, image_sas):
+def start_process_async(video_sas, image_sas, options=None):
     job_id = str(uuid.uuid4())
     payload = {
         'job_id': job_id,
         'video_sas': video_sas,
-        'image_sas': image_sas
+        'image_sas': image_sas,
+        'options': options or {}
     }
 
     def do_request():
@@ -52,12 +64,13 @@ def start_process_async(video_sas, image_sas):
 
     return job_id
 
-def start_process_sync(video_sas, image_sas):
+def start_process_sync(video_sas, image_sas, options=None):
     job_id = str(uuid.uuid4())
     payload = {
         'job_id': job_id,
         'video_sas': video_sas,
-        'image_sas': image_sas
+        'image_sas': image_sas,
+        'options': options or {}
     }
     response = requests.post(URL_MAIN_PROCESS, json=payload)
     try:
@@ -72,18 +85,44 @@ def start_process_sync(video_sas, image_sas):
         print(f"Processing started: {response.json().get('message', '')}")
         return job_id
 
-def poll_process(job_id):
+def get_progress(job_id):
     response = requests.get(URL_CHECK_PROGRESS, params={'job_id': job_id})
     response.raise_for_status()
-    data = response.json()
+    return response.json()
+
+
+def poll_process(job_id):
+    data = get_progress(job_id)
     print(f"Progress: {data['progress_value']}%")
+    if data.get('failed'):
+        raise Exception(f"Processing failed: {data.get('error')}")
     if data.get('done'):
         print("Processing complete.")
     return (data['progress_value'], data['done'])
     
 
-def get_download_link(job_id, file_type):
-    response = requests.get(URL_GET_DOWNLOAD_URL, params={'job_id': job_id, 'type': file_type})
+def get_preview(video_sas, image_sas, output_path, options=None, time=0, format='jpg', frames=None):
+    payload = {
+        'video_sas': video_sas,
+        'image_sas': image_sas,
+        'options': options or {},
+        'time': time,
+        'format': format
+    }
+    if frames is not None:
+        payload['frames'] = frames
+    response = requests.post(URL_PREVIEW, json=payload)
+    response.raise_for_status()
+    with open(output_path, 'wb') as f:
+        f.write(response.content)
+    print(f"Preview saved to: {output_path}")
+
+
+def get_download_link(job_id, file_type, rendition=None):
+    params = {'job_id': job_id, 'type': file_type}
+    if rendition is not None:
+        params['rendition'] = rendition
+    response = requests.get(URL_GET_DOWNLOAD_URL, params=params)
     response.raise_for_status()
     return response.json()['downloadUrl']
 
@@ -0,0 +1,218 @@
+import os
+import logging
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import cv2
+import numpy as np
+import imageio_ffmpeg as ffmpeg
+import storage_functions
+import metrics
+import invisible_watermark
+from watermarking import blend_frame, rendition_size, X264_INTERMEDIATE_PARAMS
+
+# Watermark chunks as streams instead of through files in /tmp, see stream_video_chunk
+STREAM_CHUNKS = os.environ.get("STREAM_CHUNKS", "1") == "1"
+# Threads that blend and scale frames, numpy and OpenCV release the GIL
+STREAM_BLEND_THREADS = int(os.environ.get("STREAM_BLEND_THREADS", 0)) or max(1, (os.cpu_count() or 1) - 1)
+# Size of the staged blocks of the output blobs and how many of them are uploaded at the same time
+STREAM_BLOCK_SIZE = int(os.environ.get("STREAM_BLOCK_SIZE", 4 * 1024 * 1024))
+STREAM_UPLOAD_CONCURRENCY = int(os.environ.get("STREAM_UPLOAD_CONCURRENCY", 4))
+
+# Output of the encoders: fragmented mp4 can be written to a pipe, the index is not at the end
+FRAGMENTED_MP4 = ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4"]
+# Last bytes of the stderr of an ffmpeg that are kept for the error message
+STDERR_TAIL_BYTES = 8192
+
+'''
+Watermark one chunk without temporary files, with the download, the blend and the upload of
+the chunk overlapping:
+* a decoder ffmpeg reads the video_chunk_orig blob over HTTP with a read SAS (range
+  requests, so the decode starts before the download ends) and writes raw frames to a pipe;
+* frames are blended (see watermarking.blend_frame) and scaled to every rendition by
+  STREAM_BLEND_THREADS threads, several frames at once, and written in order to
+* one encoder ffmpeg per rendition, which writes fragmented mp4 to its stdout, which
+* is uploaded as the video_chunk_mod blob with staged blocks while it is being encoded
+  (storage_functions.upload_stream_internal).
+The encoders use the codecs of watermarking.open_video_writer. The blob is only committed
+when the whole chunk is encoded; on an error all processes are stopped and nothing is
+committed. meta is the chunk info from the queue message, it is required here because the
+chunk is not probed; a chunk with fewer or more frames than it says fails. Returns the number
+of frames.
+'''
+def stream_video_chunk(job_id, chunk_id, meta, renditions=None, blend_ranges=None, intermediate="mp4v", mode="visible",
+                       placement=None):
+    frame_width, frame_height = meta["width"], meta["height"]
+    start_frame, fps = meta["start_frame"], meta["fps"]
+    pattern = invisible_watermark.embedding_pattern(job_id, frame_height, frame_width) if mode == "invisible" else None
+    blend = (None if mode == "invisible" else placement, blend_ranges, pattern)
+
+    source_url = storage_functions.internal_read_url(job_id, 'video_chunk_orig', chunk_id)
+    decoder = subprocess.Popen([
+        ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+        "-i", source_url,
+        "-map", "0:v:0",
+        "-frames:v", str(meta["num_frames"]),
+        "-f", "rawvideo", "-pix_fmt", "bgr24", "-"
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    decoder_errors = _drain_stderr(decoder, f"decode-{chunk_id}")
+
+    encoders = []
+    for rendition in renditions or [None]:
+        if rendition is None:
+            name, size, bitrate = None, (frame_width, frame_height), None
+        else:
+            name, bitrate = rendition["name"], rendition["bitrate"]
+            size = rendition_size(frame_width, frame_height, rendition["height"])
+        encoders.append(_open_encoder(name, size, fps, bitrate, intermediate))
+
+    uploads = [_start_upload(job_id, chunk_id, encoder) for encoder in encoders]
+    try:
+        frames_read = _pipe_frames(decoder, encoders, (frame_height, frame_width), start_frame, blend)
+        if decoder.wait() != 0:
+            raise RuntimeError(f"decoding chunk {chunk_id} failed: {decoder_errors()}")
+        if frames_read != meta["num_frames"]:
+            raise RuntimeError(f"decoding chunk {chunk_id} failed: {frames_read} of {meta['num_frames']} frames read")
+        # the encoders only finish normally, and their blobs are only committed, from here on
+        for encoder in encoders:
+            encoder["process"].stdin.close()
+        for upload in uploads:
+            upload["thread"].join()
+            if upload["error"] is not None:
+                raise upload["error"]
+    except BaseException as e:
+        for process in [decoder, *(encoder["process"] for encoder in encoders)]:
+            process.kill()
+        for upload in uploads:
+            upload["thread"].join()
+        # a failed upload kills its encoder, the broken pipe to it is only the consequence
+        errors = [upload["error"] for upload in uploads if upload["error"] is not None]
+        if isinstance(e, BrokenPipeError) and errors:
+            raise errors[0]
+        raise
+    finally:
+        for process, errors in [(decoder, decoder_errors), *((encoder["process"], encoder["errors"]) for encoder in encoders)]:
+            process.wait()
+            errors()  # the thread that reads stderr is done before the pipe is closed
+            for pipe in (process.stdin, process.stdout, process.stderr):
+                try:
+                    if pipe is not None:
+                        pipe.close()
+                except OSError:
+                    pass  # the stdin of a killed encoder can't be flushed
+
+    metrics.inc("frames_total", frames_read, stage="watermark")
+    logging.info(f"Streamed chunk {chunk_id}: {frames_read} frames to {len(encoders)} renditions")
+    return frames_read
+
+
+'''
+Read the frames of the decoder, blend and scale them in the thread pool and write them in
+order to the encoders. At most 2 * STREAM_BLEND_THREADS frames are in flight; their buffers
+are reused once they are written.
+'''
+def _pipe_frames(decoder, encoders, frame_shape, start_frame, blend):
+    in_flight = 2 * STREAM_BLEND_THREADS
+    buffers = [np.empty((*frame_shape, 3), dtype=np.uint8) for _ in range(in_flight + 1)]
+    pending = deque()
+    frames_read = 0
+
+    def process(video_frame, frame_index):
+        blend_frame(video_frame, frame_index, blend)
+        return [video_frame if encoder["size"] == (frame_shape[1], frame_shape[0])
+                else cv2.resize(video_frame, encoder["size"], interpolation=cv2.INTER_AREA) for encoder in encoders]
+
+    def write_oldest():
+        for encoder, frame in zip(encoders, pending.popleft().result()):
+            encoder["process"].stdin.write(memoryview(frame).cast("B"))
+
+    with ThreadPoolExecutor(max_workers=STREAM_BLEND_THREADS, thread_name_prefix="stream-blend") as pool:
+        while True:
+            if len(pending) >= in_flight:
+                write_oldest()
+            video_frame = buffers[frames_read % len(buffers)]
+            if decoder.stdout.readinto(memoryview(video_frame).cast("B")) < video_frame.nbytes:
+                break
+            pending.append(pool.submit(process, video_frame, start_frame + frames_read))
+            frames_read += 1
+        while pending:
+            write_oldest()
+    return frames_read
+
+
+'''
+ffmpeg that encodes raw BGR frames from its stdin to fragmented mp4 on its stdout, with the
+codec open_video_writer would use for this rendition.
+'''
+def _open_encoder(name, size, fps, bitrate, intermediate):
+    if bitrate is not None:
+        codec = ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-b:v", str(bitrate), "-preset", "veryfast"]
+    elif intermediate == "x264":
+        codec = ["-c:v", "libx264", "-pix_fmt", "yuv420p", *X264_INTERMEDIATE_PARAMS]
+    else:
+        codec = ["-c:v", "mpeg4", "-tag:v", "mp4v", "-q:v", "3"]
+    if codec[1] == "libx264" and (size[0] % 2 or size[1] % 2):
+        # yuv420p needs an even size
+        codec = ["-vf", "crop=trunc(iw/2)*2:trunc(ih/2)*2", *codec]
+
+    rate = Fraction(fps).limit_denominator(1001)
+    process = subprocess.Popen([
+        ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{size[0]}x{size[1]}", "-r", f"{rate.numerator}/{rate.denominator}",
+        "-i", "-",
+        *codec,
+        *FRAGMENTED_MP4, "-"
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return {"name": name, "size": size, "process": process, "errors": _drain_stderr(process, f"encode-{name}")}
+
+
+'''
+Read the stderr of an ffmpeg in a thread and keep its last STDERR_TAIL_BYTES. Nobody else
+reads it while the frames are piped, and a process that writes more than the pipe holds (a
+corrupt chunk gives an error per frame) would block on it forever. Returns a function that
+waits until stderr is closed and returns the kept text.
+'''
+def _drain_stderr(process, name):
+    tail = bytearray()
+
+    def run():
+        for data in iter(lambda: process.stderr.read1(65536), b""):
+            tail.extend(data)
+            del tail[:-STDERR_TAIL_BYTES]
+
+    thread = threading.Thread(target=run, name=f"stderr-{name}", daemon=True)
+    thread.start()
+
+    def errors():
+        thread.join()
+        return tail.decode(errors="replace").strip()
+    return errors
+
+
+'''
+Upload the output of an encoder in a thread. The blob is only committed when the encoder
+finished normally, not when it was killed. When the upload fails the encoder is killed, so
+the frames that are written to it fail instead of waiting for a reader that is gone.
+'''
+def _start_upload(job_id, chunk_id, encoder):
+    upload = {"error": None}
+    process = encoder["process"]
+
+    def check_encoder():
+        if process.wait() != 0:
+            raise RuntimeError(f"encoding chunk {chunk_id} ({encoder['name']}) failed: {encoder['errors']()}")
+
+    def run():
+        try:
+            storage_functions.upload_stream_internal(job_id, encoder["process"].stdout, 'video_chunk_mod', chunk_id,
+                                                     encoder["name"], block_size=STREAM_BLOCK_SIZE,
+                                                     concurrency=STREAM_UPLOAD_CONCURRENCY, before_commit=check_encoder)
+        except Exception as e:
+            upload["error"] = e
+            encoder["process"].kill()
+
+    upload["thread"] = threading.Thread(target=run, name=f"stream-upload-{chunk_id}", daemon=True)
+    upload["thread"].start()
+    return upload
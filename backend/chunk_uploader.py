@@ -0,0 +1,130 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import storage_functions
+from job_db import mark_chunks_done
+from queue_functions import send_message, send_trigger, group_message, CHUNK_GROUP_SIZE
+
+# Number of threads that upload finished chunks while the split loop keeps decoding
+UPLOAD_WORKERS = int(os.environ.get("SPLIT_UPLOAD_WORKERS", 4))
+# Maximum number of finished chunk files that may wait on /tmp for their upload
+MAX_PENDING_CHUNKS = int(os.environ.get("SPLIT_MAX_PENDING_CHUNKS", 8))
+
+
+'''
+Uploads finished chunks in the background so the split loop does not have to wait for
+blob storage, the job table and the queues before it can decode the next frame.
+For every chunk the workers:
+* upload the chunk file as 'video_chunk_orig'
+* remove the local chunk file
+Uploaded chunks are collected in groups of group_size. For every group one message is sent
+to the watermark queue and one to the thumbnail queue (see queue_functions.group_message),
+with chunk_info (frame range and geometry of the chunk) in the message, and then the chunks
+are marked Dispatched in their state and counted in ChunkUploaded. A retried split skips the
+chunks that are already dispatched. close() sends the last, smaller group. Chunks with
+passthrough in their chunk_info only go to the thumbnail queue.
+When the split already made the thumbnail of a chunk (thumbnail_path in submit), it is uploaded
+with the chunk and the chunk skips the thumbnail queue. It is marked Thumbnailed right away
+(see job_db.mark_chunks_done), which needs total_chunks to know when the last thumbnail is done.
+With profile the messages ask the workers to profile the chunks (see profiling.profiled).
+submit() blocks as long as max_pending chunks are still waiting, so the split loop can
+never fill up /tmp faster than the uploads drain it.
+If watermark_ready (an Event) is given, no chunk is sent to the watermark queue before
+it is set, so the watermark can be moved while the video is already being split.
+'''
+class ChunkUploader:
+    def __init__(self, job_id, w_queue, t_queue, max_workers=UPLOAD_WORKERS, max_pending=MAX_PENDING_CHUNKS,
+                 watermark_ready=None, group_size=CHUNK_GROUP_SIZE, total_chunks=None, profile=False):
+        self.job_id = job_id
+        self.total_chunks = total_chunks
+        self.profile = profile
+        self.w_queue = w_queue
+        self.t_queue = t_queue
+        self.watermark_ready = watermark_ready
+        self.group_size = max(1, group_size)
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"upload-{job_id}")
+        self._futures = []
+        self._uploaded = []
+        self._uploaded_lock = threading.Lock()
+
+    def submit(self, chunk_path, chunk_id, chunk_info=None, thumbnail_path=None):
+        # wait for a free slot, this is the backpressure on the split loop
+        self._pending.acquire()
+        self._raise_if_failed()
+        self._futures.append(self._pool.submit(self._upload, chunk_path, chunk_id, chunk_info, thumbnail_path))
+
+    def close(self):
+        # wait for all uploads and re-raise the first error
+        self._pool.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+
+        # send the chunks that did not fill a whole group
+        with self._uploaded_lock:
+            group, self._uploaded = self._uploaded, []
+        if group:
+            self._dispatch(group)
+
+    def _raise_if_failed(self):
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                raise future.exception()
+
+    def _upload(self, chunk_path, chunk_id, chunk_info, thumbnail_path):
+        try:
+            # Upload the finished chunk to blob storage
+            storage_functions.upload_file_internal(self.job_id, chunk_path, "video_chunk_orig", index=chunk_id)
+            if thumbnail_path is not None:
+                storage_functions.upload_file_internal(self.job_id, thumbnail_path, "thumbnail", index=chunk_id)
+        finally:
+            for path in (chunk_path, thumbnail_path):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            self._pending.release()
+
+        chunk = {"chunk_id": chunk_id, "passthrough": False, "thumbnail_ready": thumbnail_path is not None}
+        if chunk_info is not None:
+            chunk.update(chunk_info)
+
+        group = None
+        with self._uploaded_lock:
+            self._uploaded.append(chunk)
+            if len(self._uploaded) >= self.group_size:
+                group, self._uploaded = self._uploaded, []
+        if group is not None:
+            self._dispatch(group)
+
+    def _dispatch(self, group):
+        group.sort(key=lambda c: c["chunk_id"])
+
+        # Trigger watermarking and thumbnailing for the group
+        thumbnail_group = [c for c in group if not c["thumbnail_ready"]]
+        if thumbnail_group:
+            send_message("thumbnailqueue", group_message(self.job_id, thumbnail_group, self.profile), queue=self.t_queue)
+        self._count_ready_thumbnails([c["chunk_id"] for c in group if c["thumbnail_ready"]])
+
+        watermark_group = [c for c in group if not c["passthrough"]]
+        if watermark_group:
+            # The watermark workers need the watermark image
+            if self.watermark_ready is not None:
+                self.watermark_ready.wait()
+            send_message("watermarkqueue", group_message(self.job_id, watermark_group, self.profile), queue=self.w_queue)
+
+        # Up the database. Chunks can finish out of order, so count instead of setting the index
+        try:
+            mark_chunks_done(self.job_id, [c["chunk_id"] for c in group], "Dispatched", "ChunkUploaded")
+        except Exception as e:
+            logging.error(f"Error: couldn't update DB after upload of chunks {[c['chunk_id'] for c in group]}: {e}")
+
+    def _count_ready_thumbnails(self, chunk_ids):
+        if not chunk_ids:
+            return
+        # the last thumbnail can be one that was made by the split
+        if mark_chunks_done(self.job_id, chunk_ids, "Thumbnailed", "ThumbnailDone", self.total_chunks):
+            send_trigger("thumbnaildone", {
+                "job_id": self.job_id,
+                "num_thumbnail_chunks": self.total_chunks
+            })
@@ -0,0 +1,155 @@
+import os
+import logging
+import numpy as np
+import cv2
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+import watermarking
+
+# Number of blend processes in the frame ring, 0 uses all cores except one for decoding and one for encoding
+FRAME_RING_BLENDERS = int(os.environ.get("FRAME_RING_BLENDERS", 0))
+# Frames with at least this many pixels go through the frame ring, smaller frames are blended serially
+FRAME_RING_MIN_PIXELS = int(os.environ.get("FRAME_RING_MIN_PIXELS", 2560 * 1440))
+
+
+'''
+Number of blend processes to use for a chunk with this frame size, 0 means the chunk is
+processed serially in the calling process. Splitting the work over processes only pays off
+for large frames (4K) on hosts with enough cores.
+'''
+def blend_processes_for(frame_width, frame_height):
+    if frame_width * frame_height < FRAME_RING_MIN_PIXELS:
+        return 0
+    blenders = FRAME_RING_BLENDERS or (os.cpu_count() or 1) - 2
+    return blenders if blenders >= 2 else 0
+
+
+'''
+Decode, blend and encode one chunk with a pipeline of processes:
+* one decoder reads frames into a ring of preallocated frame slots in shared memory
+* num_blenders processes blend the watermark into their slot in place
+* one encoder writes the slots in frame order to all renditions and frees them again
+Only slot indices are sent through the queues, the frames themselves never get pickled.
+The ring has num_slots slots (default 2 per blender plus 2), the decoder waits for a free
+slot, so at most that many frames are in flight.
+frame_shape is (height, width), start_frame the global index of the first frame of the chunk
+and blend is the tuple of watermarking.blend_frame. writer_specs are the (output_path, fps,
+size, bitrate, intermediate) of watermarking.open_rendition_writers.
+Returns the number of frames written.
+'''
+def run_frame_ring(video_path, frame_shape, start_frame, num_frames, writer_specs, blend, num_blenders, num_slots=None):
+    num_slots = num_slots or 2 * num_blenders + 2
+    height, width = frame_shape
+    ctx = multiprocessing.get_context("fork")  # the children use the shared memory object of this process
+
+    shm = shared_memory.SharedMemory(create=True, size=height * width * 3 * num_slots)
+    free_q = ctx.Queue()
+    blend_q = ctx.Queue()
+    encode_q = ctx.Queue()
+    frames_written = ctx.Value('i', 0)
+    for slot in range(num_slots):
+        free_q.put(slot)
+
+    ring = (shm, (num_slots, height, width, 3))
+    processes = [ctx.Process(target=_decode, name="ring-decoder",
+                             args=(ring, video_path, num_frames, num_blenders, free_q, blend_q))]
+    for i in range(num_blenders):
+        processes.append(ctx.Process(target=_blend, name=f"ring-blender-{i}",
+                                     args=(ring, start_frame, blend, blend_q, encode_q)))
+    processes.append(ctx.Process(target=_encode, name="ring-encoder",
+                                 args=(ring, writer_specs, num_blenders, free_q, encode_q, frames_written)))
+
+    try:
+        for process in processes:
+            process.start()
+
+        # wait until all processes are done, stop everything as soon as one of them fails
+        running = list(processes)
+        while running:
+            wait([process.sentinel for process in running])
+            for process in list(running):
+                if process.exitcode is None:
+                    continue
+                running.remove(process)
+                if process.exitcode != 0:
+                    raise RuntimeError(f"frame ring: {process.name} failed with exit code {process.exitcode}")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shm.close()
+        shm.unlink()
+
+    logging.info(f"frame ring: wrote {frames_written.value} frames with {num_blenders} blenders and {num_slots} slots")
+    return frames_written.value
+
+
+def _slots(ring):
+    shm, shape = ring
+    return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+
+def _decode(ring, video_path, num_frames, num_blenders, free_q, blend_q):
+    slots = _slots(ring)
+    cap = cv2.VideoCapture(video_path)
+    seq = 0
+    try:
+        while num_frames is None or seq < num_frames:
+            slot = free_q.get()
+            success, frame = cap.read(slots[slot])
+            if not success:
+                free_q.put(slot)
+                break
+            if frame.ctypes.data != slots[slot].ctypes.data:
+                # the decoder did not write into the slot itself
+                np.copyto(slots[slot], frame)
+            blend_q.put((seq, slot))
+            seq += 1
+    finally:
+        cap.release()
+        # one stop signal per blender
+        for _ in range(num_blenders):
+            blend_q.put(None)
+
+
+def _blend(ring, start_frame, blend, blend_q, encode_q):
+    slots = _slots(ring)
+    while True:
+        item = blend_q.get()
+        if item is None:
+            encode_q.put(None)
+            return
+        seq, slot = item
+        watermarking.blend_frame(slots[slot], start_frame + seq, blend)
+        encode_q.put(item)
+
+
+def _encode(ring, writer_specs, num_blenders, free_q, encode_q, frames_written):
+    slots = _slots(ring)
+    writers = watermarking.open_rendition_writers(writer_specs)
+    # blended frames arrive out of order, they wait in their slot until it is their turn
+    pending = {}
+    next_seq = 0
+    stopped_blenders = 0
+    try:
+        while stopped_blenders < num_blenders:
+            item = encode_q.get()
+            if item is None:
+                stopped_blenders += 1
+                continue
+            seq, slot = item
+            pending[seq] = slot
+            while next_seq in pending:
+                slot = pending.pop(next_seq)
+                watermarking.write_renditions(writers, slots[slot])
+                free_q.put(slot)
+                next_seq += 1
+    finally:
+        for size, scaled_frame, video_writer in writers:
+            video_writer.release()
+
+    if pending:
+        raise RuntimeError(f"frame ring: frame {next_seq} never arrived at the encoder")
+    frames_written.value = next_seq
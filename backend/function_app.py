@@ -1,23 +1,52 @@
 import azure.functions as func
-from watermarking import process_video_chunk, concat_chunks
+from sdk_imports import import_storage_sdk
+# before any module that imports the storage SDK, see sdk_imports
+import_storage_sdk()
 import storage_functions
 import json
-import cv2
-import numpy as np
 import os
 import uuid
+import importlib
 from datetime import datetime, timedelta
 from azure.storage.blob import generate_blob_sas, BlobSasPermissions
+from azure.core.exceptions import ResourceNotFoundError
 from run_pipeline import run_pipeline
-from job_db import update_job, get_job, atomic_increment
-from azure.storage.queue import (
-        QueueClient,
-        BinaryBase64EncodePolicy,
-        BinaryBase64DecodePolicy
-)
+from queue_functions import send_trigger, chunk_messages, chunk_info, get_queue_client, QUEUE_MAX_DEQUEUE_COUNT
+from job_db import (update_job, get_job, fail_job, chunks_done, mark_chunks_done, delete_job, list_expired_jobs,
+                    passthrough_from_job, metadata_from_job)
+from job_options import (validate_options, options_from_job, parse_renditions, parse_intermediate, parse_thumbnails,
+                         parse_watermark_mode, rendition_names, watermark_frame_ranges)
 import logging
+import time
+import metrics
+from metrics import track
+from profiling import profiled
+from storage_retry import is_transient
 
+'''
+The codec stack (cv2, numpy, ffmpeg and the modules built on them) takes most of the import
+time of this module, so it is imported inside the functions that need it. The HTTP endpoints
+that only touch storage (upload and download urls, progress) then start without it. See
+measure_cold_start.py for the import time and the cold start budget of every endpoint.
+'''
+CODEC_MODULES = ["numpy", "cv2", "imageio_ffmpeg", "watermarking", "splitting", "preview", "thumbnail_select", "chunk_stream"]
+
+
+'''
+Import the codec stack and locate the ffmpeg binary, so the first chunk on this instance does
+not pay for it. Returns the seconds spent per module.
+'''
+def preload_codecs():
+    timings = {}
+    for module in CODEC_MODULES:
+        start = time.monotonic()
+        importlib.import_module(module)
+        timings[module] = time.monotonic() - start
 
+    start = time.monotonic()
+    importlib.import_module("imageio_ffmpeg").get_ffmpeg_exe()
+    timings["ffmpeg"] = time.monotonic() - start
+    return timings
 
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
@@ -27,65 +56,131 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 # -----------------------------------------------------
 @app.function_name(name="process_chunk_func")
 @app.queue_trigger(arg_name="msg", queue_name="watermarkqueue", connection="AZURE_STORAGE_CONNECTION_STRING")
+@track("process_chunk_func")
+@profiled("process_chunk_func")
 def process_chunk_func(msg: func.QueueMessage) -> None:    
+    from placement import load_job_placement
+    from chunk_stream import STREAM_CHUNKS, stream_video_chunk
     logging.info("PROCESSING CHUNK")
+    job_id = chunk_id = None
 
     try:
         data = json.loads(msg.get_body().decode("utf-8"))
         job_id = data["job_id"]
-        chunk_id = data["chunk_id"]
+        # a message holds a group of chunks
+        chunks = chunk_messages(data)
         
         job = get_job(job_id)
         current_busy = job["ChunkWatermarkBusy"]
-        update_job(job_id, {"ChunkWatermarkBusy": current_busy + 1})
-
-
-        # Download chunk and watermark to local storage
-        chunk_path = storage_functions._unique_filepath_tmp('mp4')
-        storage_functions.download_file_internal(job_id, 'video_chunk_orig', chunk_path, index=chunk_id)
-        watermark_path = storage_functions._unique_filepath_tmp('jpg')
-        storage_functions.download_file_internal(job_id, 'watermark', watermark_path)
-        
-        # watermark chunk
-        output = process_video_chunk(job_id, chunk_path, watermark_path, chunk_id)
+        update_job(job_id, {"ChunkWatermarkBusy": current_busy + len(chunks)})
+        options = options_from_job(job)
+        renditions = parse_renditions(options)
+        intermediate = parse_intermediate(options)
+        mode = parse_watermark_mode(options)
+
+        # Download the placement of the watermark, once for the whole group. Invisible jobs don't use it
+        placement = load_job_placement(job_id, job, options) if mode == "visible" else None
+
+        for chunk in _chunks_to_do(msg, job_id, chunks, "Watermarked"):
+            chunk_id = chunk["chunk_id"]
+            chunk_start = time.monotonic()
+
+            # watermark chunk, once for every rendition. Streamed from blob to blob when the message
+            # has the chunk info, older messages go through files
+            meta = chunk_info(chunk)
+            blend_ranges = watermark_frame_ranges(options, meta["fps"]) if meta is not None else None
+            if STREAM_CHUNKS and meta is not None:
+                stream_video_chunk(job_id, chunk_id, meta, renditions=renditions, blend_ranges=blend_ranges,
+                                   intermediate=intermediate, mode=mode, placement=placement)
+            else:
+                watermark_chunk_file(job_id, chunk_id, meta, renditions, blend_ranges, intermediate, mode, placement)
+
+            metrics.inc("chunks_total", stage="watermark")
+            metrics.observe("chunk_duration_seconds", time.monotonic() - chunk_start, stage="watermark")
+            logging.info(f"Watermark {chunk_id} succesful")
 
-        # Upload watermarked chunk
-        storage_functions.upload_file_internal(job_id, output, 'video_chunk_mod', index=chunk_id)
+        # Watermarks are uploaded so up database, a chunk that was already done is not counted again
+        # The pass-through chunks are counted by the split
+        total_num_chunks = job["TotalNumChunks"]
+        last = mark_chunks_done(job_id, [chunk["chunk_id"] for chunk in chunks], "Watermarked", "ChunkWatermarkDone",
+                                total_num_chunks)
 
-        # Watermark is uploaded so up database
-        current_done = atomic_increment(job_id, "ChunkWatermarkDone")
-        
         # Check if this was the last chunk. If so, send a trigger for the concat function
-        total_num_chunks = job["TotalNumChunks"]
-        if total_num_chunks > 0 and current_done == total_num_chunks:
-            queue = QueueClient.from_connection_string(conn_str=os.environ["AZURE_STORAGE_CONNECTION_STRING"], queue_name="watermarkdone")
-            queue.message_encode_policy = BinaryBase64EncodePolicy()
-            queue.message_decode_policy = BinaryBase64EncodePolicy()
-            message = {
+        if total_num_chunks > 0 and last:
+            send_trigger("watermarkdone", {
                 "job_id": job_id,
-                "num_watermark_chunks": total_num_chunks
-            }
-            message_string = json.dumps(message)
-            message_bytes =  message_string.encode('utf-8')
-            queue.send_message(queue.message_encode_policy.encode(content=message_bytes))
+                "num_watermark_chunks": total_num_chunks,
+                "profile": bool(options.get("profile"))
+            })
 
-            # delete chunks and watermark from local storage
-            os.remove(chunk_path)
-            os.remove(watermark_path)
-            os.remove(output)
+    except Exception as e:
+        logging.error(f"Error in concat processing chunk {chunk_id}: {e}")
+        # raise again so the queue retries the group. Chunks are only counted once, so a retry
+        # after they were counted only sends the trigger again
+        if _retry_or_fail(msg, job_id, f"watermark of chunk {chunk_id}", e):
+            raise
+
+
+'''
+Whether a queue worker raises its error again so the queue retries the message. Only transient
+errors are retried; other errors and the last delivery of a message mark the job as failed
+(see job_db.fail_job), the job would never finish otherwise.
+'''
+def _retry_or_fail(msg, job_id, stage, error):
+    if not is_transient(error) or _last_delivery(msg):
+        _fail_job(job_id, stage, error)
+    return is_transient(error)
+
+
+def _last_delivery(msg):
+    return (msg.dequeue_count or 1) >= QUEUE_MAX_DEQUEUE_COUNT
 
-            logging.info(f"Watermark {chunk_id} succesful")
 
+def _fail_job(job_id, stage, error):
+    if job_id is None:
+        return
+    try:
+        fail_job(job_id, stage, error)
     except Exception as e:
-        logging.error(f"Error in concat processing chunk {chunk_id}: {e}")
+        logging.error(f"Error: couldn't mark job {job_id} as failed: {e}")
 
 
- 
+'''
+The chunks of a message that still have to be done in a stage. Only a message that is
+delivered again (a retry) looks up the state of the chunks, its chunks can be done already.
+'''
+def _chunks_to_do(msg, job_id, chunks, stage):
+    if msg.dequeue_count is None or msg.dequeue_count <= 1:
+        return chunks
+    done = chunks_done(job_id, [chunk["chunk_id"] for chunk in chunks], stage)
+    return [chunk for chunk in chunks if chunk["chunk_id"] not in done]
 
-    
 
 
+'''
+Watermark a chunk through local files: download it, watermark it into one file per rendition
+and upload those. The files are removed also when a step fails.
+'''
+def watermark_chunk_file(job_id, chunk_id, meta, renditions, blend_ranges, intermediate, mode, placement):
+    from watermarking import process_video_chunk
+    import storage_async
+    chunk_path = storage_functions._unique_filepath_tmp('mp4')
+    outputs = {}
+    try:
+        storage_functions.download_file_internal(job_id, 'video_chunk_orig', chunk_path, index=chunk_id)
+        outputs = process_video_chunk(job_id, chunk_path, None, chunk_id, renditions=renditions, meta=meta,
+                                      blend_ranges=blend_ranges, intermediate=intermediate, mode=mode,
+                                      placement=placement)
+        if outputs is None:
+            raise RuntimeError(f"can't read chunk {chunk_id}")
 
+        # Upload watermarked chunk, all renditions at the same time
+        storage_async.upload_files_internal(job_id, [(output, 'video_chunk_mod', chunk_id, rendition)
+                                                     for rendition, output in outputs.items()])
+    finally:
+        for path in [chunk_path, *(outputs or {}).values()]:
+            if os.path.exists(path):
+                os.remove(path)
 
 
 # -----------------------------------------------------
@@ -93,141 +188,103 @@ def process_chunk_func(msg: func.QueueMessage) -> None:
 # -----------------------------------------------------
 @app.function_name(name="concat_chunks_func")
 @app.queue_trigger(arg_name="msg", queue_name="watermarkdone", connection="AZURE_STORAGE_CONNECTION_STRING")
+@track("concat_chunks_func")
+@profiled("concat_chunks_func")
 def concat_chunks_func(msg: func.QueueMessage) -> None: 
+    from watermarking import concat_chunks
+    import storage_async
+    job_id = None
     try:
         data = json.loads(msg.get_body().decode("utf-8"))
         job_id = data["job_id"]
         num_chunks = data["num_watermark_chunks"]
-
-        chunk_paths = []
-        
-        # download all chunks to local storage
-        for i in range(num_chunks):
-            save_path = storage_functions._unique_filepath_tmp('mp4')
-            storage_functions.download_file_internal(job_id, 'video_chunk_mod', save_path, index=i)
-            chunk_paths.append(save_path)
-
-        # concat final video
-        output_path = storage_functions._unique_filepath_tmp('mp4')
-        concat_chunks(chunk_paths, output_path)
-
-        # Upload finished video to blob storage
-        storage_functions.upload_file_internal(job_id, output_path, 'output_video')
+        job = get_job(job_id)
+        options = options_from_job(job)
+        # chunks outside the watermark_ranges are used as they were split
+        passthrough = passthrough_from_job(job)
+        # copied source chunks and watermarked chunks have different codecs
+        reencode = parse_intermediate(options) == "copy" and len(passthrough) > 0
+
+        # every rendition gets its own final video
+        for rendition in rendition_names(options):
+            chunk_paths = [storage_functions._unique_filepath_tmp('mp4') for _ in range(num_chunks)]
+
+            # download all chunks to local storage, at the same time
+            storage_async.download_files_internal(job_id, [
+                ('video_chunk_orig', path, i, None) if i in passthrough else ('video_chunk_mod', path, i, rendition)
+                for i, path in enumerate(chunk_paths)
+            ])
+
+            # concat final video
+            output_path = storage_functions._unique_filepath_tmp('mp4')
+            concat_chunks(chunk_paths, output_path, reencode=reencode, fps=metadata_from_job(job).get("fps"))
+
+            # Upload finished video to blob storage
+            storage_functions.upload_file_internal(job_id, output_path, 'output_video', rendition=rendition)
+
+            # delete chunk and final video from local storage
+            for path in chunk_paths:
+                os.remove(path)
+            os.remove(output_path)
 
         # Video is done!
         update_job(job_id, {"Concat": True})
 
-        # delete chunk and final video from local storage
-        for path in chunk_paths:
-            os.remove(path)
-        os.remove(output_path)
-
 
         logging.info("concat video chunks succesful")
     except Exception as e:
-        logging.error("Error in concat video chunks")
+        logging.error(f"Error in concat video chunks: {e}")
+        # the concat only marks the job done at the end, so a retry of the queue is safe
+        if _retry_or_fail(msg, job_id, "concat", e):
+            raise
+
+
+
+@app.function_name(name="split_chunks_queue_func")
+@app.queue_trigger(arg_name="msg", queue_name="splitqueue", connection="AZURE_STORAGE_CONNECTION_STRING")
+@track("split_chunks_queue_func")
+@profiled("split_chunks_queue_func")
+def split_chunks_queue_func(msg: func.QueueMessage) -> None:
+    from splitting import split_video
+    data = json.loads(msg.get_body().decode("utf-8"))
+    job_id = data["job_id"]
+    video_SAS = data["video_SAS"]
+    image_SAS = data["image_SAS"]
+    chunk_size = int(data.get("chunk_size", 150))
 
+    # A retried message for a job that was already split completely has nothing left to do
+    job = get_job(job_id)
+    if job.get("SplitDone"):
+        logging.info(f"Job {job_id} is already split, skipping")
+        return
+
+    try:
+        # The watermark is moved while the video is being split
+        num_chunks = split_video(job_id, video_SAS, chunk_size, image_SAS=image_SAS, options=options_from_job(job))
+
+        logging.info(f"Split job {job_id} into {num_chunks} chunks")
+    except Exception as e:
+        # raise again so the queue retries the split, also after errors that are not transient
+        # (a chunk that failed to upload), only the last attempt fails the job
+        logging.error(f"Error in splitting job {job_id} (attempt {msg.dequeue_count}): {e}")
+        if _last_delivery(msg):
+            _fail_job(job_id, "split", e)
+        raise
 
 
 @app.function_name(name="split_chunks_func")
 @app.route(route="split_chunks_func", methods=["POST"])
+@track("split_chunks_func")
+@profiled("split_chunks_func")
 def split_chunks_func(req: func.HttpRequest) -> func.HttpResponse:
+    from splitting import split_video
     try:
         data = req.get_json()
         video_SAS = data['video_SAS']
         job_id = data['job_id']
         chunk_size = int(data.get('chunk_size', 150))
 
-        # path to store the video locally
-        video_path = storage_functions._unique_filepath_tmp('mp4')
-        storage_functions.get_user_video(video_SAS, video_path)
-
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-
-        chunk_id = 0
-        frame_count = 0
-        writer = None
-
-        w_queue = QueueClient.from_connection_string(conn_str=os.environ["AZURE_STORAGE_CONNECTION_STRING"], queue_name="watermarkqueue")
-        t_queue = QueueClient.from_connection_string(conn_str=os.environ["AZURE_STORAGE_CONNECTION_STRING"], queue_name="thumbnailqueue")
-        w_queue.message_encode_policy = BinaryBase64EncodePolicy()
-        w_queue.message_decode_policy = BinaryBase64DecodePolicy()
-        t_queue.message_encode_policy = BinaryBase64EncodePolicy()
-        t_queue.message_decode_policy = BinaryBase64DecodePolicy()
-
-
-        while True:
-            success, frame = cap.read()
-            if not success:
-                break
-
-            if frame_count % chunk_size == 0:
-                if writer is not None:
-                    writer.release()
-                    # Upload the finished chunk to blob storage
-                    storage_functions.upload_file_internal(job_id, chunk_path, "video_chunk_orig", index=chunk_id)
-                    
-                    # Up the database
-                    try:
-                        update_job(job_id, {"ChunkUploaded": chunk_id + 1})
-                    except Exception as e:
-                        print(f"Error: couldn't update DB after chunk {chunk_id} upload: {e}")
-                    
-                    # Trigger watermarking and thumbnailing for new chunk
-                    message = {
-                        "job_id": job_id,
-                        "chunk_id": chunk_id
-                    }
-                    message_string = json.dumps(message)
-                    message_bytes =  message_string.encode('utf-8')
-                    w_queue.send_message(w_queue.message_encode_policy.encode(content=message_bytes))
-                    t_queue.send_message(w_queue.message_encode_policy.encode(content=message_bytes))
-
-                    os.remove(chunk_path)
-                    chunk_id += 1
-
-                chunk_path = storage_functions._unique_filepath_tmp('mp4')
-                writer = cv2.VideoWriter(chunk_path, fourcc, fps, (width, height))
-                print(f"[INFO] Writing to {chunk_path}")
-
-            writer.write(frame)
-            frame_count += 1
-
-        # Handle the last chunk
-        if writer is not None:
-            writer.release()
-            storage_functions.upload_file_internal(job_id, chunk_path, "video_chunk_orig", index=chunk_id)
-
-            # Up the database
-            try:
-                update_job(job_id, {"ChunkUploaded": chunk_id + 1})
-            except Exception as e:
-                print(f"Error: couldn't update DB after chunk {chunk_id} upload: {e}")
-            
-            
-            # Trigger watermarking for last chunk
-            message = {
-                "job_id": job_id,
-                "chunk_id": chunk_id
-            }
-            message_string = json.dumps(message)
-            message_bytes =  message_string.encode('utf-8')
-            w_queue.send_message(w_queue.message_encode_policy.encode(content=message_bytes))
-            t_queue.send_message(w_queue.message_encode_policy.encode(content=message_bytes))
-
-            chunk_id += 1
-            os.remove(chunk_path)
-        
-        cap.release()
-
-        update_job(job_id, {"TotalNumChunks": chunk_id})
-
-        os.remove(video_path) # we don't need the full input video anymore, so remove it.
+        split_video(job_id, video_SAS, chunk_size)
 
         return func.HttpResponse(
             json.dumps({"status": "success"}), mimetype="application/json"
@@ -239,84 +296,104 @@ def split_chunks_func(req: func.HttpRequest) -> func.HttpResponse:
 
 @app.function_name(name="thumbnail_chunk_func")
 @app.queue_trigger(arg_name="msg", queue_name="thumbnailqueue", connection="AZURE_STORAGE_CONNECTION_STRING")
+@track("thumbnail_chunk_func")
 def thumbnail_chunk_func(msg: func.QueueMessage) -> None:    
+    import cv2
+    import numpy as np
+    job_id = chunk_id = None
     try:
         data = json.loads(msg.get_body().decode("utf-8"))
         job_id = data["job_id"]
-        chunk_id = data["chunk_id"]
+        # a message holds a group of chunks
+        chunks = chunk_messages(data)
 
         job = get_job(job_id)
         current_busy = job["ThumbnailBusy"]
-        update_job(job_id, {"ThumbnailBusy": current_busy + 1})
+        update_job(job_id, {"ThumbnailBusy": current_busy + len(chunks)})
 
-        # download chunk to local storage
-        chunk_path = storage_functions._unique_filepath_tmp('mp4')
-        storage_functions.download_file_internal(job_id, 'video_chunk_orig', chunk_path, index=chunk_id)
+        for chunk in _chunks_to_do(msg, job_id, chunks, "Thumbnailed"):
+            chunk_id = chunk["chunk_id"]
 
-        cap = cv2.VideoCapture(chunk_path)
-        success, frame = cap.read()
-        cap.release()
+            # download chunk to local storage
+            chunk_path = storage_functions._unique_filepath_tmp('mp4')
+            storage_functions.download_file_internal(job_id, 'video_chunk_orig', chunk_path, index=chunk_id)
 
-        if not success:
-            raise ValueError("Failed to read first frame from chunk")
+            cap = cv2.VideoCapture(chunk_path)
+            info = chunk_info(chunk)
+            if info is not None:
+                # geometry is known from the message, decode straight into a buffer
+                success, frame = cap.read(np.empty((info["height"], info["width"], 3), dtype=np.uint8))
+            else:
+                success, frame = cap.read()
+            cap.release()
 
-        # save frame to local storage
-        output_path = storage_functions._unique_filepath_tmp('jpg')
-        cv2.imwrite(output_path, frame)  
+            if not success:
+                raise ValueError("Failed to read first frame from chunk")
 
-        # write frame to blob storage
-        storage_functions.upload_file_internal(job_id, output_path, 'thumbnail', index=chunk_id)
+            # save frame to local storage
+            output_path = storage_functions._unique_filepath_tmp('jpg')
+            cv2.imwrite(output_path, frame)  
 
-        # Done, so update the database
-        current_done = atomic_increment(job_id, "ThumbnailDone")
+            # write frame to blob storage
+            storage_functions.upload_file_internal(job_id, output_path, 'thumbnail', index=chunk_id)
 
-        # Check if this was the last chunk. If so, send a trigger
+            # delete chunk and frame from local storage
+            os.remove(chunk_path)
+            os.remove(output_path)
+
+            metrics.inc("chunks_total", stage="thumbnail")
+            logging.info(f"Thumbnail chunk {chunk_id} succesful")
+
+        # Done, so update the database, a chunk that was already done is not counted again
         total_num_chunks = job["TotalNumChunks"]
-        if total_num_chunks > 0 and current_done == total_num_chunks:
-            queue = QueueClient.from_connection_string(conn_str=os.environ["AZURE_STORAGE_CONNECTION_STRING"], queue_name="thumbnaildone")
-            queue.message_encode_policy = BinaryBase64EncodePolicy()
-            queue.message_decode_policy = BinaryBase64EncodePolicy()
-            message = {
+        last = mark_chunks_done(job_id, [chunk["chunk_id"] for chunk in chunks], "Thumbnailed", "ThumbnailDone", total_num_chunks)
+
+        # Check if this was the last chunk. If so, send a trigger
+        if total_num_chunks > 0 and last:
+            send_trigger("thumbnaildone", {
                 "job_id": job_id,
                 "num_thumbnail_chunks": total_num_chunks
-            }
-            message_string = json.dumps(message)
-            message_bytes =  message_string.encode('utf-8')
-            queue.send_message(queue.message_encode_policy.encode(content=message_bytes))
-
-        # delete chunk and frame from local storage
-        os.remove(chunk_path)
-        os.remove(output_path)
-
-        logging.info(f"Thumbnail chunk {chunk_id} succesful")
+            })
 
         
     except Exception as e:
         logging.error(f"Error processing thumbnail chunk {chunk_id}: {e}")
+        # raise again so the queue retries the group, see process_chunk_func
+        if _retry_or_fail(msg, job_id, f"thumbnail of chunk {chunk_id}", e):
+            raise
 
 
 @app.function_name(name="concat_thumbnails_func")
 @app.queue_trigger(arg_name="msg", queue_name="thumbnaildone", connection="AZURE_STORAGE_CONNECTION_STRING")
+@track("concat_thumbnails_func")
 def concat_thumbnails_func(msg: func.QueueMessage) -> None:    
+    import cv2
+    import numpy as np
+    from thumbnail_select import select_thumbnails
+    import storage_async
+    job_id = None
     try:
         data = json.loads(msg.get_body().decode("utf-8"))
         job_id = data["job_id"]
         num_thumbs = data["num_thumbnail_chunks"]
 
         thumbs = []
-        paths = []
-        # Download all thumbs to local storage and read the image
-        for i in range(num_thumbs):
-            save_path = storage_functions._unique_filepath_tmp('jpg')
-            storage_functions.download_file_internal(job_id, 'thumbnail', save_path, index=i)
-            img = cv2.imread(save_path)
+        paths = [storage_functions._unique_filepath_tmp('jpg') for _ in range(num_thumbs)]
+        # Download all thumbs to local storage at the same time and read the images
+        storage_async.download_files_internal(job_id, [('thumbnail', path, i, None) for i, path in enumerate(paths)])
+        for path in paths:
+            img = cv2.imread(path)
             if img is not None:
                 thumbs.append(img)
-                paths.append(save_path)
             
         if not thumbs:
             raise ValueError("No valid thumbnails found")
 
+        # in scene mode only the most distinct thumbnails are used
+        thumbnail_mode, num_thumbnails = parse_thumbnails(options_from_job(get_job(job_id)))
+        if thumbnail_mode == "scene":
+            thumbs = [thumbs[i] for i in select_thumbnails(thumbs, num_thumbnails)]
+
         total_width = sum(img.shape[1] for img in thumbs)
         height = thumbs[0].shape[0]
         grid = np.zeros((height, total_width, 3), dtype=np.uint8)
@@ -342,11 +419,46 @@ def concat_thumbnails_func(msg: func.QueueMessage) -> None:
         logging.info("concat thumbnail chunks succesful")
 
     except Exception as e:
-        logging.error("error in cancating thumbnail chunks")
+        logging.error(f"error in cancating thumbnail chunks: {e}")
+        if _retry_or_fail(msg, job_id, "thumbnail concat", e):
+            raise
     
 
+'''
+Preview of the watermark before the job is started, so the client can check the opacity and
+the watermark before the whole video is processed. Takes the video_sas, image_sas and options
+of main_process_func (no image_sas for an invisible watermark_mode) and optionally:
+* time: position in the video in seconds, default 0
+* format: 'jpg' for a still image (default) or 'mp4' for a short clip
+* frames: number of frames of the clip
+Returns the image or the clip itself.
+'''
+@app.function_name(name="preview_func")
+@app.route(route="preview", methods=["POST"])
+@track("preview_func")
+def preview_func(req: func.HttpRequest) -> func.HttpResponse:
+    from preview import render_preview
+    try:
+        data = req.get_json()
+        options = validate_options(data.get("options"))
+        start_seconds = float(data.get("time", 0))
+        video_sas, image_sas = data["video_sas"], data.get("image_sas")
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        return func.HttpResponse(f"Invalid request: {str(e)}", status_code=400)
+
+    try:
+        body, mimetype = render_preview(video_sas, image_sas, options, start_seconds=start_seconds,
+                                        output_format=data.get("format", "jpg"), num_frames=data.get("frames"))
+        return func.HttpResponse(body=body, mimetype=mimetype, status_code=200)
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid preview: {str(e)}", status_code=400)
+    except Exception as e:
+        return func.HttpResponse(f"Error: {str(e)}", status_code=500)
+
+
 @app.function_name(name="move_watermark_func")
 @app.route(route="move_watermark_func", methods=["POST"])
+@track("move_watermark_func")
 def move_watermark_func(req: func.HttpRequest) -> func.HttpResponse:
     data = req.get_json()
     job_id = data["job_id"]
@@ -366,6 +478,7 @@ def move_watermark_func(req: func.HttpRequest) -> func.HttpResponse:
 
 @app.function_name(name="main_process_func")
 @app.route(route="main_process_func", methods=["POST"])
+@track("main_process_func")
 def main_process_func(req: func.HttpRequest) -> func.HttpResponse:
     data = req.get_json()
     job_id = data["job_id"]
@@ -373,12 +486,18 @@ def main_process_func(req: func.HttpRequest) -> func.HttpResponse:
     image_sas = data["image_sas"]
 
     try:
-        run_pipeline(job_id, video_sas, image_sas)
+        options = validate_options(data.get("options"))
+    except (ValueError, TypeError) as e:
+        return func.HttpResponse(f"Invalid options: {str(e)}", status_code=400)
+
+    try:
+        # Only registers the job and enqueues the split, the work happens in split_chunks_queue_func
+        run_pipeline(job_id, video_sas, image_sas, options)
 
         return func.HttpResponse(
-            json.dumps({"status": "success"}),
+            json.dumps({"status": "success", "job_id": job_id}),
             mimetype="application/json",
-            status_code=200
+            status_code=202
         )
     except Exception as e:
         return func.HttpResponse(f"Error: {str(e)}", status_code=500)
@@ -387,6 +506,7 @@ def main_process_func(req: func.HttpRequest) -> func.HttpResponse:
 
 @app.function_name(name="check_progress_func")
 @app.route(route="check_progress_func", methods=["GET"])
+@track("check_progress_func")
 def check_progress_func(req: func.HttpRequest) -> func.HttpResponse:
     job_id = req.params.get("job_id")
     
@@ -415,8 +535,13 @@ def check_progress_func(req: func.HttpRequest) -> func.HttpResponse:
 
         logging.info(f"Progress is {progress_in_percent}%, done is {done}. Watermarked: {a}. Thumnailed: {b}. concat: {c}, thumnailconcat: {d}. totalchunks = {total_chunks}")
 
+        # the state of every stage, for clients that time the stages (load_test.py). A failed job
+        # is never done, error says which stage failed
         return func.HttpResponse(
-                json.dumps({"progress_value": progress_in_percent, "done": done}),
+                json.dumps({"progress_value": progress_in_percent, "done": done,
+                            "failed": job.get("Failed", False), "error": job.get("Error") or None,
+                            "total_chunks": total_chunks, "split_done": job.get("SplitDone", False),
+                            "watermarked": a, "thumbnailed": b, "concat": c, "thumbnail_concat": d}),
                 mimetype="application/json",
                 status_code=200
             )
@@ -431,6 +556,7 @@ wants to upload a file. The file can then be uploaded to the obtained URL.
 '''
 @app.function_name(name="get-upload-url")
 @app.route(route="get-upload-url")
+@track("get-upload-url")
 def generate_sas(req: func.HttpRequest) -> func.HttpResponse:
     filename = str(uuid.uuid4())
 
@@ -449,7 +575,7 @@ def generate_sas(req: func.HttpRequest) -> func.HttpResponse:
             expiry=datetime.utcnow() + timedelta(minutes=15),
         )
 
-        url = f"https://{account_name}.blob.core.windows.net/{container_name}/{filename}?{sas_token}"
+        url = storage_functions.blob_url(account_name, container_name, filename, sas_token)
 
         return func.HttpResponse(f'{{"uploadUrl": "{url}"}}',
                                  mimetype="application/json",
@@ -462,19 +588,24 @@ def generate_sas(req: func.HttpRequest) -> func.HttpResponse:
 Use this function when the client want to download the result file. The function will provide
 the URL.
 type can be either 'output_video' or 'output_thumbnail'
+For jobs with a rendition ladder, rendition selects the output_video of that rendition.
 '''
 @app.function_name(name="get-download-url")
 @app.route(route='get-download-url')  
+@track("get-download-url")
 def get_download_url(req: func.HttpRequest) -> func.HttpResponse:
     job_id = req.params.get("job_id")
     type = req.params.get("type")  
+    rendition = req.params.get("rendition")
 
     if job_id is None:
         return func.HttpResponse("Missing job_id parameter", status_code=400)
     if type not in ['output_video', 'output_thumbnail']:
         return func.HttpResponse("Invalid or missing type parameter", status_code=400)
+    if rendition is not None and (type != 'output_video' or not rendition.isalnum()):
+        return func.HttpResponse("Invalid rendition parameter", status_code=400)
     
-    filename = storage_functions._form_filename(job_id, type)
+    filename = storage_functions._form_filename(job_id, type, rendition=rendition)
     container_name = 'downloads'
 
     try:
@@ -489,7 +620,7 @@ def get_download_url(req: func.HttpRequest) -> func.HttpResponse:
             expiry=datetime.utcnow() + timedelta(minutes=15),
         )
 
-        url =  f"https://{account_name}.blob.core.windows.net/{container_name}/{filename}?{sas_token}"
+        url = storage_functions.blob_url(account_name, container_name, filename, sas_token)
         
         return func.HttpResponse(f'{{"downloadUrl": "{url}"}}',
                                  mimetype="application/json",
@@ -497,12 +628,105 @@ def get_download_url(req: func.HttpRequest) -> func.HttpResponse:
     except Exception as e:
         return func.HttpResponse(f"Error generating SAS URL: {str(e)}", status_code=500)
 
+'''
+Remove everything of a job: its blobs in 'internal' and 'downloads', the uploads of the user
+and the rows in the job table.
+'''
+def cleanup_job(job_id):
+    try:
+        upload_names = json.loads(get_job(job_id).get("UploadNames") or "[]")
+    except ResourceNotFoundError:
+        upload_names = []  # the table row is already gone, still remove the blobs
+
+    storage_functions.delete_files_from_job(job_id, upload_names)
+    delete_job(job_id)
+
+
 @app.function_name(name="cleanup-after-job")
 @app.route(route='cleanup-after-job')  
+@track("cleanup-after-job")
 def cleanup_after_job(req: func.HttpRequest) -> func.HttpResponse:
     job_id = req.params.get("job_id")
+    if not job_id:
+        return func.HttpResponse("Missing job_id parameter", status_code=400)
     try:
-        storage_functions.delete_files_from_job(job_id)
+        cleanup_job(job_id)
         return func.HttpResponse(status_code=200)
     except Exception as e:
-        return func.HttpResponse(f"Error in cleanup: {str(e)}", status_code=500)
\ No newline at end of file
+        return func.HttpResponse(f"Error in cleanup: {str(e)}", status_code=500)
+
+
+'''
+Jobs that are never cleaned up by the client expire. Every 30 minutes all jobs that have not
+been updated for JOB_TTL_HOURS (default 24) hours are removed.
+'''
+@app.function_name(name="sweep_expired_jobs_func")
+@app.timer_trigger(arg_name="timer", schedule="0 */30 * * * *", run_on_startup=False)
+@track("sweep_expired_jobs_func")
+def sweep_expired_jobs_func(timer: func.TimerRequest) -> None:
+    max_age = timedelta(hours=float(os.environ.get("JOB_TTL_HOURS", 24)))
+
+    expired = list_expired_jobs(max_age)
+    logging.info(f"Found {len(expired)} expired jobs")
+    for job_id in expired:
+        try:
+            cleanup_job(job_id)
+            logging.info(f"Removed expired job {job_id}")
+        except Exception as e:
+            logging.error(f"Error removing expired job {job_id}: {e}")
+
+
+# Queues of the pipeline whose depth is sampled for the metrics
+MONITORED_QUEUES = ["splitqueue", "watermarkqueue", "thumbnailqueue", "watermarkdone", "thumbnaildone"]
+
+'''
+Every minute the approximate number of messages in every queue of the pipeline is stored in
+the queue_depth gauge, the backlog to autoscale and alert on. Also removes the metrics of
+processes that are gone.
+'''
+@app.function_name(name="sample_queue_depth_func")
+@app.timer_trigger(arg_name="timer", schedule="0 * * * * *", run_on_startup=False)
+@track("sample_queue_depth_func")
+def sample_queue_depth_func(timer: func.TimerRequest) -> None:
+    for queue_name in MONITORED_QUEUES:
+        try:
+            depth = get_queue_client(queue_name).get_queue_properties().approximate_message_count
+            metrics.set_gauge("queue_depth", depth, queue=queue_name)
+        except Exception as e:
+            logging.error(f"Error sampling depth of {queue_name}: {e}")
+    metrics.maybe_flush(force=True)
+
+    try:
+        metrics.remove_stale()
+    except Exception as e:
+        logging.error(f"Error removing stale metrics: {e}")
+
+
+'''
+The metrics of all instances in the Prometheus text format.
+'''
+@app.function_name(name="metrics_func")
+@app.route(route="metrics", methods=["GET"])
+def metrics_func(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        metrics.maybe_flush(force=True)
+        return func.HttpResponse(metrics.render(metrics.collect_all()),
+                                 mimetype="text/plain; version=0.0.4",
+                                 status_code=200)
+    except Exception as e:
+        return func.HttpResponse(f"Error collecting metrics: {str(e)}", status_code=500)
+
+
+'''
+Runs when a new instance is added to the app (Premium and Dedicated plans only, the trigger
+does not fire on the Consumption plan). Preloads the codec stack before the instance gets
+traffic so the first chunk does not pay for it. Set PRELOAD_CODECS=0 to keep instances that
+mostly serve the HTTP endpoints small.
+'''
+@app.function_name(name="warmup")
+@app.warm_up_trigger(arg_name="warmup")
+def warmup(warmup) -> None:
+    if os.environ.get("PRELOAD_CODECS", "1") == "0":
+        return
+    timings = preload_codecs()
+    logging.info("Preloaded codecs in " + ", ".join(f"{module} {seconds:.3f}s" for module, seconds in timings.items()))
@@ -0,0 +1,232 @@
+import os
+import sys
+import time
+import hashlib
+import cv2
+import numpy as np
+
+BLOCK = 8
+# Bits of the payload, the first bits of the sha256 of the job id
+PAYLOAD_BITS = 64
+# Mid-frequency DCT coefficients of every 8x8 luma block that carry the payload: low enough to
+# survive the encoders, high enough to stay invisible
+COEFFICIENTS = ((1, 2), (2, 1), (2, 2), (1, 3), (3, 1))
+# Amplitude of the change of every coefficient, in luma levels of the orthonormal DCT. Below 8
+# the intra quantizers of the encoders (mpeg4 -q:v 3, x264 CRF 23) round the change of flat
+# blocks away
+INVISIBLE_STRENGTH = float(os.environ.get("INVISIBLE_STRENGTH", 8.0))
+# Perceptual masking: textured blocks hide a stronger change and the encoders keep their
+# detail, they get INVISIBLE_MASKING_GAIN times the strength. A block counts as textured when
+# the mean absolute Laplacian of its luma is at least INVISIBLE_MASKING_ACTIVITY (see texture_mask)
+INVISIBLE_MASKING_GAIN = float(os.environ.get("INVISIBLE_MASKING_GAIN", 2.0))
+INVISIBLE_MASKING_ACTIVITY = int(os.environ.get("INVISIBLE_MASKING_ACTIVITY", 12))
+# Secret that is mixed into the pseudo-random pattern, so a pattern can't be made without it
+INVISIBLE_WATERMARK_KEY = os.environ.get("INVISIBLE_WATERMARK_KEY", "")
+
+'''
+Invisible watermark for leak tracing: the job id is embedded in the block DCT of the luma of
+every frame, with spread spectrum.
+* every 8x8 block carries one bit of the payload, the bits are spread over the frame by a
+  pseudo-random permutation of the blocks;
+* the COEFFICIENTS of a block are changed by +-strength, the sign is the bit times a
+  pseudo-random sign per block and coefficient;
+* textured blocks of a frame are changed by +-strength * INVISIBLE_MASKING_GAIN instead.
+The pattern only depends on the job id, the key and the frame size. Because the DCT is linear,
+adding strength to a coefficient is the same as adding its basis image to the pixels, so the
+pattern is made once per chunk with one inverse transform of all blocks (block_idct) and
+every frame only gets the pattern added (embed_frame), with saturating uint8 operations; the
+textured blocks are found per frame with a Laplacian and get the rest of the change through a
+mask. Adding the same value to B, G and R adds it to the luma and leaves the chroma alone.
+The payload is read back by correlating the block DCT of frames with the layout, the masking
+only scales the change of a block and needs nothing from the detector. Check that the
+payload survives the encoders with: python invisible_watermark.py robustness VIDEO
+'''
+
+
+def dct_matrix(n=BLOCK):
+    k = np.arange(n)
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = dct_matrix()
+
+
+'''
+Orthonormal DCT of all 8x8 blocks of planes (..., height, width) at once, height and width
+multiples of 8. Returns (..., height / 8, width / 8, 8, 8). The leading dimensions batch
+several frames into the same transform.
+'''
+def block_dct(planes):
+    *batch, height, width = planes.shape
+    blocks = planes.reshape(*batch, height // BLOCK, BLOCK, width // BLOCK, BLOCK).swapaxes(-3, -2)
+    return _DCT @ blocks.astype(np.float32) @ _DCT.T
+
+
+'''
+Inverse of block_dct, returns planes (..., height, width).
+'''
+def block_idct(coefficients):
+    *batch, blocks_y, blocks_x, _, _ = coefficients.shape
+    blocks = _DCT.T @ coefficients @ _DCT
+    return blocks.swapaxes(-3, -2).reshape(*batch, blocks_y * BLOCK, blocks_x * BLOCK)
+
+
+def payload_bits(job_id):
+    digest = hashlib.sha256(str(job_id).encode("utf-8")).digest()
+    return np.unpackbits(np.frombuffer(digest, dtype=np.uint8))[:PAYLOAD_BITS]
+
+
+'''
+Which bit every block carries and the pseudo-random sign of every coefficient, for the full
+blocks of a frame of this size. Returns (bit_of_block, signs) with shapes (blocks_y, blocks_x)
+and (blocks_y, blocks_x, len(COEFFICIENTS)).
+'''
+def embedding_layout(job_id, height, width):
+    seed = hashlib.sha256(f"{INVISIBLE_WATERMARK_KEY}:{job_id}:{height}x{width}".encode("utf-8")).digest()
+    rng = np.random.default_rng(np.frombuffer(seed[:16], dtype=np.uint64))
+    blocks_y, blocks_x = height // BLOCK, width // BLOCK
+    bit_of_block = (rng.permutation(blocks_y * blocks_x) % PAYLOAD_BITS).reshape(blocks_y, blocks_x)
+    signs = rng.choice(np.array([-1, 1], dtype=np.int8), size=(blocks_y, blocks_x, len(COEFFICIENTS)))
+    return bit_of_block, signs
+
+
+'''
+The change of the luma of a frame of this size that embeds the payload of the job, as uint8
+(height, width, 3) images to add to and subtract from BGR frames: "positive" and "negative"
+for every block, "masked_positive" and "masked_negative" for the rest of the change of the
+textured blocks. Pixels outside the full 8x8 blocks are not changed.
+'''
+def embedding_pattern(job_id, height, width, strength=INVISIBLE_STRENGTH, masking_gain=INVISIBLE_MASKING_GAIN):
+    bit_of_block, signs = embedding_layout(job_id, height, width)
+    symbols = payload_bits(job_id).astype(np.int8) * 2 - 1  # bit 0 is -1, bit 1 is +1
+
+    coefficients = np.zeros(bit_of_block.shape + (BLOCK, BLOCK), dtype=np.float32)
+    rows, columns = zip(*COEFFICIENTS)
+    coefficients[..., rows, columns] = signs * symbols[bit_of_block][..., None]
+    luma = block_idct(coefficients)
+
+    pattern = {"blocks": bit_of_block.shape}
+    base = np.rint(luma * strength).astype(np.int16)
+    for name, change in (("", base), ("masked_", np.rint(luma * strength * masking_gain).astype(np.int16) - base)):
+        full = np.zeros((height, width, 3), dtype=np.int16)
+        full[:luma.shape[0], :luma.shape[1]] = change[..., None]
+        pattern[name + "positive"] = np.clip(full, 0, 255).astype(np.uint8)
+        pattern[name + "negative"] = np.clip(-full, 0, 255).astype(np.uint8)
+    return pattern
+
+
+'''
+Add the pattern to a BGR frame in place, saturating at 0 and 255. A pixel is only in one of
+the positive and negative images, so this is the same as adding the signed change.
+'''
+def embed_frame(video_frame, pattern):
+    mask = texture_mask(video_frame, pattern["blocks"])
+    cv2.add(video_frame, pattern["positive"], dst=video_frame)
+    cv2.subtract(video_frame, pattern["negative"], dst=video_frame)
+    cv2.add(video_frame, pattern["masked_positive"], dst=video_frame, mask=mask)
+    cv2.subtract(video_frame, pattern["masked_negative"], dst=video_frame, mask=mask)
+
+
+'''
+The pixels of the full 8x8 blocks of a BGR frame that are textured, as a uint8 mask of the
+frame size (255 in those blocks). The activity of a block is the mean absolute Laplacian of
+the luma of every fourth pixel in both directions, the texture the encoders keep is coarse
+enough to show in it, and it is four times cheaper than the full frame.
+'''
+def texture_mask(video_frame, blocks):
+    blocks_y, blocks_x = blocks
+    samples = cv2.resize(video_frame[:blocks_y * BLOCK, :blocks_x * BLOCK], (blocks_x * 2, blocks_y * 2),
+                         interpolation=cv2.INTER_NEAREST)
+    activity = cv2.convertScaleAbs(cv2.Laplacian(cv2.cvtColor(samples, cv2.COLOR_BGR2GRAY), cv2.CV_16S))
+    textured = cv2.compare(cv2.resize(activity, (blocks_x, blocks_y), interpolation=cv2.INTER_AREA),
+                           INVISIBLE_MASKING_ACTIVITY, cv2.CMP_GE)
+    textured = cv2.resize(textured, (blocks_x * BLOCK, blocks_y * BLOCK), interpolation=cv2.INTER_NEAREST)
+    height, width = video_frame.shape[:2]
+    return cv2.copyMakeBorder(textured, 0, height - textured.shape[0], 0, width - textured.shape[1], cv2.BORDER_CONSTANT, 0)
+
+
+'''
+Frames per second of the visible blend and of the invisible embedding of one chunk, at 1080p
+by default: python invisible_watermark.py [width] [height] [frames]
+'''
+def benchmark(width=1920, height=1080, num_frames=120):
+    from job_options import parse_placement
+    from placement import compile_placement, prepare_placement, blend_placement
+
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 256, size=(8, height, width, 3), dtype=np.uint8)
+    watermark_image = rng.integers(0, 256, size=(height // 2, width, 3), dtype=np.uint8)
+    placement = prepare_placement(compile_placement(watermark_image, parse_placement({}), width, height, 0.5))
+
+    def frames_per_second(embed):
+        start = time.perf_counter()
+        for i in range(num_frames):
+            embed(frames[i % len(frames)])
+        return num_frames / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    pattern = embedding_pattern("benchmark", height, width)
+    pattern_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    block_dct(cv2.cvtColor(frames[0], cv2.COLOR_BGR2GRAY)[:height // BLOCK * BLOCK, :width // BLOCK * BLOCK])
+    dct_seconds = time.perf_counter() - start
+
+    print(f"{width}x{height}, {num_frames} frames")
+    print(f"  visible blend:       {frames_per_second(lambda f: blend_placement(f, placement, 0)):8.1f} frames/s")
+    print(f"  invisible embedding: {frames_per_second(lambda f: embed_frame(f, pattern)):8.1f} frames/s")
+    print(f"  pattern (once per chunk): {pattern_seconds * 1000:.1f} ms, block DCT of one frame: {dct_seconds * 1000:.1f} ms")
+
+
+'''
+Check that the payload survives the pipeline and a re-encode of its outputs: the video is
+watermarked like a chunk of an invisible job (intermediate codec, renditions of the given
+heights), every output is checked with verify_watermark.verify_file, and again after a
+libx264 CRF 23 re-encode, the usual settings of a copy that is passed on. The unmarked video
+is checked too, it must not be detected.
+python invisible_watermark.py robustness VIDEO [height...]
+'''
+def robustness(video_path, heights=(720, 480, 360), intermediate="mp4v", job_id="robustness"):
+    import subprocess
+    import imageio_ffmpeg as ffmpeg
+    from job_options import parse_renditions
+    from video_probe import probe_video
+    from watermarking import process_video_chunk
+    from verify_watermark import verify_file
+
+    meta = probe_video(video_path)
+    size = (meta["width"], meta["height"])
+    renditions = parse_renditions({"renditions": [{"name": "original", "height": meta["height"]}] +
+                                                 [{"height": height} for height in heights if height < meta["height"]]})
+    outputs = process_video_chunk(job_id, video_path, None, "robustness", renditions=renditions, intermediate=intermediate,
+                                  mode="invisible")
+    if outputs is None:
+        raise ValueError(f"can't read {video_path}")
+
+    def check(path):
+        result = verify_file(path, job_id=job_id, size=size)
+        if "error" in result:
+            return f"error: {result['error']}"
+        return f"{result['score']:6.1f} {'detected' if result['detected'] else 'not detected'}"
+
+    print(f"{video_path}: {size[0]}x{size[1]}, intermediate {intermediate}")
+    print(f"  unmarked: {check(video_path)}")
+    try:
+        for name, output_path in outputs.items():
+            reencoded_path = output_path[:-len(".mp4")] + "-crf23.mp4"
+            subprocess.run([ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-i", output_path,
+                            "-c:v", "libx264", "-crf", "23", "-y", reencoded_path], check=True)
+            print(f"  {name:>8}: {check(output_path)}, after CRF 23: {check(reencoded_path)}")
+            os.remove(reencoded_path)
+    finally:
+        for output_path in outputs.values():
+            os.remove(output_path)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["robustness"]:
+        robustness(sys.argv[2], *([tuple(int(arg) for arg in sys.argv[3:])] if sys.argv[3:] else []))
+    else:
+        benchmark(*(int(arg) for arg in sys.argv[1:]))
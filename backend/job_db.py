@@ -1,57 +1,157 @@
-from azure.data.tables import TableServiceClient, UpdateMode
-from azure.core.exceptions import ResourceModifiedError
-from azure.core import MatchConditions
-import os
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from job_store import get_store
 
-TABLE_NAME = "jobstatus"
-
-def get_table_client():
-    conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
-    table_service = TableServiceClient.from_connection_string(conn_str)
-    return table_service.get_table_client(table_name=TABLE_NAME)
-
-
-def create_job_entry(job_id: str):
+'''
+The state of the jobs, in the job store selected by JOB_STORE (see job_store.py).
+'''
+def create_job_entry(job_id: str, options: dict = None, upload_names: list = None):
     entity = {
-        "PartitionKey": job_id,
-        "RowKey": "status",
         "AudioExtracted": False,
         "ChunkUploaded": 0,
         "ChunkWatermarkBusy": 0,
         "ChunkWatermarkDone": 0,
         "TotalNumChunks" : 0,
+        "SplitDone": False,
         "Concat": False,
         "AudioAdded": False,
         "ThumbnailBusy": 0,
         "ThumbnailDone": 0,
         "ThumbnailConcat": False,
+        "Options": json.dumps(options or {}),
+        "Metadata": "{}",
+        "UploadNames": json.dumps(upload_names or []),
+        "PassThrough": "[]",
+        "Failed": False,
+        "Error": "",
     }
-    get_table_client().create_entity(entity)
+    get_store().create(job_id, "status", entity)
 
 
 def update_job(job_id: str, updates: dict):
-    table_client = get_table_client()
-    entity = table_client.get_entity(partition_key=job_id, row_key="status")
-    for key, value in updates.items():
-        entity[key] = value
-    table_client.update_entity(entity=entity, mode=UpdateMode.MERGE)
-
-def atomic_increment(job_id: str, key: str):
-    table_client = get_table_client()
-    while True:
-        entity = table_client.get_entity(partition_key=job_id, row_key="status")
-        etag = entity.metadata['etag']
-
-        # Increase the value
-        entity[key] += 1
-
-        # Attempt conditional update
-        try:
-            table_client.update_entity(entity, etag=etag, match_condition=MatchConditions.IfNotModified)
-            return entity[key]
-        except ResourceModifiedError:
-            continue # try again
+    get_store().update(job_id, "status", updates)
+
+def atomic_increment(job_id: str, key: str, amount: int = 1):
+    return get_store().increment(job_id, "status", key, amount)
 
 
 def get_job(job_id: str):
-    return get_table_client().get_entity(partition_key=job_id, row_key="status")
+    return get_store().get(job_id, "status")
+
+
+'''
+Mark a job as failed with the stage and the error, so the progress reports it instead of a
+job that never finishes.
+'''
+def fail_job(job_id: str, stage: str, error):
+    update_job(job_id, {"Failed": True, "Error": f"{stage}: {error}"})
+
+
+def _chunk_row_key(chunk_id, stage):
+    return f"chunk-{chunk_id:06d}-{stage}"
+
+
+'''
+The stages every chunk of a job that has any is done in, as {chunk_id: {stage: True}}. Reads
+all chunk rows of the job, for the chunks of one message see chunks_done.
+'''
+def get_chunk_states(job_id: str):
+    states = {}
+    for row_key in get_store().list_rows(job_id, prefix="chunk-"):
+        chunk_id, _, stage = row_key[len("chunk-"):].partition("-")
+        states.setdefault(int(chunk_id), {})[stage] = True
+    return states
+
+
+'''
+The ids of the given chunks that are done in a stage, one read per chunk.
+'''
+def chunks_done(job_id: str, chunk_ids: list, stage: str):
+    done = set()
+    for chunk_id in chunk_ids:
+        try:
+            get_store().get(job_id, _chunk_row_key(chunk_id, stage))
+            done.add(chunk_id)
+        except ResourceNotFoundError:
+            pass
+    return done
+
+
+'''
+Mark chunks as done in a stage, e.g. "Watermarked". Every chunk is claimed by creating its row
+for the stage, which fails when the row exists, so of retried or concurrent deliveries of a
+chunk only one counts it in the counter of the status row (e.g. ChunkWatermarkDone). When the
+counter can't be increased the claims are removed again, so the retry counts the chunks.
+Returns True for the call that completes the stage, whose increment takes the counter to
+total; of workers that finish at the same time only one sees that. A call that claims no
+chunk (a retry of one that may have failed after counting) returns True when the counter
+already is at total. Without total it returns False.
+'''
+def mark_chunks_done(job_id: str, chunk_ids: list, stage: str, counter: str, total: int = None):
+    store = get_store()
+    claimed = []
+    try:
+        for chunk_id in chunk_ids:
+            try:
+                store.create(job_id, _chunk_row_key(chunk_id, stage), {"Done": True})
+                claimed.append(chunk_id)
+            except ResourceExistsError:
+                pass  # counted by an earlier delivery
+        if claimed:
+            value = atomic_increment(job_id, counter, len(claimed))
+    except Exception:
+        for chunk_id in claimed:
+            try:
+                store.delete_row(job_id, _chunk_row_key(chunk_id, stage))
+            except Exception as e:
+                logging.error(f"Error: couldn't release chunk {chunk_id} of job {job_id} in {stage}: {e}")
+        raise
+
+    if total is None:
+        return False
+    if not claimed:
+        return get_job(job_id)[counter] >= total
+    return value - len(claimed) < total <= value
+
+
+'''
+Chunks that are not watermarked but go into the final video as they are, stored as runs of
+chunk ids [[first, last], ...] to keep the entry small.
+'''
+def passthrough_to_runs(chunk_ids):
+    runs = []
+    for chunk_id in sorted(chunk_ids):
+        if runs and runs[-1][1] == chunk_id - 1:
+            runs[-1][1] = chunk_id
+        else:
+            runs.append([chunk_id, chunk_id])
+    return json.dumps(runs)
+
+
+def passthrough_from_job(job):
+    runs = json.loads(job.get("PassThrough") or "[]")
+    return {chunk_id for first, last in runs for chunk_id in range(first, last + 1)}
+
+
+'''
+Delete every row of a job, its status and the state of its chunks.
+'''
+def delete_job(job_id: str):
+    return get_store().delete(job_id)
+
+
+'''
+The ids of all jobs that have not been updated for longer than max_age (a timedelta).
+'''
+def list_expired_jobs(max_age: timedelta):
+    return get_store().list_updated_before(datetime.now(timezone.utc) - max_age)
+
+
+'''
+Stream metadata of the input video (frame_count, fps, time_base, width, height, codec),
+probed once by the split. Empty before the split has started.
+'''
+def metadata_from_job(job):
+    return json.loads(job.get("Metadata") or "{}")
@@ -0,0 +1,254 @@
+import os
+import re
+import json
+
+# Intermediate format of the chunk blobs when a job does not choose one, see parse_intermediate
+DEFAULT_INTERMEDIATE = os.environ.get("DEFAULT_INTERMEDIATE", "auto")
+INTERMEDIATE_FORMATS = ("auto", "mp4v", "copy", "x264")
+THUMBNAIL_MODES = ("first", "scene")
+# Number of tiles in the thumbnail of a scene mode job when the job does not give one
+DEFAULT_NUM_THUMBNAILS = 8
+# Opacity of the watermark when the job does not give one
+DEFAULT_OPACITY = 0.5
+WATERMARK_MODES = ("visible", "invisible")
+# Anchors of the placement and the position they stand for, as fractions of the free space
+PLACEMENT_ANCHORS = {
+    "top-left": (0, 0), "top": (0.5, 0), "top-right": (1, 0),
+    "left": (0, 0.5), "center": (0.5, 0.5), "right": (1, 0.5),
+    "bottom-left": (0, 1), "bottom": (0.5, 1), "bottom-right": (1, 1),
+}
+# Maximum number of columns and rows of a tiled placement
+MAX_PLACEMENT_TILES = 16
+
+'''
+Job options are given by the client when a job is started (main_process_func) and are stored
+as json in the "Options" field of the job entry. All options are optional, an empty dict
+gives the default pipeline. Supported options:
+* renditions: list of output renditions, e.g.
+  [{"name": "1080p", "height": 1080, "bitrate": "5M"}, {"height": 720, "bitrate": "2500k"}]
+  name defaults to "<height>p". Without bitrate the rendition uses the default chunk codec.
+* watermark_ranges: list of [start, end] in seconds where the watermark is applied, e.g.
+  [[0, 10], [50.5, null]]. end null means until the end of the video. Without this option
+  the whole video is watermarked.
+* intermediate: format of the chunk blobs between the pipeline stages, see parse_intermediate.
+* thumbnail_mode and num_thumbnails: how the thumbnail is made, see parse_thumbnails.
+* opacity: opacity of the watermark between 0 and 1, default 0.5.
+* watermark_mode: visible (default) or invisible, see parse_watermark_mode.
+* placement: where the visible watermark goes, see parse_placement.
+* profile: true profiles the split, watermark and concat of the job (see profiling.profiled).
+'''
+def validate_options(options):
+    if options is None:
+        return {}
+    if not isinstance(options, dict):
+        raise ValueError("options must be a json object")
+    parse_renditions(options)
+    parse_watermark_ranges(options)
+    parse_intermediate(options)
+    parse_thumbnails(options)
+    parse_opacity(options)
+    parse_watermark_mode(options)
+    parse_placement(options)
+    if not isinstance(options.get("profile", False), bool):
+        raise ValueError("profile must be true or false")
+    return options
+
+
+def options_from_job(job):
+    return json.loads(job.get("Options") or "{}")
+
+
+'''
+Returns the rendition ladder of a job as a list of dicts with name, height and bitrate.
+An empty list means the video is only rendered in its original size.
+'''
+def parse_renditions(options):
+    renditions = []
+    names = set()
+    for spec in options.get("renditions") or []:
+        if not isinstance(spec, dict) or "height" not in spec:
+            raise ValueError("every rendition needs a height")
+        height = int(spec["height"])
+        if height <= 0 or height % 2 != 0:
+            raise ValueError(f"invalid rendition height {spec['height']}")
+        name = str(spec.get("name", f"{height}p"))
+        if not re.fullmatch(r"[A-Za-z0-9]+", name):
+            raise ValueError(f"invalid rendition name {name}, only letters and digits are allowed")
+        if name in names:
+            raise ValueError(f"duplicate rendition name {name}")
+        names.add(name)
+        bitrate = spec.get("bitrate")
+        renditions.append({"name": name, "height": height, "bitrate": str(bitrate) if bitrate else None})
+    return renditions
+
+
+'''
+The names of the renditions that are produced for a job. None stands for the single output
+in the original size when no ladder is given.
+'''
+def rendition_names(options):
+    renditions = parse_renditions(options)
+    if not renditions:
+        return [None]
+    return [r["name"] for r in renditions]
+
+
+'''
+Returns the watermark_ranges of a job as a sorted list of (start, end) in seconds, end is
+None for open ranges. None means the whole video gets the watermark.
+'''
+def parse_watermark_ranges(options):
+    if options.get("watermark_ranges") is None:
+        return None
+    ranges = []
+    for spec in options["watermark_ranges"]:
+        if not isinstance(spec, (list, tuple)) or len(spec) != 2:
+            raise ValueError("every watermark range needs a start and an end")
+        start = float(spec[0])
+        end = None if spec[1] is None else float(spec[1])
+        if start < 0 or (end is not None and end <= start):
+            raise ValueError(f"invalid watermark range {spec}")
+        ranges.append((start, end))
+    return sorted(ranges, key=lambda r: r[0])
+
+
+'''
+The watermark_ranges of a job in frames: a list of (start_frame, end_frame), end exclusive and
+None for open ranges. None means every frame gets the watermark.
+'''
+def watermark_frame_ranges(options, fps):
+    ranges = parse_watermark_ranges(options)
+    if ranges is None:
+        return None
+    return [(int(round(start * fps)), None if end is None else int(round(end * fps))) for start, end in ranges]
+
+
+'''
+True if any frame in [start_frame, end_frame) lies in one of the frame ranges.
+'''
+def overlaps_frame_ranges(frame_ranges, start_frame, end_frame):
+    if frame_ranges is None:
+        return True
+    for start, end in frame_ranges:
+        if start < end_frame and (end is None or end > start_frame):
+            return True
+    return False
+
+
+'''
+The format of the video_chunk_orig and video_chunk_mod blobs. These only live between the
+pipeline stages, so the policy trades blob size against CPU:
+* mp4v: every hop is encoded with the mp4v codec of OpenCV, the cheapest encoder we have.
+  The concat stream-copies the chunks, so the output is mp4v as well.
+* copy: the split stream-copies the source GOPs of every chunk that starts and ends on a
+  keyframe, without decoding or encoding them. Other chunks and the watermarked chunks are
+  mp4v. Pass-through chunks then have the source codec, so the concat re-encodes the output.
+* x264: every hop is encoded with libx264 (ultrafast), more CPU than mp4v. The concat
+  stream-copies the chunks, so the output is h264.
+* auto (default): copy when the whole video is watermarked, mp4v when the job has
+  watermark_ranges, where the re-encode of the concat costs more than copy saves. On 10 s
+  of 720p in 5 chunks a job took 10.6 s CPU with copy against 15.3 s with mp4v and 16.1 s
+  with x264, the re-encode of the concat alone 20.6 s.
+Returns the format of the job, never auto.
+'''
+def parse_intermediate(options):
+    intermediate = options.get("intermediate") or DEFAULT_INTERMEDIATE
+    if intermediate not in INTERMEDIATE_FORMATS:
+        raise ValueError(f"invalid intermediate {intermediate}, must be one of {', '.join(INTERMEDIATE_FORMATS)}")
+    if intermediate == "auto":
+        return "copy" if parse_watermark_ranges(options) is None else "mp4v"
+    return intermediate
+
+
+'''
+Returns (thumbnail_mode, num_thumbnails):
+* first: the thumbnail has one tile per chunk, the first frame of the chunk (default).
+* scene: the split keeps the best frame of every chunk it decodes and the thumbnail has the
+  num_thumbnails (default 8) most distinct, non-black of them (see thumbnail_select).
+'''
+def parse_thumbnails(options):
+    mode = options.get("thumbnail_mode") or "first"
+    if mode not in THUMBNAIL_MODES:
+        raise ValueError(f"invalid thumbnail_mode {mode}, must be one of {', '.join(THUMBNAIL_MODES)}")
+    num_thumbnails = options.get("num_thumbnails")
+    num_thumbnails = DEFAULT_NUM_THUMBNAILS if num_thumbnails is None else int(num_thumbnails)
+    if num_thumbnails <= 0:
+        raise ValueError(f"invalid num_thumbnails {num_thumbnails}")
+    return mode, num_thumbnails
+
+
+def parse_opacity(options):
+    opacity = options.get("opacity")
+    opacity = DEFAULT_OPACITY if opacity is None else float(opacity)
+    if not 0 <= opacity <= 1:
+        raise ValueError(f"invalid opacity {opacity}, must be between 0 and 1")
+    return opacity
+
+
+'''
+* visible: the watermark image is blended in the center of the frames (default).
+* invisible: the job id is embedded in the block DCT of the luma for leak tracing, the frames
+  look unchanged (see invisible_watermark). The watermark image is not used.
+Both only apply inside the watermark_ranges.
+'''
+def parse_watermark_mode(options):
+    mode = options.get("watermark_mode") or "visible"
+    if mode not in WATERMARK_MODES:
+        raise ValueError(f"invalid watermark_mode {mode}, must be one of {', '.join(WATERMARK_MODES)}")
+    return mode
+
+
+'''
+Returns the placement of the visible watermark as a dict with anchor, margin, scale, tile and
+path. All keys are optional, the default is the centered watermark at half the frame width:
+* anchor: one of PLACEMENT_ANCHORS, e.g. "bottom-right". Default center.
+* margin: space between the watermark and the edges, as a fraction of the frame width. Default 0.
+* scale: width of the watermark as a fraction of the frame width. Default 0.5.
+* tile: [columns, rows], the frame is divided into a grid of cells and every cell gets the
+  watermark at its anchor, with margin and scale relative to the cell.
+* path: [[seconds, x, y], ...], a motion path that replaces the anchor. x and y are the
+  position in the free space of the frame (or cell), 0 is left or top and 1 right or bottom.
+  The position is interpolated linearly between the points and held before the first and
+  after the last point, with loop true the path starts again after its last point.
+  e.g. {"scale": 0.2, "margin": 0.02, "path": [[0, 0, 0], [10, 1, 1]], "loop": true}
+The placement is compiled into a table once per job, see placement.compile_placement.
+'''
+def parse_placement(options):
+    spec = options.get("placement") or {}
+    if not isinstance(spec, dict):
+        raise ValueError("placement must be a json object")
+
+    anchor = spec.get("anchor") or "center"
+    if anchor not in PLACEMENT_ANCHORS:
+        raise ValueError(f"invalid placement anchor {anchor}, must be one of {', '.join(PLACEMENT_ANCHORS)}")
+    margin = float(spec.get("margin") or 0)
+    if not 0 <= margin < 0.5:
+        raise ValueError(f"invalid placement margin {margin}, must be at least 0 and less than 0.5")
+    scale = 0.5 if spec.get("scale") is None else float(spec["scale"])
+    if not 0 < scale <= 1:
+        raise ValueError(f"invalid placement scale {scale}, must be more than 0 and at most 1")
+
+    tile = spec.get("tile")
+    if tile is not None:
+        if not isinstance(tile, (list, tuple)) or len(tile) != 2:
+            raise ValueError("placement tile must be [columns, rows]")
+        tile = (int(tile[0]), int(tile[1]))
+        if not all(1 <= n <= MAX_PLACEMENT_TILES for n in tile):
+            raise ValueError(f"invalid placement tile {list(tile)}, columns and rows must be between 1 and {MAX_PLACEMENT_TILES}")
+
+    path = spec.get("path")
+    if path is not None:
+        points = []
+        for point in path:
+            if not isinstance(point, (list, tuple)) or len(point) != 3:
+                raise ValueError("every point of the placement path needs seconds, x and y")
+            seconds, x, y = (float(value) for value in point)
+            if seconds < 0 or not (0 <= x <= 1 and 0 <= y <= 1) or (points and seconds <= points[-1][0]):
+                raise ValueError(f"invalid placement path point {list(point)}")
+            points.append((seconds, x, y))
+        if not points:
+            raise ValueError("the placement path needs at least one point")
+        path = points
+
+    return {"anchor": anchor, "margin": margin, "scale": scale, "tile": tile, "path": path,
+            "loop": bool(spec.get("loop", False))}
@@ -0,0 +1,322 @@
+import os
+import copy
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from azure.data.tables import TableServiceClient, UpdateMode
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError, ResourceExistsError
+from azure.core import MatchConditions
+import metrics
+
+TABLE_NAME = "jobstatus"
+# Backend of the job state: table (Azure Table Storage), sqlite or memory
+JOB_STORE = os.environ.get("JOB_STORE", "table")
+# Database file of the sqlite backend, must be on a local disk shared by all processes
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "/tmp/jobstatus.sqlite")
+
+'''
+The state of a job is one row with RowKey 'status' (see job_db.create_job_entry), the state of
+its chunks are rows with RowKey 'chunk-<id>-<stage>' (see job_db.mark_chunks_done). A row is a flat dict of json values. Every
+backend raises the exceptions of the table backend, so callers can handle them the same way:
+ResourceNotFoundError for a row that does not exist and ResourceExistsError when a created
+row already exists.
+* table: Azure Table Storage, shared by all instances of the function app.
+* sqlite: a database file in WAL mode, shared by the processes of one host. For local runs
+  and batch processing on one machine.
+* memory: a dict in the process. Processes started by the job would get a copy, so it is
+  only suitable for runs in one process, e.g. benchmarks, and the split refuses it.
+'''
+class JobStore(ABC):
+    # Whether processes started by the job (the split) see the same rows
+    shared_between_processes = True
+
+    @abstractmethod
+    def create(self, job_id, row_key, entity):
+        pass
+
+    @abstractmethod
+    def get(self, job_id, row_key):
+        pass
+
+    @abstractmethod
+    def update(self, job_id, row_key, updates):
+        pass
+
+    # Add amount to the number in key, atomically. Returns the new value
+    @abstractmethod
+    def increment(self, job_id, row_key, key, amount):
+        pass
+
+    # Insert or merge
+    @abstractmethod
+    def upsert(self, job_id, row_key, updates):
+        pass
+
+    # All rows of a job whose RowKey starts with prefix, as {row_key: entity}
+    @abstractmethod
+    def list_rows(self, job_id, prefix=""):
+        pass
+
+    # Delete one row, a row that does not exist is ignored
+    @abstractmethod
+    def delete_row(self, job_id, row_key):
+        pass
+
+    # Delete all rows of a job, returns the number of rows
+    @abstractmethod
+    def delete(self, job_id):
+        pass
+
+    # The ids of the jobs whose status row was not updated since cutoff (an aware datetime)
+    @abstractmethod
+    def list_updated_before(self, cutoff):
+        pass
+
+
+def get_table_client():
+    conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
+    table_service = TableServiceClient.from_connection_string(conn_str)
+    return table_service.get_table_client(table_name=TABLE_NAME)
+
+
+class TableJobStore(JobStore):
+    def create(self, job_id, row_key, entity):
+        get_table_client().create_entity({"PartitionKey": job_id, "RowKey": row_key, **entity})
+
+    def get(self, job_id, row_key):
+        return get_table_client().get_entity(partition_key=job_id, row_key=row_key)
+
+    def update(self, job_id, row_key, updates):
+        table_client = get_table_client()
+        entity = table_client.get_entity(partition_key=job_id, row_key=row_key)
+        for key, value in updates.items():
+            entity[key] = value
+        table_client.update_entity(entity=entity, mode=UpdateMode.MERGE)
+
+    def increment(self, job_id, row_key, key, amount):
+        table_client = get_table_client()
+        while True:
+            entity = table_client.get_entity(partition_key=job_id, row_key=row_key)
+            etag = entity.metadata['etag']
+
+            # Increase the value
+            entity[key] += amount
+
+            # Attempt conditional update
+            try:
+                table_client.update_entity(entity, etag=etag, match_condition=MatchConditions.IfNotModified)
+                return entity[key]
+            except ResourceModifiedError:
+                metrics.inc("etag_conflicts_total", key=key)
+                continue # try again
+
+    def upsert(self, job_id, row_key, updates):
+        get_table_client().upsert_entity({"PartitionKey": job_id, "RowKey": row_key, **updates}, mode=UpdateMode.MERGE)
+
+    def list_rows(self, job_id, prefix=""):
+        entities = get_table_client().query_entities("PartitionKey eq @job_id", parameters={"job_id": job_id})
+        return {entity["RowKey"]: entity for entity in entities if entity["RowKey"].startswith(prefix)}
+
+    def delete_row(self, job_id, row_key):
+        get_table_client().delete_entity(partition_key=job_id, row_key=row_key)
+
+    '''
+    All rows of a job share the PartitionKey, so they are deleted with transactions of at
+    most 100 rows.
+    '''
+    def delete(self, job_id):
+        table_client = get_table_client()
+        entities = list(table_client.query_entities("PartitionKey eq @job_id", parameters={"job_id": job_id}, select=["PartitionKey", "RowKey"]))
+        for i in range(0, len(entities), 100):
+            table_client.submit_transaction([("delete", entity) for entity in entities[i:i + 100]])
+        return len(entities)
+
+    def list_updated_before(self, cutoff):
+        entities = get_table_client().query_entities(
+            "RowKey eq 'status' and Timestamp lt @cutoff",
+            parameters={"cutoff": cutoff},
+            select=["PartitionKey"],
+        )
+        return [entity["PartitionKey"] for entity in entities]
+
+
+def _not_found(job_id, row_key):
+    return ResourceNotFoundError(f"job {job_id} has no row {row_key}")
+
+
+'''
+The rows are json in a table (job_id, row_key, data, updated). Every process and thread has
+its own connection; writes take the write lock of the database (BEGIN IMMEDIATE), so a read,
+modify and write is atomic over all processes on the host.
+'''
+class SqliteJobStore(JobStore):
+    def __init__(self, path=JOB_STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # a forked process must not use the connection of its parent
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT, row_key TEXT, data TEXT, updated REAL, "
+                               "PRIMARY KEY (job_id, row_key))")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _write(self, job_id, row_key, change):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT data FROM jobs WHERE job_id = ? AND row_key = ?", (job_id, row_key)).fetchone()
+            entity, result = change(json.loads(row[0]) if row is not None else None)
+            connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)", (job_id, row_key, json.dumps(entity), time.time()))
+            connection.execute("COMMIT")
+            return result
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def create(self, job_id, row_key, entity):
+        def change(current):
+            if current is not None:
+                raise ResourceExistsError(f"job {job_id} already has a row {row_key}")
+            return entity, None
+        self._write(job_id, row_key, change)
+
+    def get(self, job_id, row_key):
+        row = self._connection().execute("SELECT data FROM jobs WHERE job_id = ? AND row_key = ?", (job_id, row_key)).fetchone()
+        if row is None:
+            raise _not_found(job_id, row_key)
+        return {"PartitionKey": job_id, "RowKey": row_key, **json.loads(row[0])}
+
+    def update(self, job_id, row_key, updates):
+        def change(current):
+            if current is None:
+                raise _not_found(job_id, row_key)
+            return {**current, **updates}, None
+        self._write(job_id, row_key, change)
+
+    def increment(self, job_id, row_key, key, amount):
+        def change(current):
+            if current is None:
+                raise _not_found(job_id, row_key)
+            current[key] += amount
+            return current, current[key]
+        return self._write(job_id, row_key, change)
+
+    def upsert(self, job_id, row_key, updates):
+        self._write(job_id, row_key, lambda current: ({**(current or {}), **updates}, None))
+
+    def list_rows(self, job_id, prefix=""):
+        rows = self._connection().execute("SELECT row_key, data FROM jobs WHERE job_id = ? AND substr(row_key, 1, ?) = ?",
+                                          (job_id, len(prefix), prefix))
+        return {row_key: {"PartitionKey": job_id, "RowKey": row_key, **json.loads(data)} for row_key, data in rows}
+
+    def delete_row(self, job_id, row_key):
+        self._connection().execute("DELETE FROM jobs WHERE job_id = ? AND row_key = ?", (job_id, row_key))
+
+    def delete(self, job_id):
+        return self._connection().execute("DELETE FROM jobs WHERE job_id = ?", (job_id,)).rowcount
+
+    def list_updated_before(self, cutoff):
+        rows = self._connection().execute("SELECT job_id FROM jobs WHERE row_key = 'status' AND updated < ?", (cutoff.timestamp(),))
+        return [job_id for job_id, in rows]
+
+
+class MemoryJobStore(JobStore):
+    shared_between_processes = False
+
+    def __init__(self):
+        self._rows = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    def _get(self, job_id, row_key):
+        entity = self._rows.get((job_id, row_key))
+        if entity is None:
+            raise _not_found(job_id, row_key)
+        return entity
+
+    def _set(self, job_id, row_key, entity):
+        self._rows[(job_id, row_key)] = entity
+        self._updated[(job_id, row_key)] = datetime.now(timezone.utc)
+
+    def create(self, job_id, row_key, entity):
+        with self._lock:
+            if (job_id, row_key) in self._rows:
+                raise ResourceExistsError(f"job {job_id} already has a row {row_key}")
+            self._set(job_id, row_key, {"PartitionKey": job_id, "RowKey": row_key, **copy.deepcopy(entity)})
+
+    # a copy, like every read from the other backends
+    def get(self, job_id, row_key):
+        with self._lock:
+            return copy.deepcopy(self._get(job_id, row_key))
+
+    def update(self, job_id, row_key, updates):
+        with self._lock:
+            self._set(job_id, row_key, {**self._get(job_id, row_key), **copy.deepcopy(updates)})
+
+    def increment(self, job_id, row_key, key, amount):
+        with self._lock:
+            entity = self._get(job_id, row_key)
+            entity[key] += amount
+            self._set(job_id, row_key, entity)
+            return entity[key]
+
+    def upsert(self, job_id, row_key, updates):
+        with self._lock:
+            current = self._rows.get((job_id, row_key), {"PartitionKey": job_id, "RowKey": row_key})
+            self._set(job_id, row_key, {**current, **copy.deepcopy(updates)})
+
+    def list_rows(self, job_id, prefix=""):
+        with self._lock:
+            return {row_key: copy.deepcopy(entity) for (row_job_id, row_key), entity in self._rows.items()
+                    if row_job_id == job_id and row_key.startswith(prefix)}
+
+    def delete_row(self, job_id, row_key):
+        with self._lock:
+            self._rows.pop((job_id, row_key), None)
+            self._updated.pop((job_id, row_key), None)
+
+    def delete(self, job_id):
+        with self._lock:
+            keys = [key for key in self._rows if key[0] == job_id]
+            for key in keys:
+                del self._rows[key]
+                del self._updated[key]
+            return len(keys)
+
+    def list_updated_before(self, cutoff):
+        with self._lock:
+            return [job_id for (job_id, row_key), updated in self._updated.items()
+                    if row_key == "status" and updated < cutoff]
+
+
+JOB_STORES = {"table": TableJobStore, "sqlite": SqliteJobStore, "memory": MemoryJobStore}
+_store = None
+
+
+'''
+The job store of this process, selected by JOB_STORE.
+'''
+def get_store():
+    global _store
+    if _store is None:
+        if JOB_STORE not in JOB_STORES:
+            raise ValueError(f"invalid JOB_STORE {JOB_STORE}, must be one of {', '.join(JOB_STORES)}")
+        _store = JOB_STORES[JOB_STORE]()
+    return _store
+
+
+'''
+Use another store in this process, e.g. a MemoryJobStore for a benchmark.
+'''
+def set_store(store):
+    global _store
+    _store = store
@@ -0,0 +1,217 @@
+import os
+import time
+import json
+import socket
+import logging
+import threading
+import functools
+from datetime import datetime, timedelta, timezone
+from azure.data.tables import TableServiceClient, UpdateMode
+
+METRICS_TABLE = "metrics"
+# Every process writes its metrics to the table at most this often, see maybe_flush
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 30))
+# Rows of processes that did not flush for this long are removed by remove_stale
+METRICS_STALE_HOURS = float(os.environ.get("METRICS_STALE_HOURS", 24))
+# Upper bounds of the buckets of all histograms, in seconds for latencies
+HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+'''
+Metrics of the pipeline: counters, gauges and histograms with labels, kept per process.
+A function app runs on several instances with several worker processes each (and the split
+forks more), so every process writes its own metrics as one row of the 'metrics' table
+(maybe_flush), and the /metrics endpoint merges all rows into the Prometheus text format
+(render). Counters and histograms are cumulative per process, gauges keep the last value.
+'''
+_lock = threading.Lock()
+_registry = None
+_last_flush = 0.0
+_table_created = False
+
+
+def _new_registry():
+    return {"pid": os.getpid(), "counters": {}, "gauges": {}, "histograms": {}}
+
+
+def _get_registry():
+    global _registry, _last_flush
+    # a forked process starts with the metrics of its parent, those are not its own
+    if _registry is None or _registry["pid"] != os.getpid():
+        _registry = _new_registry()
+        _last_flush = time.monotonic()
+    return _registry
+
+
+def _key(name, labels):
+    return name + json.dumps(sorted(labels.items()), separators=(',', ':'))
+
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        counters = _get_registry()["counters"]
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _get_registry()["gauges"][_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    with _lock:
+        histograms = _get_registry()["histograms"]
+        key = _key(name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {"buckets": [0] * len(HISTOGRAM_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+'''
+Decorator for the functions of function_app. Counts the invocations per status, observes the
+duration in function_duration_seconds and for queue triggers the dequeued messages, of which
+the ones with a dequeue count above 1 are retries. The metrics are flushed afterwards when
+they are due.
+'''
+def track(function_name):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            msg = kwargs.get("msg")
+            if msg is not None and getattr(msg, "dequeue_count", None) is not None:
+                inc("queue_dequeues_total", function=function_name)
+                if msg.dequeue_count > 1:
+                    inc("queue_redeliveries_total", function=function_name)
+
+            start = time.monotonic()
+            status = "ok"
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                observe("function_duration_seconds", time.monotonic() - start, function=function_name)
+                inc("function_invocations_total", function=function_name, status=status)
+                maybe_flush()
+        return wrapper
+    return decorator
+
+
+def _get_table_client():
+    global _table_created
+    conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
+    table_service = TableServiceClient.from_connection_string(conn_str)
+    if not _table_created:
+        table_service.create_table_if_not_exists(METRICS_TABLE)
+        _table_created = True
+    return table_service.get_table_client(table_name=METRICS_TABLE)
+
+
+def _instance_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+'''
+Write the metrics of this process to its row of the metrics table.
+'''
+def flush():
+    global _last_flush
+    with _lock:
+        data = json.dumps(_get_registry())
+        _last_flush = time.monotonic()
+    _get_table_client().upsert_entity({
+        "PartitionKey": "metrics",
+        "RowKey": _instance_id(),
+        "Data": data,
+    }, mode=UpdateMode.REPLACE)
+
+
+def maybe_flush(force=False):
+    if not force and time.monotonic() - _last_flush < METRICS_FLUSH_SECONDS:
+        return
+    try:
+        flush()
+    except Exception as e:
+        logging.error(f"Error flushing metrics: {e}")
+
+
+'''
+The metrics of all processes, the rows of the metrics table, oldest first.
+'''
+def collect_all():
+    rows = _get_table_client().query_entities("PartitionKey eq 'metrics'")
+    rows = sorted(rows, key=lambda row: row.metadata["timestamp"])
+    return [json.loads(row["Data"]) for row in rows]
+
+
+'''
+Remove the rows of processes that are gone. Their counters disappear from the sums, which
+Prometheus handles like a counter reset.
+'''
+def remove_stale():
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours=METRICS_STALE_HOURS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    table_client = _get_table_client()
+    stale = table_client.query_entities(f"PartitionKey eq 'metrics' and Timestamp lt datetime'{cutoff}'")
+    for row in stale:
+        table_client.delete_entity(partition_key=row["PartitionKey"], row_key=row["RowKey"])
+
+
+'''
+Merge the metrics of all processes into the Prometheus text format. Counters and histograms
+are summed, for gauges the value of the newest process wins.
+'''
+def render(registries):
+    counters, gauges, histograms = {}, {}, {}
+    for registry in registries:
+        for key, value in registry["counters"].items():
+            counters[key] = counters.get(key, 0) + value
+        gauges.update(registry["gauges"])
+        for key, histogram in registry["histograms"].items():
+            merged = histograms.setdefault(key, {"buckets": [0] * len(HISTOGRAM_BUCKETS), "sum": 0.0, "count": 0})
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], histogram["buckets"])]
+            merged["sum"] += histogram["sum"]
+            merged["count"] += histogram["count"]
+
+    lines = []
+    lines += _render_simple(counters, "counter")
+    lines += _render_simple(gauges, "gauge")
+    for name, series in _by_name(histograms).items():
+        lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in series:
+            for bound, count in zip(HISTOGRAM_BUCKETS, histogram["buckets"]):
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {count}")
+            lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {histogram['count']}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def _render_simple(values, metric_type):
+    lines = []
+    for name, series in _by_name(values).items():
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in series:
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return lines
+
+
+def _by_name(values):
+    by_name = {}
+    for key in sorted(values):
+        name, labels = key.split("[", 1)
+        by_name.setdefault(name, []).append((json.loads("[" + labels), values[key]))
+    return by_name
+
+
+def _labels(labels, **extra):
+    pairs = [(k, v) for k, v in labels] + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
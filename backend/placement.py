@@ -0,0 +1,150 @@
+import os
+import logging
+import cv2
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+import storage_functions
+from job_db import metadata_from_job
+from job_options import PLACEMENT_ANCHORS, parse_placement, parse_opacity
+
+'''
+Placement of the visible watermark (see job_options.parse_placement). The placement of a job
+is compiled once, by the split, into a table that is stored as the 'placement' blob:
+* sprite_rgb, sprite_alpha: the watermark resized to its size in the frame, uint8
+* opacity: the opacity of the job
+* offsets: (frames, 2) position (x, y) of the watermark in its cell for every frame of the
+  video, a single row when the watermark does not move
+* tiles: (cells, 2) position (x, y) of every cell in the frame
+The chunk workers only look up the row of the global frame index and blend the sprite into
+every cell, so a chunk continues the motion path exactly where the chunk before it ended and
+a moving or tiled watermark costs the same lookups as the centered one.
+'''
+
+
+'''
+Compile the placement spec for frames of width x height. times are the seconds of every frame
+of the video, only used by a motion path, None gives the position at 0 seconds.
+'''
+def compile_placement(watermark_image, spec, width, height, opacity, times=None):
+    columns, rows = spec["tile"] or (1, 1)
+    cell_width, cell_height = width / columns, height / rows
+
+    sprite_width = max(1, int(cell_width * spec["scale"]))
+    sprite_height = max(1, int(sprite_width * watermark_image.shape[0] / watermark_image.shape[1]))
+    sprite = cv2.resize(watermark_image, (sprite_width, sprite_height))
+    if sprite.ndim == 2:
+        sprite = cv2.cvtColor(sprite, cv2.COLOR_GRAY2BGR)
+    if sprite.shape[2] == 4:
+        sprite_rgb, sprite_alpha = sprite[:, :, :3], sprite[:, :, 3]
+    else:
+        sprite_rgb, sprite_alpha = sprite, np.full((sprite_height, sprite_width), 255, dtype=np.uint8)
+
+    # position in the free space of the cell, per frame for a motion path
+    if spec["path"] is None:
+        position = np.array([PLACEMENT_ANCHORS[spec["anchor"]]], dtype=np.float64)
+    else:
+        seconds, x, y = (np.array(values) for values in zip(*spec["path"]))
+        times = np.zeros(1) if times is None else np.asarray(times, dtype=np.float64)
+        if spec["loop"] and seconds[-1] > 0:
+            times = times % seconds[-1]
+        position = np.stack([np.interp(times, seconds, x), np.interp(times, seconds, y)], axis=1)
+
+    margin = spec["margin"] * cell_width
+    free = np.array([cell_width - sprite_width - 2 * margin, cell_height - sprite_height - 2 * margin])
+    offsets = np.floor(margin + position * free).astype(np.int32)
+    tiles = np.array([(int(column * cell_width), int(row * cell_height)) for row in range(rows) for column in range(columns)],
+                     dtype=np.int32)
+
+    return {"sprite_rgb": np.ascontiguousarray(sprite_rgb), "sprite_alpha": np.ascontiguousarray(sprite_alpha),
+            "opacity": np.float32(opacity), "offsets": offsets, "tiles": tiles}
+
+
+'''
+The blend weights of a compiled table, computed once per chunk: weight is the alpha of the
+sprite times the opacity, the sprite is premultiplied with it.
+'''
+def prepare_placement(table):
+    weight = (table["sprite_alpha"].astype(np.float32) / 255 * float(table["opacity"]))[:, :, None]
+    return {
+        "inverse_weight": 1 - weight,
+        "premultiplied": table["sprite_rgb"].astype(np.float32) * weight,
+        "offsets": np.asarray(table["offsets"]),
+        "tiles": np.asarray(table["tiles"]),
+    }
+
+
+'''
+Blend the watermark into the frame with the given global frame index, in place. Parts of the
+sprite outside the frame are cut off.
+'''
+def blend_placement(video_frame, placement, frame_index):
+    frame_height, frame_width = video_frame.shape[:2]
+    sprite_height, sprite_width = placement["inverse_weight"].shape[:2]
+    offsets = placement["offsets"]
+    offset = offsets[min(frame_index, len(offsets) - 1)]
+
+    for x, y in placement["tiles"] + offset:
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + sprite_width, frame_width), min(y + sprite_height, frame_height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        roi = video_frame[y0:y1, x0:x1]
+        sprite = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        blended = roi * placement["inverse_weight"][sprite]
+        blended += placement["premultiplied"][sprite]
+        np.copyto(roi, blended, casting="unsafe")
+
+
+'''
+Compile the placement of a job from the watermark image (bytes of the uploaded image) and
+the probed metadata of the video (see video_probe.probe_video), and upload it as the
+'placement' blob. Returns the table.
+'''
+def save_job_placement(job_id, watermark_data, options, meta):
+    table = _compile_job_placement(cv2.imdecode(np.frombuffer(watermark_data, dtype=np.uint8), cv2.IMREAD_UNCHANGED),
+                                   options, meta)
+    placement_path = storage_functions._unique_filepath_tmp('npz')
+    try:
+        with open(placement_path, "wb") as f:
+            np.savez_compressed(f, **table)
+        storage_functions.upload_file_internal(job_id, placement_path, 'placement')
+    finally:
+        os.remove(placement_path)
+    return table
+
+
+def _compile_job_placement(watermark_image, options, meta):
+    if watermark_image is None:
+        raise ValueError("can't load the watermark image")
+    spec = parse_placement(options)
+    times = np.arange(meta["frame_count"]) / meta["fps"] if spec["path"] is not None else None
+    return compile_placement(watermark_image, spec, meta["width"], meta["height"], parse_opacity(options), times)
+
+
+'''
+The prepared placement of a job for a chunk worker. Jobs whose watermark was not moved by the
+split have no 'placement' blob, their placement is compiled here from the watermark and the
+metadata in the job entry.
+'''
+def load_job_placement(job_id, job, options):
+    placement_path = storage_functions._unique_filepath_tmp('npz')
+    try:
+        storage_functions.download_file_internal(job_id, 'placement', placement_path)
+        with np.load(placement_path) as table:
+            return prepare_placement(dict(table))
+    except RuntimeError as e:
+        if not isinstance(e.__cause__, ResourceNotFoundError):
+            raise
+    finally:
+        if os.path.exists(placement_path):
+            os.remove(placement_path)
+
+    logging.info(f"Job {job_id} has no placement, compiling it from the watermark")
+    watermark_path = storage_functions._unique_filepath_tmp('jpg')
+    try:
+        storage_functions.download_file_internal(job_id, 'watermark', watermark_path)
+        watermark_image = cv2.imread(watermark_path, cv2.IMREAD_UNCHANGED)
+    finally:
+        if os.path.exists(watermark_path):
+            os.remove(watermark_path)
+    return prepare_placement(_compile_job_placement(watermark_image, options, metadata_from_job(job)))
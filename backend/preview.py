@@ -0,0 +1,144 @@
+import os
+import subprocess
+import cv2
+import imageio_ffmpeg as ffmpeg
+import storage_functions
+import numpy as np
+import invisible_watermark
+from job_options import parse_opacity, parse_placement, parse_watermark_mode
+from watermarking import process_video_chunk
+from placement import compile_placement, prepare_placement, blend_placement
+
+# Number of frames in a preview clip when the request does not give one, and the maximum
+PREVIEW_CLIP_FRAMES = int(os.environ.get("PREVIEW_CLIP_FRAMES", 50))
+PREVIEW_MAX_FRAMES = int(os.environ.get("PREVIEW_MAX_FRAMES", 150))
+PREVIEW_FORMATS = ("jpg", "mp4")
+# Id whose payload invisible previews embed, a preview has no job yet
+PREVIEW_JOB_ID = "preview"
+# Demuxers ffmpeg may use for the video of the user, no playlists that point to other urls
+PREVIEW_INPUT_FORMATS = "mov,mp4,m4a,3gp,3g2,mj2,matroska,webm,avi,mpegts,flv"
+
+
+'''
+Render a preview of the watermark on the video of the user, before the job is started. The
+video is never downloaded as a whole: ffmpeg opens the SAS URL itself and only reads the
+index and the bytes around start_seconds with HTTP range requests.
+* jpg: the frame at start_seconds with the watermark, as a jpg image.
+* mp4: a clip of num_frames frames from the keyframe at or before start_seconds on, watermarked
+  by process_video_chunk and encoded with libx264 so a browser can play it.
+The preview uses the watermark_mode, opacity and placement of the options, a motion path is
+shown from start_seconds on. It always shows the watermark, also outside the watermark_ranges.
+An invisible preview embeds the payload of PREVIEW_JOB_ID, which changes the frames as much as
+the payload of the job will, and needs no image_SAS.
+Both SAS urls must point to blobs of our account (see storage_functions.is_account_blob_url),
+the preview is anonymous and ffmpeg would otherwise open any path or url it is given.
+Returns (bytes, mimetype).
+'''
+def render_preview(video_SAS, image_SAS, options, start_seconds=0, output_format="jpg", num_frames=None):
+    if output_format not in PREVIEW_FORMATS:
+        raise ValueError(f"invalid format {output_format}, must be one of {', '.join(PREVIEW_FORMATS)}")
+    num_frames = PREVIEW_CLIP_FRAMES if num_frames is None else int(num_frames)
+    if not 0 < num_frames <= PREVIEW_MAX_FRAMES:
+        raise ValueError(f"invalid number of frames {num_frames}, must be between 1 and {PREVIEW_MAX_FRAMES}")
+    if start_seconds < 0:
+        raise ValueError(f"invalid time {start_seconds}")
+    mode = parse_watermark_mode(options)
+    if mode == "visible" and image_SAS is None:
+        raise ValueError("a visible watermark needs the watermark image")
+    for url in (video_SAS, image_SAS if mode == "visible" else None):
+        if url is not None and not storage_functions.is_account_blob_url(url):
+            raise ValueError("the video and the watermark must be blobs of this storage account")
+    alpha = parse_opacity(options)
+    spec = parse_placement(options)
+
+    watermark_path = None
+    if mode == "visible":
+        watermark_path = storage_functions._unique_filepath_tmp('jpg')
+        storage_functions.get_user_video(image_SAS, watermark_path)
+    try:
+        if output_format == "jpg":
+            return _render_frame(video_SAS, watermark_path, start_seconds, alpha, spec), "image/jpeg"
+        return _render_clip(video_SAS, watermark_path, start_seconds, num_frames, alpha, spec), "video/mp4"
+    finally:
+        if watermark_path is not None:
+            os.remove(watermark_path)
+
+
+def _render_frame(video_SAS, watermark_path, start_seconds, alpha, spec):
+    frame_path = storage_functions._unique_filepath_tmp('png')
+    try:
+        # seeking before the input decodes from the keyframe before start_seconds, but only
+        # the frame at start_seconds is written
+        _run_ffmpeg(["-ss", f"{start_seconds:.3f}", *_input(video_SAS), "-map", "0:v:0", "-frames:v", "1"], frame_path)
+        frame = cv2.imread(frame_path)
+    finally:
+        if os.path.exists(frame_path):
+            os.remove(frame_path)
+    if frame is None:
+        raise ValueError(f"no frame at {start_seconds} seconds")
+
+    if watermark_path is None:
+        invisible_watermark.embed_frame(frame, invisible_watermark.embedding_pattern(PREVIEW_JOB_ID, *frame.shape[:2]))
+        return _encode_jpg(frame)
+    watermark_image = cv2.imread(watermark_path, cv2.IMREAD_UNCHANGED)
+    if watermark_image is None:
+        raise ValueError("can't load the watermark image")
+    table = compile_placement(watermark_image, spec, frame.shape[1], frame.shape[0], alpha, np.array([start_seconds]))
+    blend_placement(frame, prepare_placement(table), 0)
+    return _encode_jpg(frame)
+
+
+def _encode_jpg(frame):
+    success, image = cv2.imencode(".jpg", frame)
+    if not success:
+        raise RuntimeError("can't encode the preview image")
+    return image.tobytes()
+
+
+def _render_clip(video_SAS, watermark_path, start_seconds, num_frames, alpha, spec):
+    clip_path = storage_functions._unique_filepath_tmp('mp4')
+    outputs = {}
+    try:
+        # stream copy, the clip starts at the keyframe at or before start_seconds
+        _run_ffmpeg(["-ss", f"{start_seconds:.3f}", *_input(video_SAS), "-map", "0:v:0", "-frames:v", str(num_frames),
+                     "-c", "copy", "-avoid_negative_ts", "make_zero"], clip_path)
+        if watermark_path is None:
+            outputs = process_video_chunk(PREVIEW_JOB_ID, clip_path, None, "preview", intermediate="x264", mode="invisible")
+        else:
+            placement = _clip_placement(clip_path, watermark_path, start_seconds, num_frames, alpha, spec)
+            outputs = process_video_chunk(None, clip_path, None, "preview", intermediate="x264", placement=placement)
+        if outputs is None:
+            raise ValueError("can't read the video")
+        with open(outputs[None], "rb") as f:
+            return f.read()
+    finally:
+        for path in [clip_path, *(outputs or {}).values()]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _clip_placement(clip_path, watermark_path, start_seconds, num_frames, alpha, spec):
+    watermark_image = cv2.imread(watermark_path, cv2.IMREAD_UNCHANGED)
+    if watermark_image is None:
+        raise ValueError("can't load the watermark image")
+    capture = cv2.VideoCapture(clip_path)
+    width, height = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    capture.release()
+    if width <= 0 or height <= 0:
+        raise ValueError("can't read the video")
+    times = start_seconds + np.arange(num_frames) / fps
+    return prepare_placement(compile_placement(watermark_image, spec, width, height, alpha, times))
+
+
+# ffmpeg may only use the network protocols of the blob url, no files, concat:, subfile: or playlists
+def _input(url):
+    protocols = "https,tls,tcp" if url.lower().startswith("https:") else "http,tcp"
+    return ["-protocol_whitelist", protocols, "-format_whitelist", PREVIEW_INPUT_FORMATS, "-i", url]
+
+
+def _run_ffmpeg(args, output_path):
+    command = [ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error", *args, "-y", output_path]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"preview: ffmpeg failed: {result.stderr.strip()}")
@@ -0,0 +1,130 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+import functools
+from datetime import datetime, timezone
+from azure.storage.blob import BlobServiceClient
+
+PROFILES_CONTAINER = "profiles"
+# Profile every PROFILE_EVERY-th invocation of a function per process, 0 only profiles jobs
+# that have the profile option
+PROFILE_EVERY = int(os.environ.get("PROFILE_EVERY", 0))
+# Number of allocation sites in the memory summary
+TOP_ALLOCATIONS = 25
+
+_invocations = {}
+_invocations_lock = threading.Lock()
+_container_created = False
+# tracemalloc is global to the process, so only one invocation at a time is profiled
+_profiling_lock = threading.Lock()
+
+
+'''
+Decorator for the queue and HTTP triggers of function_app. An invocation is profiled when its
+message (or request body) has "profile": true, which is set on all messages of a job with the
+profile option, or when it is the PROFILE_EVERY-th invocation of the function in this process.
+A profiled invocation runs under cProfile and tracemalloc. Afterwards the stats are uploaded
+to the 'profiles' container as <job_id>/<function>/<chunks>-<time>.pstats, with the peak
+memory and the allocation sites that still hold the most memory at the end (leaks, caches)
+in a .mem.json next to it (see merge_profiles.py).
+Only the invoked process is profiled, not the processes it starts (split ranges, ffmpeg).
+Invocations that run while another one is profiled in the same process, or while tracemalloc
+was started by someone else, are not profiled.
+'''
+def profiled(function_name):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            data = _invocation_data(kwargs)
+            if not _should_profile(function_name, data) or not _profiling_lock.acquire(blocking=False):
+                return handler(*args, **kwargs)
+            if tracemalloc.is_tracing():
+                # traced by someone else, their trace must not be stopped here
+                _profiling_lock.release()
+                return handler(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            try:
+                tracemalloc.start()
+                start = time.monotonic()
+                profiler.enable()
+                try:
+                    return handler(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    duration = time.monotonic() - start
+                    _, peak = tracemalloc.get_traced_memory()
+                    top = tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]
+                    tracemalloc.stop()
+            finally:
+                _profiling_lock.release()
+                try:
+                    _upload_profile(function_name, data, profiler, {
+                        "function": function_name,
+                        "duration_seconds": duration,
+                        "peak_bytes": peak,
+                        "retained_allocations": [{"site": str(stat.traceback), "bytes": stat.size, "count": stat.count}
+                                            for stat in top],
+                    })
+                except Exception as e:
+                    logging.error(f"Error uploading profile of {function_name}: {e}")
+        return wrapper
+    return decorator
+
+
+def _invocation_data(kwargs):
+    try:
+        if kwargs.get("msg") is not None:
+            return json.loads(kwargs["msg"].get_body().decode("utf-8"))
+        if kwargs.get("req") is not None:
+            return kwargs["req"].get_json()
+    except ValueError:
+        pass
+    return {}
+
+
+def _should_profile(function_name, data):
+    if data.get("profile"):
+        return True
+    if PROFILE_EVERY <= 0:
+        return False
+    # the triggers of one function run in several threads at once
+    with _invocations_lock:
+        _invocations[function_name] = _invocations.get(function_name, 0) + 1
+        return _invocations[function_name] % PROFILE_EVERY == 0
+
+
+def _upload_profile(function_name, data, profiler, memory_summary):
+    global _container_created
+    service = BlobServiceClient.from_connection_string(os.environ["AZURE_STORAGE_CONNECTION_STRING"])
+    container = service.get_container_client(PROFILES_CONTAINER)
+    if not _container_created:
+        if not container.exists():
+            container.create_container()
+        _container_created = True
+
+    # group messages hold [[chunk_id, ...], ...], single messages a chunk_id
+    chunk_ids = [str(chunk[0]) for chunk in data.get("chunks", [])]
+    if "chunk_id" in data:
+        chunk_ids = [str(data["chunk_id"])]
+    chunks = "chunks-" + "-".join(chunk_ids) if chunk_ids else "job"
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    name = f"{data.get('job_id', 'unknown')}/{function_name}/{chunks}-{timestamp}"
+
+    # pstats can only write its binary format to a file
+    stats_path = f"/tmp/{os.getpid()}-{timestamp}.pstats"
+    try:
+        pstats.Stats(profiler).dump_stats(stats_path)
+        with open(stats_path, "rb") as f:
+            container.upload_blob(f"{name}.pstats", f, overwrite=True)
+    finally:
+        if os.path.exists(stats_path):
+            os.remove(stats_path)
+    container.upload_blob(f"{name}.mem.json", io.BytesIO(json.dumps(memory_summary).encode("utf-8")), overwrite=True)
+    logging.info(f"Uploaded profile {name}")
@@ -0,0 +1,110 @@
+import os
+import json
+import threading
+from azure.storage.queue import (
+        QueueClient,
+        BinaryBase64EncodePolicy,
+        BinaryBase64DecodePolicy
+)
+from storage_retry import call_with_retries
+
+# Number of chunks that the split packs into one watermark/thumbnail message
+CHUNK_GROUP_SIZE = int(os.environ.get("CHUNK_GROUP_SIZE", 4))
+# Deliveries of a message before the host moves it to the poison queue (maxDequeueCount of the host)
+QUEUE_MAX_DEQUEUE_COUNT = int(os.environ.get("QUEUE_MAX_DEQUEUE_COUNT", 5))
+
+# Queue clients are reused, one per queue per process
+_clients = {}
+_clients_lock = threading.Lock()
+
+'''
+Queues used in the pipeline:
+* splitqueue: start of a job, triggers the split of the input video
+* watermarkqueue: a group of chunks that has to be watermarked
+* thumbnailqueue: a group of chunks that needs thumbnails
+* watermarkdone: all chunks are watermarked, triggers the concat
+* thumbnaildone: all thumbnails are made, triggers the thumbnail concat
+The client is created once per process and reused for every message after that.
+'''
+def get_queue_client(queue_name):
+    key = (os.getpid(), queue_name)  # clients are not shared with forked processes
+    with _clients_lock:
+        queue = _clients.get(key)
+        if queue is None:
+            queue = QueueClient.from_connection_string(conn_str=os.environ["AZURE_STORAGE_CONNECTION_STRING"], queue_name=queue_name)
+            queue.message_encode_policy = BinaryBase64EncodePolicy()
+            queue.message_decode_policy = BinaryBase64DecodePolicy()
+            _clients[key] = queue
+        return queue
+
+
+'''
+Send a dict as a compact json message to a queue. The queue triggers expect base64 encoded bytes.
+'''
+def send_message(queue_name, message, queue=None):
+    if queue is None:
+        queue = get_queue_client(queue_name)
+    message_bytes = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    queue.send_message(queue.message_encode_policy.encode(content=message_bytes))
+
+
+'''
+Send the trigger of a later stage (watermarkdone, thumbnaildone). Only the worker that
+finishes the last chunk sends it, so a lost trigger would leave the job unfinished; transient
+errors are retried like storage operations (see storage_retry.call_with_retries).
+'''
+def send_trigger(queue_name, message):
+    call_with_retries(lambda: send_message(queue_name, message), f"Sending to {queue_name}")
+
+
+'''
+Build one message for a group of chunks of a job. Every chunk is a dict with chunk_id and,
+when known, its chunk info (start_frame, num_frames, fps, width, height). The frame size and
+fps are the same for every chunk of a job, so they are only sent once. Format:
+{"job_id": ..., "fps": ..., "width": ..., "height": ..., "chunks": [[chunk_id, start_frame, num_frames], ...]}
+With profile the message also has "profile": true (see profiling.profiled).
+'''
+def group_message(job_id, chunks, profile=False):
+    message = {"job_id": job_id}
+    if profile:
+        message["profile"] = True
+    if chunks and "num_frames" in chunks[0]:
+        for key in ("fps", "width", "height"):
+            message[key] = chunks[0][key]
+        message["chunks"] = [[c["chunk_id"], c["start_frame"], c["num_frames"]] for c in chunks]
+    else:
+        message["chunks"] = [[c["chunk_id"]] for c in chunks]
+    return message
+
+
+'''
+Unpack a watermark or thumbnail message into one dict per chunk, with job_id, chunk_id and the
+chunk info if it was sent. Also accepts the old messages with a single chunk_id.
+'''
+def chunk_messages(message):
+    if "chunks" not in message:
+        return [message]
+
+    chunks = []
+    for entry in message["chunks"]:
+        chunk = {"job_id": message["job_id"], "chunk_id": entry[0]}
+        if len(entry) >= 3:
+            chunk.update({
+                "start_frame": entry[1],
+                "num_frames": entry[2],
+                "fps": message["fps"],
+                "width": message["width"],
+                "height": message["height"],
+            })
+        chunks.append(chunk)
+    return chunks
+
+
+'''
+Frame range and geometry of a chunk as sent by the split (start_frame, num_frames, fps,
+width, height). Returns None for messages without chunk info.
+'''
+def chunk_info(message):
+    if "num_frames" not in message:
+        return None
+    return {key: message[key] for key in ("start_frame", "num_frames", "fps", "width", "height")}
@@ -1,55 +1,32 @@
-import requests
 from job_db import create_job_entry
+from storage_functions import uploaded_blob_name
+from queue_functions import send_message
 
-BASE_URL = 'https://watermark-backend.azurewebsites.net/api/'
-MOVE_WATERMARK_URL = BASE_URL + 'move_watermark_func'
-SPLIT_CHUNKS_URL = BASE_URL + 'split_chunks_func' 
 CHUNK_SIZE = 50
 
-# === Helper Function ===
-def post_json(url, payload):
-    """Send a POST request with JSON payload and print status."""
-    r = requests.post(url, json=payload)
-    print(f"{url} → {r.status_code}")
-    if not r.ok:
-        print("Response:", r.text)
-    return r
-
-def run_pipeline(job_id, video_SAS, image_SAS):
-    create_job_entry(job_id)  # voeg job-status toe
-    
-    # === Step 1: Move watermark to a storage location that we can find
-    print("\nStep 1: Moving watermark to reachable location...")
-    response = post_json(MOVE_WATERMARK_URL, {
-        "job_id" : job_id,
-        "image_SAS": image_SAS
-    })
-    if not response.ok:
-        raise Exception(f"Exception in moving watermark: {response.status_code}: {response.text}")
-
-    # === Step 2: Split video into chunks ===
-    print("\nStep 2: Splitting into chunks...")
-    response = post_json(SPLIT_CHUNKS_URL, {
-        "job_id" : job_id,
+'''
+Start a job. This only registers the job and puts a message on the split queue, so the
+caller gets an answer immediately. The rest of the pipeline is driven by queues.
+'''
+def run_pipeline(job_id, video_SAS, image_SAS, options=None):
+    # remember the uploads of the user, so they are removed with the job
+    upload_names = [uploaded_blob_name(video_SAS), uploaded_blob_name(image_SAS)]
+    create_job_entry(job_id, options, [name for name in upload_names if name])  # voeg job-status toe
+
+    # === Step 1 + 2: Move watermark and split video into chunks, done by split_chunks_queue_func.
+    # A failed split is retried by the queue.
+    send_message("splitqueue", {
+        "job_id": job_id,
         "video_SAS": video_SAS,
-        "chunk_size": CHUNK_SIZE
+        "image_SAS": image_SAS,
+        "chunk_size": CHUNK_SIZE,
+        "profile": bool((options or {}).get("profile"))
     })
-    if not response.ok: 
-        raise Exception(f"Exception in splitting video chunks: {response.status_code}: {response.text}")
-
 
-    # === Step 3: Apply watermark to each chunk, imediately triggered after splitting func. 
-    
+    # === Step 3: Apply watermark to each chunk, imediately triggered after splitting a chunk.
 
-    # === Step 4a: Generate thumbnails from first frame of each chunk, immediately triggered after splitting func ===
+    # === Step 4a: Generate thumbnails from first frame of each chunk, immediately triggered after splitting a chunk ===
 
-    
     # === Step 4b: Concatenate thumbnails into one image, tirggered after all thumbnails are done ===
 
     # === Step 5: Concatenate processed video chunks, triggered after all watermarking is done ===
-
-    
-    
-
-
- 
\ No newline at end of file
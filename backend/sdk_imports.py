@@ -0,0 +1,43 @@
+import sys
+import importlib
+
+# The storage SDK packages the function app imports at startup
+STORAGE_SDK_MODULES = ["azure.storage.blob", "azure.storage.queue", "azure.data.tables"]
+# Modules of the SDK that import the aiohttp transport of azure-core to recognise it when they sign a request
+SIGNING_MODULES = ["azure.storage.blob._shared.authentication", "azure.storage.queue._shared.authentication"]
+
+'''
+azure.storage.blob and azure.storage.queue import aiohttp as soon as they are imported when it
+is installed, also for the sync clients, which adds about 0.2 s to every cold start although
+only the async clients of storage_async use it. function_app imports the SDK with
+import_storage_sdk, which hides aiohttp from it, and storage_async calls enable_aiohttp before
+it creates a client, so aiohttp is imported lazily like the codec stack.
+'''
+
+
+'''
+Import the storage SDK without aiohttp. A no-op for the packages that are already imported.
+'''
+def import_storage_sdk():
+    hide = "aiohttp" not in sys.modules
+    if hide:
+        # a None entry makes `import aiohttp` raise ImportError, like when it is not installed
+        sys.modules["aiohttp"] = None
+    try:
+        for module in STORAGE_SDK_MODULES:
+            importlib.import_module(module)
+    finally:
+        if hide and sys.modules.get("aiohttp", False) is None:
+            del sys.modules["aiohttp"]
+
+
+'''
+Give the signing modules the aiohttp transport they did not get in import_storage_sdk, so they
+sign the requests of the async clients like without it. Imports aiohttp.
+'''
+def enable_aiohttp():
+    from azure.core.pipeline.transport import AioHttpTransport
+    for name in SIGNING_MODULES:
+        module = sys.modules.get(name)
+        if module is not None and module.AioHttpTransport is None:
+            module.AioHttpTransport = AioHttpTransport
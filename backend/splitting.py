@@ -0,0 +1,297 @@
+import os
+import json
+import bisect
+import subprocess
+import cv2
+import numpy as np
+import imageio_ffmpeg as ffmpeg
+import logging
+from multiprocessing import Pool, Event
+import storage_functions
+from job_db import update_job, get_chunk_states, mark_chunks_done, passthrough_to_runs
+from job_store import get_store
+from job_options import (parse_renditions, parse_intermediate, parse_thumbnails, parse_watermark_mode, watermark_frame_ranges,
+                         overlaps_frame_ranges)
+from queue_functions import get_queue_client, send_trigger
+from chunk_uploader import ChunkUploader
+import metrics
+from video_probe import probe_video, plan_chunks, plan_ranges
+from watermarking import open_video_writer
+from placement import save_job_placement
+from thumbnail_select import ChunkSampler
+
+# Number of processes that split disjoint ranges of the video at the same time
+SPLIT_PROCESSES = int(os.environ.get("SPLIT_PROCESSES", os.cpu_count() or 1))
+
+# Set in every range worker by _init_range_worker, see split_video
+_watermark_ready = None
+
+
+'''
+Split the user video into chunks of about chunk_size frames.
+The video is probed once for its exact frame count and keyframes, and the chunks are
+planned up front (see video_probe.plan_chunks), so TotalNumChunks is in the database
+before the first chunk is enqueued and every chunk_id is fixed by the plan.
+The chunks are then divided into contiguous ranges that are split by a pool of processes.
+Every process uploads its chunks and sends them to the watermark and thumbnail queues.
+When image_SAS is given the watermark is moved and the placement of the job is compiled (see
+placement.save_job_placement) while the ranges are split, and chunks are only sent to the
+watermark queue once both are in place.
+With the watermark_ranges option, chunks that are completely outside the ranges are
+pass-through: they are not sent to the watermark queue and the concat takes them from
+video_chunk_orig. They are marked as watermarked right away.
+With the copy intermediate format, chunks that start and end on a keyframe are stream-copied
+from the source instead of decoded and encoded again.
+With the scene thumbnail_mode the best frame of every chunk that is decoded here becomes its
+thumbnail, so those chunks skip the thumbnail queue (see thumbnail_select.ChunkSampler).
+The split is retried by the queue when it fails. Chunks that were dispatched before (see
+ChunkUploader) are not split again, and the workers count every chunk only once (see
+job_db.mark_chunks_done), so chunks of the failed attempt are not counted twice.
+The job store must be shared between processes, so not JOB_STORE=memory.
+Returns the number of chunks.
+'''
+def split_video(job_id, video_SAS, chunk_size, image_SAS=None, options=None):
+    # the ranges are split in other processes, which could not update a store in this one
+    if not get_store().shared_between_processes:
+        raise RuntimeError(f"the split needs a job store that is shared between processes, not {type(get_store()).__name__}")
+
+    # path to store the video locally
+    video_path = storage_functions._unique_filepath_tmp('mp4')
+    storage_functions.get_user_video(video_SAS, video_path)
+
+    try:
+        meta = probe_video(video_path)
+        chunks = plan_chunks(meta["keyframes"], meta["frame_count"], chunk_size)
+        # a retried split leaves out the chunks that were already sent to the workers
+        dispatched = {chunk_id for chunk_id, state in get_chunk_states(job_id).items() if state.get("Dispatched")}
+        ranges = [r for r in ([c for c in r if c[0] not in dispatched] for r in plan_ranges(chunks, SPLIT_PROCESSES)) if r]
+        logging.info(f"Splitting {meta['frame_count']} frames into {len(chunks)} chunks over {len(ranges)} processes, "
+                     f"{len(dispatched)} chunks were already dispatched")
+
+        # With renditions every chunk has to be scaled, so nothing can be passed through
+        passthrough = set()
+        if not parse_renditions(options or {}):
+            frame_ranges = watermark_frame_ranges(options or {}, meta["fps"])
+            passthrough = {c[0] for c in chunks if not overlaps_frame_ranges(frame_ranges, c[1], c[2])}
+
+        intermediate = parse_intermediate(options or {})
+        copyable = {}
+        if intermediate == "copy":
+            # chunk id -> where the seek to its first keyframe lands
+            seek_times = dict(zip(meta["keyframes"], meta["keyframe_times"]))
+            bounds = set(meta["keyframes"]) | {meta["frame_count"]}
+            copyable = {c[0]: seek_times[c[1]] for c in chunks if c[1] in seek_times and c[2] in bounds}
+            logging.info(f"Stream-copying {len(copyable)} of {len(chunks)} chunks")
+
+        scene_thumbnails = parse_thumbnails(options or {})[0] == "scene"
+        profile = bool((options or {}).get("profile"))
+
+        # the metadata is probed only here, the workers get it from the job or their message
+        save_metadata(job_id, meta)
+        update_job(job_id, {
+            "TotalNumChunks": len(chunks),
+            "Metadata": json.dumps(job_metadata(meta)),
+            "PassThrough": passthrough_to_runs(passthrough),
+        })
+        # a retried split must not overwrite what the workers counted since, so they are marked per chunk
+        watermark_complete = mark_chunks_done(job_id, sorted(passthrough), "Watermarked", "ChunkWatermarkDone", len(chunks))
+
+        watermark_ready = Event() if image_SAS is not None else None
+        seek_index = (meta["keyframes"], meta["keyframe_times"])
+        args = [(job_id, video_path, r, meta["fps"], meta["width"], meta["height"], passthrough, intermediate, copyable,
+                 scene_thumbnails, len(chunks), profile, seek_index) for r in ranges]
+
+        # Leaving the with block terminates the workers, also when moving the watermark fails
+        with Pool(processes=max(1, len(ranges)), initializer=_init_range_worker, initargs=(watermark_ready,)) as pool:
+            result = pool.map_async(split_range, args)
+            if image_SAS is not None:
+                watermark_data = storage_functions.move_watermark(job_id, image_SAS)
+                # the chunks are only enqueued once the placement is there
+                if parse_watermark_mode(options or {}) == "visible":
+                    save_job_placement(job_id, watermark_data, options or {}, meta)
+                watermark_ready.set()
+            result.get()
+    finally:
+        os.remove(video_path) # we don't need the full input video anymore, so remove it.
+
+    # nothing to watermark at all, so no worker will trigger the concat
+    if watermark_complete:
+        send_trigger("watermarkdone", {
+            "job_id": job_id,
+            "num_watermark_chunks": len(chunks),
+            "profile": bool((options or {}).get("profile"))
+        })
+
+    update_job(job_id, {"SplitDone": True})
+    return len(chunks)
+
+
+'''
+The part of the probed metadata that is stored in the job entry. The keyframe index can be
+large for long videos, so it is only stored in the 'metadata' blob (see save_metadata).
+'''
+def job_metadata(meta):
+    return {key: value for key, value in meta.items() if key not in ("keyframes", "keyframe_times")}
+
+
+'''
+Upload the full probed metadata, including the keyframe index, as the 'metadata' blob.
+'''
+def save_metadata(job_id, meta):
+    metadata_path = storage_functions._unique_filepath_tmp('json')
+    try:
+        with open(metadata_path, "w") as f:
+            json.dump(meta, f)
+        storage_functions.upload_file_internal(job_id, metadata_path, 'metadata')
+    finally:
+        os.remove(metadata_path)
+
+
+def _init_range_worker(watermark_ready):
+    global _watermark_ready
+    _watermark_ready = watermark_ready
+
+
+'''
+Split one range of planned chunks, runs in a worker process of split_video.
+args is (job_id, video_path, chunks, fps, width, height, passthrough, intermediate, copyable,
+scene_thumbnails, total_chunks, profile, seek_index) with chunks a list of (chunk_id, start_frame, end_frame) that follow each other, passthrough
+the set of chunk ids that skip the watermark queue, intermediate the chunk format (see
+job_options.parse_intermediate) and copyable maps the ids of the chunks that are stream-copied
+to the seek time of their first keyframe (see video_probe.probe_video).
+The video is only decoded for the chunks that are not copied, by a FrameReader with the
+(keyframes, keyframe_times) of seek_index. With scene_thumbnails those chunks also get their
+thumbnail here. profile is passed on in the messages (see profiling).
+'''
+def split_range(args):
+    (job_id, video_path, chunks, fps, width, height, passthrough, intermediate, copyable, scene_thumbnails,
+     total_chunks, profile, seek_index) = args
+
+    reader = FrameReader(video_path, width, height, *seek_index)
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    # Finished chunks are uploaded and enqueued in the background while decoding continues
+    uploader = ChunkUploader(job_id, get_queue_client("watermarkqueue"), get_queue_client("thumbnailqueue"),
+                             watermark_ready=_watermark_ready, total_chunks=total_chunks, profile=profile)
+    try:
+        for chunk_id, start_frame, end_frame in chunks:
+            chunk_path = storage_functions._unique_filepath_tmp('mp4')
+            thumbnail_path = None
+            logging.info(f"Writing chunk {chunk_id} (frames {start_frame}-{end_frame}) to {chunk_path}")
+
+            if chunk_id in copyable:
+                copy_frames(video_path, chunk_path, copyable[chunk_id], end_frame - start_frame)
+                frames_written = end_frame - start_frame
+            else:
+                # the frames of copied or skipped chunks were not decoded, so seek to the chunk first
+                reader.seek(start_frame)
+                writer = open_video_writer(chunk_path, fps, (width, height), intermediate=intermediate)
+                sampler = ChunkSampler() if scene_thumbnails else None
+                frames_written = 0
+                for _ in range(end_frame - start_frame):
+                    if not reader.read(frame):
+                        break
+                    writer.write(frame)
+                    if sampler is not None:
+                        sampler.add(frame)
+                    frames_written += 1
+                writer.release()
+
+                if sampler is not None and sampler.best_frame is not None:
+                    thumbnail_path = storage_functions._unique_filepath_tmp('jpg')
+                    cv2.imwrite(thumbnail_path, sampler.best_frame)
+
+            if frames_written == 0:
+                os.remove(chunk_path)
+                raise RuntimeError(f"split_range: no frames could be read for chunk {chunk_id}")
+
+            metrics.inc("frames_total", frames_written, stage="split")
+            metrics.inc("chunks_total", stage="split")
+            uploader.submit(chunk_path, chunk_id, chunk_info={
+                "start_frame": start_frame,
+                "num_frames": frames_written,
+                "fps": fps,
+                "width": width,
+                "height": height,
+                "passthrough": chunk_id in passthrough,
+            }, thumbnail_path=thumbnail_path)
+    finally:
+        reader.close()
+        # wait until every chunk is uploaded and enqueued
+        uploader.close()
+        # this runs in a worker process of the pool, its metrics would be lost otherwise
+        metrics.maybe_flush(force=True)
+
+    return len(chunks)
+
+
+'''
+Reads the frames of a video frame-accurately from any frame on. ffmpeg seeks to the keyframe
+at or before the frame by its timestamp (keyframe_times of video_probe.probe_video), decodes
+forward and writes raw BGR frames to a pipe; the frames before the wanted one are dropped.
+cv2.VideoCapture seeks by a frame number it computes from the frame rate, which lands on the
+wrong frame for chunks that don't start on a keyframe or a variable frame rate. A seek to a
+frame that can be reached by decoding on from the current position does not restart ffmpeg.
+'''
+class FrameReader:
+    def __init__(self, video_path, width, height, keyframes, keyframe_times):
+        self.video_path = video_path
+        self.keyframes = keyframes
+        self.keyframe_times = keyframe_times
+        self.position = 0  # the next frame that is read
+        self._process = None
+        self._skipped = np.empty((height, width, 3), dtype=np.uint8)
+
+    def seek(self, frame_index):
+        k = bisect.bisect_right(self.keyframes, frame_index) - 1
+        keyframe = self.keyframes[k] if k >= 0 else 0
+        if self._process is None or not keyframe <= self.position <= frame_index:
+            self.close()
+            command = [ffmpeg.get_ffmpeg_exe(), "-loglevel", "error"]
+            if keyframe > 0:
+                # lands on the keyframe itself, an accurate seek would drop it
+                command += ["-noaccurate_seek", "-ss", f"{self.keyframe_times[k]:.6f}"]
+            command += ["-i", self.video_path, "-map", "0:v:0", "-fps_mode", "passthrough",
+                        "-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+            self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.position = keyframe
+        while self.position < frame_index:
+            if not self.read(self._skipped):
+                raise RuntimeError(f"FrameReader: the video ends before frame {frame_index}")
+
+    # Read the next frame into frame, False at the end of the video
+    def read(self, frame):
+        if self._process is None:
+            self.seek(self.position)
+        if self._process.stdout.readinto(memoryview(frame).cast("B")) < frame.nbytes:
+            return False
+        self.position += 1
+        return True
+
+    def close(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+
+'''
+Stream-copy num_frames frames from a keyframe on into a new file, without decoding them.
+seek_time is where a seek lands on the keyframe (keyframe_times of video_probe.probe_video),
+from the real timestamps, so the frame rate does not have to be constant.
+'''
+def copy_frames(video_path, output_path, seek_time, num_frames):
+    command = [
+        ffmpeg.get_ffmpeg_exe(),
+        "-loglevel", "error",
+        "-ss", f"{seek_time:.6f}",
+        "-i", video_path,
+        "-map", "0:v:0",
+        "-frames:v", str(num_frames),
+        "-c", "copy",
+        "-avoid_negative_ts", "make_zero",
+        "-y",
+        output_path
+    ]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -0,0 +1,183 @@
+import os
+import asyncio
+import logging
+from sdk_imports import enable_aiohttp
+enable_aiohttp()
+from azure.storage.blob.aio import BlobServiceClient
+import metrics
+from storage_functions import _form_filename
+from storage_retry import call_with_retries_async, AsyncAdaptiveLimiter
+
+# Blob operations of one batch that run at the same time, at most
+ASYNC_STORAGE_CONCURRENCY = int(os.environ.get("ASYNC_STORAGE_CONCURRENCY", 32))
+# A blob batch request can delete at most 256 blobs
+DELETE_BATCH_SIZE = 256
+# Number of batch requests that are sent at the same time
+DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", 8))
+
+# The concurrency limit the last batch of a process ended with, per pid
+_last_limits = {}
+
+'''
+Async variant of storage_functions for the stages that touch many blobs at once (the concats,
+the cleanup and the rendition uploads). A batch shares one client, so one connection pool,
+and runs its blob operations concurrently on one event loop, bounded by gather_bounded, instead
+of one after the other or with a thread per blob. The sync functions at the bottom run a whole
+batch and are what the functions call; they must not be called from a running event loop.
+Every request of a batch runs under the AIMD limiter of the batch (see batch_limiter), so a
+throttled batch backs off like the sync operations do.
+Blob names and containers are the same as in storage_functions.
+'''
+
+
+def service_client():
+    # the retries of the SDK are off, see call_with_retries_async
+    return BlobServiceClient.from_connection_string(os.environ["AZURE_STORAGE_CONNECTION_STRING"], retry_total=0)
+
+
+'''
+The limiter of the requests of one batch, with at most limit requests at the same time (see
+storage_retry.AsyncAdaptiveLimiter). It starts at the limit the last batch of the process ended
+with, so a batch right after throttling does not start at full concurrency again.
+Must be created and used on the event loop of the batch.
+'''
+def batch_limiter(limit=ASYNC_STORAGE_CONCURRENCY):
+    return AsyncAdaptiveLimiter(initial=_last_limits.get(os.getpid(), limit), maximum=limit)
+
+
+def _remember_limit(limiter):
+    _last_limits[os.getpid()] = limiter.limit
+
+
+'''
+Await the coroutines with at most limit of them running at the same time. Returns their
+results in order, an exception in place of the result of a coroutine that failed.
+'''
+async def gather_bounded(coroutines, limit=ASYNC_STORAGE_CONCURRENCY):
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(bounded(coroutine) for coroutine in coroutines), return_exceptions=True)
+
+
+def _raise_failed(results, action):
+    failed = [result for result in results if isinstance(result, BaseException)]
+    if failed:
+        raise RuntimeError(f"{action}: {len(failed)} of {len(results)} failed, e.g. {failed[0]}") from failed[0]
+    return results
+
+
+async def download_file_internal_async(service, job_id, type, save_path, index=None, rendition=None, limiter=None):
+    filename = _form_filename(job_id, type, index, rendition)
+    blob = service.get_blob_client("internal", filename)
+
+    # a retry starts the file again
+    async def download():
+        with open(save_path, "wb") as file:
+            stream = await blob.download_blob()
+            await stream.readinto(file)
+
+    await call_with_retries_async(download, f"Downloading {filename}", limiter=limiter)
+    metrics.inc("storage_bytes_total", os.path.getsize(save_path), direction="download", type=type)
+
+
+async def upload_file_internal_async(service, job_id, filepath, type, index=None, rendition=None, limiter=None):
+    container_name = 'downloads' if 'output' in type else 'internal'
+    filename = _form_filename(job_id, type, index, rendition)
+    blob = service.get_blob_client(container_name, filename)
+
+    async def upload():
+        with open(filepath, "rb") as data:
+            await blob.upload_blob(data, overwrite=True)
+
+    await call_with_retries_async(upload, f"Uploading {filename}", limiter=limiter)
+    metrics.inc("storage_bytes_total", os.path.getsize(filepath), direction="upload", type=type)
+
+
+'''
+Delete blobs from a container with batch requests of up to 256 blobs. Blobs that are
+already gone are not an error. Returns the number of deleted blobs.
+'''
+async def delete_blobs_async(container_client, names, limiter=None):
+    names = list(names)
+
+    async def delete_batch(batch):
+        async def delete():
+            failed = []
+            responses = await container_client.delete_blobs(*batch, raise_on_any_failure=False)
+            async for name, response in _zip_async(batch, responses):
+                if response.status_code not in (200, 202, 404):
+                    failed.append(name)
+            if failed:
+                raise RuntimeError(f"Deleting {len(failed)} blobs failed, e.g. {failed[0]}")
+            return len(batch)
+        return await call_with_retries_async(delete, f"Deleting a batch of {len(batch)} blobs", limiter=limiter)
+
+    batches = [names[i:i + DELETE_BATCH_SIZE] for i in range(0, len(names), DELETE_BATCH_SIZE)]
+    results = await gather_bounded([delete_batch(batch) for batch in batches], DELETE_WORKERS)
+    return sum(_raise_failed(results, "Deleting blobs"))
+
+
+async def _zip_async(names, responses):
+    names = iter(names)
+    async for response in responses:
+        yield next(names), response
+
+
+'''
+Delete all files of a job, see storage_functions.delete_files_from_job. The containers are
+listed and deleted from at the same time.
+'''
+async def delete_files_from_job_async(job_id, upload_names=()):
+    limiter = batch_limiter(DELETE_WORKERS)
+    async with service_client() as service:
+        async def delete_prefix(container_name):
+            container_client = service.get_container_client(container_name)
+            names = [blob.name async for blob in container_client.list_blobs(name_starts_with=job_id)]
+            return await delete_blobs_async(container_client, names, limiter)
+
+        deletes = [delete_prefix('internal'), delete_prefix('downloads')]
+        upload_names = [name for name in upload_names if name]
+        if upload_names:
+            deletes.append(delete_blobs_async(service.get_container_client('uploads'), upload_names, limiter))
+        return sum(_raise_failed(await asyncio.gather(*deletes, return_exceptions=True), f"Deleting files of {job_id}"))
+
+
+'''
+Download many files of a job at the same time. files holds (type, save_path, index,
+rendition) tuples, like the arguments of storage_functions.download_file_internal. Raises a
+RuntimeError when any of them failed, after all others finished.
+'''
+def download_files_internal(job_id, files, limit=ASYNC_STORAGE_CONCURRENCY):
+    async def run():
+        limiter = batch_limiter(limit)
+        async with service_client() as service:
+            results = await gather_bounded([download_file_internal_async(service, job_id, type, save_path, index, rendition,
+                                                                         limiter)
+                                            for type, save_path, index, rendition in files], limit)
+        _remember_limit(limiter)
+        return results
+
+    _raise_failed(asyncio.run(run()), f"Downloading files of {job_id}")
+    logging.info(f"Downloaded {len(files)} files of {job_id}")
+
+
+'''
+Upload many files of a job at the same time. files holds (filepath, type, index, rendition)
+tuples, like the arguments of storage_functions.upload_file_internal.
+'''
+def upload_files_internal(job_id, files, limit=ASYNC_STORAGE_CONCURRENCY):
+    async def run():
+        limiter = batch_limiter(limit)
+        async with service_client() as service:
+            results = await gather_bounded([upload_file_internal_async(service, job_id, filepath, type, index, rendition,
+                                                                       limiter)
+                                            for filepath, type, index, rendition in files], limit)
+        _remember_limit(limiter)
+        return results
+
+    _raise_failed(asyncio.run(run()), f"Uploading files of {job_id}")
+    logging.info(f"Uploaded {len(files)} files of {job_id}")
@@ -1,9 +1,16 @@
 import os
 import io
 import logging
-import time
 import uuid
-from azure.storage.blob import BlobClient, BlobServiceClient
+import asyncio
+import base64
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from azure.storage.blob import BlobClient, BlobBlock, generate_blob_sas, BlobSasPermissions
+import metrics
+from storage_retry import call_with_retries
 
 '''
 Valid types are:
@@ -14,22 +21,34 @@ Valid types are:
 * output_video
 * output_thumbnail
 * audio
+* metadata: probed stream metadata of the input video, json
+* placement: compiled placement of the watermark, npz (see placement.py)
 Note that for video_chunk_orig, video_chunk_mod and thumnail, and index is required
+For video_chunk_mod and output_video a rendition name can be given when the job renders
+more than one size, e.g. <job_id>_video_chunk_mod_720p_3.mp4
 '''
-def _form_filename(job_id, type, index=None):
+def _form_filename(job_id, type, index=None, rendition=None):
     if job_id is None:
         raise RuntimeError("_form_filename: no job_id")
-    if type not in ['watermark', 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'output_video', 'output_thumbnail', 'audio']:
+    if type not in ['watermark', 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'output_video', 'output_thumbnail', 'audio', 'metadata', 'placement']:
         raise RuntimeError("_form_filename: invalid type")
     if index is None and type in ['video_chunk_orig', 'video_chunk_mod', 'thumbnail']:
         raise RuntimeError("_form_filename: no index")
+    if rendition is not None and type not in ['video_chunk_mod', 'output_video']:
+        raise RuntimeError("_form_filename: rendition is only valid for video_chunk_mod and output_video")
     
     filename = f"{str(job_id)}_{type}"
+    if rendition is not None:
+        filename += f"_{str(rendition)}"
     if index is not None:
         filename += f"_{str(index)}"
 
     if type in ['watermark', 'thumbnail', 'output_thumbnail']:
         filename += '.jpg'
+    elif type == 'metadata':
+        filename += '.json'
+    elif type == 'placement':
+        filename += '.npz'
     else:
         filename += '.mp4'
 
@@ -37,6 +56,41 @@ def _form_filename(job_id, type, index=None):
     return filename
 
 
+'''
+URL of a blob for the client, with a SAS token. AZURE_STORAGE_BLOB_ENDPOINT replaces the
+public endpoint of the account, e.g. http://127.0.0.1:10000/devstoreaccount1 for Azurite.
+'''
+def blob_url(account_name, container_name, filename, sas_token):
+    endpoint = os.environ.get("AZURE_STORAGE_BLOB_ENDPOINT") or f"https://{account_name}.blob.core.windows.net"
+    return f"{endpoint.rstrip('/')}/{container_name}/{filename}?{sas_token}"
+
+
+'''
+Whether a url given by a client points to a blob of our account: https (or the scheme of
+AZURE_STORAGE_BLOB_ENDPOINT) to the blob endpoint of AZURE_STORAGE_ACCOUNT. Urls that are
+opened by ffmpeg or the SDK must pass this, anything else could read local files or reach
+internal services.
+'''
+def is_account_blob_url(url):
+    account_name = os.environ.get("AZURE_STORAGE_ACCOUNT")
+    endpoint = os.environ.get("AZURE_STORAGE_BLOB_ENDPOINT") or f"https://{account_name}.blob.core.windows.net"
+    try:
+        expected, actual = urlsplit(endpoint.rstrip('/') + '/'), urlsplit(str(url))
+    except ValueError:
+        return False
+    return (actual.scheme == expected.scheme and actual.netloc.lower() == expected.netloc.lower()
+            and actual.path.startswith(expected.path) and len(actual.path) > len(expected.path))
+
+
+'''
+Client of a blob in our account. The retries of the SDK are off, call_with_retries retries
+instead so it can back off on throttling (see storage_retry.py).
+'''
+def _blob_client(container_name, filename):
+    conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
+    return BlobClient.from_connection_string(conn_str, container_name, filename, retry_total=0)
+
+
 def _unique_filepath_tmp(extension):
     filename = str(uuid.uuid4()) + "." + extension
     path = os.path.join("/tmp", filename)
@@ -50,11 +104,10 @@ def get_user_video(sas_url, save_path):
     logging.info("Executing get_user_video")
 
     try:
-        blob_client = BlobClient.from_blob_url(sas_url)
-        stream = blob_client.download_blob()
-        data = stream.readall()
+        blob_client = BlobClient.from_blob_url(sas_url, retry_total=0)
+        data = call_with_retries(lambda: blob_client.download_blob().readall(), "Downloading the user video")
     except Exception as e:
-        raise RuntimeError(f"get_user_video failed. Invalid SAS URL or download error: {e}") 
+        raise RuntimeError(f"get_user_video failed. Invalid SAS URL or download error: {e}") from e
     
     try:
         # Write the downloaded bytes to a file
@@ -69,17 +122,15 @@ def get_user_video(sas_url, save_path):
 
 '''
 The user provides a SAS or uploads an image to a SAS. This function moves the watermark image
-to the correct container. 
+to the correct container. Returns the bytes of the image.
 '''
 def move_watermark(job_id, sas_url):
     logging.info("Executing move_watermark")
-    conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
     container_name = 'internal'
 
     try:
-        blob_client = BlobClient.from_blob_url(sas_url)
-        stream = blob_client.download_blob()
-        data = stream.readall() 
+        blob_client = BlobClient.from_blob_url(sas_url, retry_total=0)
+        data = call_with_retries(lambda: blob_client.download_blob().readall(), "Downloading the watermark")
     except Exception as e:
         raise RuntimeError("Moving watermark failed. Invalid SAS") from e
 
@@ -87,11 +138,12 @@ def move_watermark(job_id, sas_url):
     name = _form_filename(job_id, 'watermark')
 
     try:
-        new_blob = BlobClient.from_connection_string(conn_str, container_name, name)
-        new_blob.upload_blob(io.BytesIO(data), overwrite=True)
+        new_blob = _blob_client(container_name, name)
+        call_with_retries(lambda: new_blob.upload_blob(io.BytesIO(data), overwrite=True), f"Uploading {name}")
         logging.info(f"Uploaded {name} to container '{container_name}'")
     except Exception as e:
         raise RuntimeError("Moving watermak failed. upload failed.") from e
+    return data
 
 '''
 Use this function to upload a file to blob storage internally. So e.g. if a worker is done
@@ -99,14 +151,15 @@ with a chunk of the watermarking, that chunk can be uploaded to blob storage wit
 Params: 
 * job_id
 * filepath: Where the file is locally
-* type: can be 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'output_video', 'audio' or 'output_thumbnail'
+* type: can be 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'output_video', 'audio', 'metadata', 'placement' or 'output_thumbnail'
 * index: in case of video_chunk_orig, video_chunk_mod and thumbnail, an index is needed
   because we have multiple video chunks and multiple thumbnail parts.
+* rendition: name of the rendition for video_chunk_mod and output_video, None for the original size
 '''
-def upload_file_internal(job_id, filepath, type, index=None):
+def upload_file_internal(job_id, filepath, type, index=None, rendition=None):
     logging.info("Executing upload_file_internal")
 
-    if type not in ['video_chunk_mod', 'video_chunk_orig', 'thumbnail', 'output_video', 'output_thumbnail', 'audio']:
+    if type not in ['video_chunk_mod', 'video_chunk_orig', 'thumbnail', 'output_video', 'output_thumbnail', 'audio', 'metadata', 'placement']:
         raise RuntimeError("upload_file_internal: invalid type parameter")
     if index is None and type in ['video_chunk_orig', 'video_chunk_mod', 'thumbnail']:
         raise RuntimeError("upload_file_internal: missing index parameter")
@@ -116,25 +169,84 @@ def upload_file_internal(job_id, filepath, type, index=None):
     else:
         container_name = "internal"
     
-    filename = _form_filename(job_id, type, index)
-
-    attempt = 0
-    max_attempts = 2
-    while attempt < max_attempts:
-        try:
-            conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
-            blob = BlobClient.from_connection_string(conn_str, container_name, filename)
-
-            with open(filepath, "rb") as data:
-                blob.upload_blob(data, overwrite=True)
-            logging.info(f"Uploaded {filename} succesfully (internal)!")
-            return
-        except Exception as e:
-            attempt += 1
-            if attempt >= max_attempts:
-                raise RuntimeError(f"Uploading {filename} (internal) failed.") from e
-            time.sleep(0.1)
-            logging.error("Upload file internal failed. Trying again.")
+    filename = _form_filename(job_id, type, index, rendition)
+
+    blob = _blob_client(container_name, filename)
+
+    def upload():
+        with open(filepath, "rb") as data:
+            blob.upload_blob(data, overwrite=True)
+
+    try:
+        call_with_retries(upload, f"Uploading {filename}")
+    except Exception as e:
+        raise RuntimeError(f"Uploading {filename} (internal) failed.") from e
+    logging.info(f"Uploaded {filename} succesfully (internal)!")
+    metrics.inc("storage_bytes_total", os.path.getsize(filepath), direction="upload", type=type)
+
+
+'''
+Upload what is read from a stream (e.g. the stdout of ffmpeg) as a blob, without a local
+file. The stream is read in blocks of block_size bytes, every block is staged while the next
+one is read, with at most concurrency blocks in flight, and the block list is committed when
+the stream ends. before_commit is called before that and can raise to abort the upload, e.g.
+when the writer of the stream failed. Staged blocks that are never committed are discarded by
+the service, so a failed upload leaves no partial blob behind. Returns the number of bytes.
+'''
+def upload_stream_internal(job_id, stream, type, index=None, rendition=None, block_size=4 * 1024 * 1024, concurrency=4,
+                           before_commit=None):
+    container_name = 'downloads' if 'output' in type else 'internal'
+    filename = _form_filename(job_id, type, index, rendition)
+    blob = _blob_client(container_name, filename)
+
+    block_ids = []
+    futures = []
+    total = 0
+    slots = threading.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"stage-{filename}") as pool:
+        while not any(future.done() and future.exception() for future in futures):
+            data = stream.read(block_size)
+            if not data:
+                break
+            # block ids of a blob must all have the same length
+            block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+            block_ids.append(block_id)
+            total += len(data)
+            slots.acquire()
+            future = pool.submit(call_with_retries, lambda block_id=block_id, data=data: blob.stage_block(block_id, data),
+                                 f"Staging block {len(block_ids)} of {filename}")
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+    try:
+        for future in futures:
+            future.result()
+        if before_commit is not None:
+            before_commit()
+        call_with_retries(lambda: blob.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids]),
+                          f"Committing {filename}")
+    except Exception as e:
+        raise RuntimeError(f"Uploading {filename} (stream) failed.") from e
+    logging.info(f"Uploaded {filename} from a stream, {len(block_ids)} blocks")
+    metrics.inc("storage_bytes_total", total, direction="upload", type=type)
+    return total
+
+
+'''
+URL with a short-lived read SAS of a blob in 'internal', so ffmpeg can read it over HTTP
+without downloading it first.
+'''
+def internal_read_url(job_id, type, index=None, rendition=None, expiry_minutes=60):
+    filename = _form_filename(job_id, type, index, rendition)
+    account_name = os.environ.get("AZURE_STORAGE_ACCOUNT")
+    sas_token = generate_blob_sas(
+        account_name=account_name,
+        container_name="internal",
+        blob_name=filename,
+        account_key=os.environ.get("AZURE_STORAGE_KEY"),
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.utcnow() + timedelta(minutes=expiry_minutes),
+    )
+    return blob_url(account_name, "internal", filename, sas_token)
     
 
 
@@ -143,50 +255,43 @@ Use this function to download a file from blob storage internally.
 E.g. when a worker needs to read a previously uploaded chunk from blob storage.
 Params: 
 * job_id
-* type: can be 'watermark', 'video_chunk_orig', 'video_chunk_mod', 'audio' or 'thumbnail'
+* type: can be 'watermark', 'video_chunk_orig', 'video_chunk_mod', 'audio', 'metadata', 'placement' or 'thumbnail'
 * index: in case of video_chunk_orig, video_chunk_mod and thumb, an index is needed
   because we have multiple video chunks and multiple thumbnail parts.
 * save_path: Where to save the file locally
+* rendition: name of the rendition for video_chunk_mod, None for the original size
 '''
-def download_file_internal(job_id, type, save_path, index=None):
+def download_file_internal(job_id, type, save_path, index=None, rendition=None):
     logging.info("Executing download_file_internal")
 
-    if type not in ['watermark', 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'audio']:
+    if type not in ['watermark', 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'audio', 'metadata', 'placement']:
         raise RuntimeError("upload_file_internal: invalid type parameter")
     if index is None and type in ['video_chunk_orig', 'video_chunk_mod', 'thumbnail']:
         raise RuntimeError("upload_file_internal: missing index parameter")
 
     container_name = "internal"
-    filename = _form_filename(job_id, type, index)
+    filename = _form_filename(job_id, type, index, rendition)
 
-    attempt = 0
-    max_attempts = 2
-    while attempt < max_attempts:
-        try:
-            # Initialize blob client
-            conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
-            blob = BlobClient.from_connection_string(conn_str, container_name, filename)
+    blob = _blob_client(container_name, filename)
 
-            # Download and save the blob to a file
-            with open(save_path, "wb") as file:
-                stream = blob.download_blob()
-                file.write(stream.readall())
+    # Download and save the blob to a file, a retry starts the file again
+    def download():
+        with open(save_path, "wb") as file:
+            blob.download_blob().readinto(file)
 
-            logging.info(f"Downloaded {filename} to {save_path} successfully!")
-            return
-        except Exception as e:
-            attempt += 1
-            if attempt >= max_attempts:
-                raise RuntimeError(f"Downloading {filename} (internal) failed.") from e
-            time.sleep(0.1)
-            logging.error("Download file internal failed. Trying again.")
+    try:
+        call_with_retries(download, f"Downloading {filename}")
+    except Exception as e:
+        raise RuntimeError(f"Downloading {filename} (internal) failed.") from e
+    logging.info(f"Downloaded {filename} to {save_path} successfully!")
+    metrics.inc("storage_bytes_total", os.path.getsize(save_path), direction="download", type=type)
 
 
 '''
 Delete a file from blob storage.  
 '''
-def delete_file(job_id, type=None, index=None):
-    if type not in ['watermark', 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'output_video', 'output_thumbnail', 'audio']:
+def delete_file(job_id, type=None, index=None, rendition=None):
+    if type not in ['watermark', 'video_chunk_orig', 'video_chunk_mod', 'thumbnail', 'output_video', 'output_thumbnail', 'audio', 'metadata', 'placement']:
         raise RuntimeError("delete file: invalid type")
     if index is None and type in ['video_chunk_orig', 'video_chunk_mod', 'thumbnail']:
         raise RuntimeError("delete file: no index")
@@ -196,33 +301,45 @@ def delete_file(job_id, type=None, index=None):
     else:
         container_name = 'internal'
 
-    filename = _form_filename(job_id, type, index)
+    filename = _form_filename(job_id, type, index, rendition)
 
     try:
-        conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
-        blob = BlobClient.from_connection_string(conn_str, container_name, filename)
-        blob.delete_blob()
+        blob = _blob_client(container_name, filename)
+        call_with_retries(blob.delete_blob, f"Deleting {filename}")
         logging.info(f"Deleted {filename} successfully!")
     except Exception as e:
         raise RuntimeError(f"Deteling {filename} failed.") from e
 
 
 '''
-Delete all files in the container 'internal' with a certain job_id
+Name of the blob behind a SAS url if it is in our 'uploads' container, otherwise None.
+Used to remember which uploads belong to a job, so the cleanup can remove them.
 '''
-def delete_files_from_job(job_id):
+def uploaded_blob_name(sas_url):
     try:
-        conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
-        blob_client = BlobServiceClient.from_connection_string(conn_str)
-        container_client = blob_client.get_container_client('internal')
+        blob_client = BlobClient.from_blob_url(sas_url)
+    except Exception:
+        return None
+    if blob_client.container_name != 'uploads':
+        return None
+    if blob_client.account_name != os.environ.get("AZURE_STORAGE_ACCOUNT", blob_client.account_name):
+        return None
+    return blob_client.blob_name
 
-        blobs_to_delete = container_client.list_blobs(name_starts_with=job_id)
 
-        deleted_count = 0
-        for blob in blobs_to_delete:
-            container_client.delete_blob(blob.name)
-            deleted_count += 1
+'''
+Delete all files of a job:
+* everything in 'internal' and 'downloads' that starts with the job_id
+* the given upload_names from 'uploads' (the video and watermark the user uploaded)
+The blobs are deleted with concurrent batch requests, see storage_async.
+'''
+def delete_files_from_job(job_id, upload_names=()):
+    from storage_async import delete_files_from_job_async  # storage_async imports this module
+    if not job_id:
+        raise RuntimeError("delete_files_from_job: no job_id")
+
+    try:
+        deleted_count = asyncio.run(delete_files_from_job_async(job_id, upload_names))
         logging.info(f"Deleted {deleted_count} for {job_id} successfully!")
-    
     except Exception as e:
         raise RuntimeError(f"Deteling files for job {job_id} failed.") from e
@@ -0,0 +1,211 @@
+import os
+import asyncio
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+import metrics
+
+# Attempts of one storage operation before it fails
+STORAGE_MAX_ATTEMPTS = int(os.environ.get("STORAGE_MAX_ATTEMPTS", 6))
+# Backoff: a random delay up to BASE * 2^attempt seconds, at most MAX seconds (full jitter)
+STORAGE_BACKOFF_BASE = float(os.environ.get("STORAGE_BACKOFF_BASE", 0.2))
+STORAGE_BACKOFF_MAX = float(os.environ.get("STORAGE_BACKOFF_MAX", 30))
+# Bounds of the number of storage operations a process runs at the same time
+STORAGE_MAX_CONCURRENCY = int(os.environ.get("STORAGE_MAX_CONCURRENCY", 16))
+STORAGE_MIN_CONCURRENCY = int(os.environ.get("STORAGE_MIN_CONCURRENCY", 1))
+
+# Status codes of requests that can succeed when they are sent again
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+# Status codes with which the account tells us to slow down
+THROTTLED_STATUS = {429, 503}
+
+
+'''
+Whether an error of a storage operation is worth retrying: timeouts, throttling, server
+errors and broken connections are, a missing blob, a bad request or a failed authentication
+are not. Follows the causes, so a RuntimeError raised from a storage error is classified
+like the storage error.
+'''
+def is_transient(error):
+    while error is not None:
+        if isinstance(error, HttpResponseError) and error.status_code is not None:
+            return error.status_code in TRANSIENT_STATUS
+        if isinstance(error, (ServiceRequestError, ServiceResponseError, ConnectionError, TimeoutError)):
+            return True
+        error = error.__cause__
+    return False
+
+
+def is_throttled(error):
+    return isinstance(error, HttpResponseError) and error.status_code in THROTTLED_STATUS
+
+
+'''
+Seconds the service asked us to wait in the Retry-After (seconds or an HTTP date) or
+x-ms-retry-after-ms header of the response, None when it did not.
+'''
+def retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("x-ms-retry-after-ms"):
+            return float(headers["x-ms-retry-after-ms"]) / 1000
+        value = headers.get("Retry-After")
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    delay = random.uniform(0, min(STORAGE_BACKOFF_MAX, STORAGE_BACKOFF_BASE * 2 ** attempt))
+    requested = retry_after(error) if error is not None else None
+    if requested is not None:
+        delay = max(delay, min(requested, STORAGE_BACKOFF_MAX))
+    return delay
+
+
+'''
+Limits the storage operations of a process that run at the same time, with additive increase
+and multiplicative decrease (AIMD): every success raises the limit by 1/limit, so by about
+one per round of requests, and throttling halves it. Many processes that back off like this
+settle near the throughput limit of the account instead of all retrying at full
+parallelism. After a decrease, throttled responses of requests that were already in flight
+do not decrease it again until one round of requests has finished.
+'''
+class AdaptiveLimiter:
+    layer = "sync"
+
+    def __init__(self, initial=STORAGE_MAX_CONCURRENCY, minimum=STORAGE_MIN_CONCURRENCY, maximum=STORAGE_MAX_CONCURRENCY):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+        self._completed = 0
+        self._decreased_at = -1
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            self._adjust(throttled)
+            self._condition.notify_all()
+
+    # the AIMD step for a finished operation, with the condition held
+    def _adjust(self, throttled):
+        self._completed += 1
+        if throttled:
+            if self._completed - self._decreased_at > self.limit:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._decreased_at = self._completed
+                logging.warning(f"Storage throttled, concurrency limit is now {int(self.limit)}")
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        metrics.set_gauge("storage_concurrency_limit", int(self.limit), pid=str(os.getpid()), layer=self.layer)
+
+
+'''
+AdaptiveLimiter for the coroutines of one event loop (see storage_async.py): acquire and
+release are awaited and wait on the loop instead of blocking its thread.
+'''
+class AsyncAdaptiveLimiter(AdaptiveLimiter):
+    layer = "async"
+
+    def __init__(self, initial=STORAGE_MAX_CONCURRENCY, minimum=STORAGE_MIN_CONCURRENCY, maximum=STORAGE_MAX_CONCURRENCY):
+        super().__init__(initial, minimum, maximum)
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, throttled=False):
+        async with self._condition:
+            self.in_flight -= 1
+            self._adjust(throttled)
+            self._condition.notify_all()
+
+
+_limiter = None
+_limiter_pid = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter, _limiter_pid
+    with _limiter_lock:
+        # a forked process (the split) gets its own limiter, the one of the parent may be held
+        if _limiter is None or _limiter_pid != os.getpid():
+            _limiter = AdaptiveLimiter()
+            _limiter_pid = os.getpid()
+        return _limiter
+
+
+'''
+Run a storage operation under the concurrency limit of the process, and retry it with
+backoff when it fails with a transient error. Permanent errors and the last failed attempt
+are raised. The waits between attempts do not hold a slot of the limit.
+'''
+def call_with_retries(operation, description, max_attempts=None):
+    max_attempts = max_attempts or STORAGE_MAX_ATTEMPTS
+    limiter = get_limiter()
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        try:
+            result = operation()
+        except Exception as e:
+            throttled = is_throttled(e)
+            limiter.release(throttled=throttled)
+            if not is_transient(e) or attempt + 1 >= max_attempts:
+                raise
+            delay = backoff_delay(attempt, e)
+            metrics.inc("storage_retries_total", layer="app", reason="throttled" if throttled else "transient")
+            logging.warning(f"{description} failed (attempt {attempt + 1}/{max_attempts}), retrying in {delay:.2f}s: {e}")
+            time.sleep(delay)
+            continue
+        limiter.release()
+        return result
+
+
+'''
+call_with_retries for coroutines (see storage_async.py), under limiter, an
+AsyncAdaptiveLimiter of the running event loop. Without one only the caller bounds the
+concurrency.
+'''
+async def call_with_retries_async(operation, description, max_attempts=None, limiter=None):
+    max_attempts = max_attempts or STORAGE_MAX_ATTEMPTS
+    for attempt in range(max_attempts):
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            result = await operation()
+        except Exception as e:
+            throttled = is_throttled(e)
+            if limiter is not None:
+                await limiter.release(throttled=throttled)
+            if not is_transient(e) or attempt + 1 >= max_attempts:
+                raise
+            delay = backoff_delay(attempt, e)
+            metrics.inc("storage_retries_total", layer="app", reason="throttled" if throttled else "transient")
+            logging.warning(f"{description} failed (attempt {attempt + 1}/{max_attempts}), retrying in {delay:.2f}s: {e}")
+            await asyncio.sleep(delay)
+            continue
+        if limiter is not None:
+            await limiter.release()
+        return result
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the function app are imported by name, like the function host does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import cv2
+import numpy as np
+import pytest
+import imageio_ffmpeg as ffmpeg
+from watermarking import process_video_chunk
+from verify_watermark import verify_file
+
+
+'''
+A test pattern video without watermark, the same video with a text watermark at opacity 0.5
+and with the invisible watermark of job "job-a", and the watermark image.
+'''
+@pytest.fixture(scope="module")
+def videos(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("verify")
+    clean_path = str(directory / "clean.mp4")
+    subprocess.run([ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-f", "lavfi", "-i", "testsrc2=s=640x360:rate=25",
+                    "-t", "4", "-g", "25", "-c:v", "libx264", "-pix_fmt", "yuv420p", clean_path], check=True)
+    watermark_path = str(directory / "watermark.png")
+    watermark_image = np.zeros((120, 400, 4), dtype=np.uint8)
+    cv2.putText(watermark_image, "ACME", (10, 100), cv2.FONT_HERSHEY_DUPLEX, 3.5, (255, 255, 255, 255), 8)
+    cv2.imwrite(watermark_path, watermark_image)
+
+    visible_path = process_video_chunk(None, clean_path, watermark_path, "test", alpha=0.5)[None]
+    invisible_path = process_video_chunk("job-a", clean_path, None, "test", mode="invisible")[None]
+    yield {"clean": clean_path, "visible": visible_path, "invisible": invisible_path, "watermark": watermark_path}
+    for path in (visible_path, invisible_path):
+        os.remove(path)
+
+
+def test_visible_watermark_is_detected(videos):
+    result = verify_file(videos["visible"], watermark_path=videos["watermark"])
+    assert "error" not in result
+    assert result["detected"]
+
+
+def test_video_without_visible_watermark_is_not_detected(videos):
+    result = verify_file(videos["clean"], watermark_path=videos["watermark"])
+    assert "error" not in result
+    assert not result["detected"]
+
+
+def test_invisible_watermark_is_detected_for_its_job_only(videos):
+    assert verify_file(videos["invisible"], job_id="job-a")["detected"]
+    assert not verify_file(videos["invisible"], job_id="job-b")["detected"]
+    assert not verify_file(videos["clean"], job_id="job-a")["detected"]
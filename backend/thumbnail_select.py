@@ -0,0 +1,84 @@
+import os
+import cv2
+import numpy as np
+
+# Every SCENE_SAMPLE_STEP-th frame of a chunk is a thumbnail candidate
+SCENE_SAMPLE_STEP = int(os.environ.get("SCENE_SAMPLE_STEP", 5))
+# Frames with a mean luma below this level count as black
+SCENE_BLACK_LEVEL = float(os.environ.get("SCENE_BLACK_LEVEL", 16))
+# Signatures are luma histograms of a downscaled frame
+SIGNATURE_SIZE = (64, 36)
+HISTOGRAM_BINS = 32
+
+
+'''
+Cheap signature of a frame: the normalized luma histogram of a 64x36 copy and its mean luma.
+'''
+def frame_signature(frame):
+    small = cv2.resize(frame, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+    luma = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    histogram = cv2.calcHist([luma], [0], None, [HISTOGRAM_BINS], [0, 256]).ravel()
+    return histogram / histogram.sum(), float(luma.mean())
+
+
+'''
+Entropy of a normalized histogram. Black frames, flat frames and frames in the middle of a
+fade have few distinct luma levels and a low entropy.
+'''
+def histogram_entropy(histogram):
+    nonzero = histogram[histogram > 0]
+    return float(-(nonzero * np.log2(nonzero)).sum())
+
+
+'''
+Keeps the best thumbnail candidate of a chunk while its frames are decoded for another reason
+(the split). Every step-th frame is a candidate, the best one is the candidate that is not
+black with the highest histogram entropy. Only the best frame so far is copied.
+'''
+class ChunkSampler:
+    def __init__(self, step=SCENE_SAMPLE_STEP):
+        self.step = max(1, step)
+        self.frames_seen = 0
+        self.best_frame = None
+        self._best_score = None
+
+    def add(self, frame):
+        if self.frames_seen % self.step == 0:
+            histogram, mean_luma = frame_signature(frame)
+            score = (mean_luma >= SCENE_BLACK_LEVEL, histogram_entropy(histogram))
+            if self._best_score is None or score > self._best_score:
+                if self.best_frame is None:
+                    self.best_frame = frame.copy()
+                else:
+                    np.copyto(self.best_frame, frame)
+                self._best_score = score
+        self.frames_seen += 1
+
+
+'''
+Pick the count most distinct images (e.g. the thumbnails of all chunks) for the thumbnail.
+Black images are only used when there are not enough others. The selection is greedy: it
+starts with the image with the highest entropy and keeps adding the image that is furthest
+(L1 distance of the histograms) from everything selected so far.
+Returns the indices of the selected images in their original order.
+'''
+def select_thumbnails(images, count):
+    signatures = [frame_signature(image) for image in images]
+    candidates = [i for i, (_, mean_luma) in enumerate(signatures) if mean_luma >= SCENE_BLACK_LEVEL]
+    if len(candidates) < count:
+        black = [i for i in range(len(images)) if i not in candidates]
+        candidates += black[:count - len(candidates)]
+    if len(candidates) <= count:
+        return sorted(candidates)
+
+    histograms = np.array([signatures[i][0] for i in candidates])
+    first = max(range(len(candidates)), key=lambda i: histogram_entropy(histograms[i]))
+    selected = [first]
+    distance = np.abs(histograms - histograms[first]).sum(axis=1)
+    while len(selected) < count:
+        distance[selected] = -1
+        furthest = int(np.argmax(distance))
+        selected.append(furthest)
+        distance = np.minimum(distance, np.abs(histograms - histograms[furthest]).sum(axis=1))
+
+    return sorted(candidates[i] for i in selected)
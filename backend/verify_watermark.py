@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import math
+import argparse
+import subprocess
+from multiprocessing import Pool
+import cv2
+import numpy as np
+import imageio_ffmpeg as ffmpeg
+import invisible_watermark
+from invisible_watermark import BLOCK, COEFFICIENTS, PAYLOAD_BITS
+from video_probe import probe_video
+from job_options import parse_placement
+from placement import compile_placement
+
+# Keyframes that are decoded per file
+VERIFY_SAMPLE_FRAMES = int(os.environ.get("VERIFY_SAMPLE_FRAMES", 16))
+# Score from which a file counts as watermarked with the invisible watermark. The score is a
+# z-score of independent blocks, so a file without the watermark only reaches 5 with a
+# probability of about 3e-7
+VERIFY_THRESHOLD = float(os.environ.get("VERIFY_THRESHOLD", 5.0))
+# Score from which a file counts as watermarked with the visible watermark. Measured on 7 kinds of
+# content (test patterns, noise, fractal, cellular automata) with a logo and a text watermark at
+# 5 placements: files without it scored at most 2.8, files with it at opacity 0.25 or more at
+# least 10.3, also after a CRF 28 re-encode or scaled to 240p
+VERIFY_VISIBLE_THRESHOLD = float(os.environ.get("VERIFY_VISIBLE_THRESHOLD", 6.0))
+# Width the frames are scaled to for the visible check, the watermark is large and smooth
+VISIBLE_MATCH_WIDTH = 480
+# Sigma in pixels (at VISIBLE_MATCH_WIDTH) of the blur that is subtracted before the match, so the
+# edges of the watermark are matched and not the brightness of the content
+VISIBLE_HIGH_PASS_SIGMA = 3
+
+'''
+Check whether video files carry our watermark, e.g. files found outside of the downloads.
+Only a few keyframes per file are decoded (VERIFY_SAMPLE_FRAMES, spread evenly over the video,
+found with probe_video without decoding). The keyframes are averaged: the watermark is the
+same in every frame and adds up, the content does not.
+* invisible: the payload of a job id (see invisible_watermark) is correlated with the block
+  DCT of the luma. Renditions are scaled back to the size of the original video first,
+  because the layout of the payload depends on it.
+* visible: the edges of the watermark image are matched against the edges of the frame at
+  every position, and the match where the placement of the job puts it is compared to the
+  matches at the positions that don't overlap it (the sidelobes). Moving placements (a
+  motion path) can't be checked this way.
+Both give a score in standard deviations above what a file without the watermark gives. The
+invisible score is a z-score of independent blocks. Neighbouring matches of the visible check
+are correlated, so its threshold (VERIFY_VISIBLE_THRESHOLD) is measured instead. Many files
+are checked in parallel by verify_files.
+Usage:
+    python verify_watermark.py FILE... (--job-id JOB_ID [--size WxH] | --watermark IMAGE [--placement JSON])
+        [--frames 16] [--workers N] [--threshold SCORE] [--json]
+'''
+
+
+'''
+The luma of up to num_frames keyframes spread over the video, as a (frames, height, width)
+uint8 array. Every keyframe is read by its own ffmpeg that seeks to it by its timestamp
+(keyframe_times of probe_video, so also right for a variable frame rate or a video that does
+not start at 0) and decodes only it.
+'''
+def sample_keyframes(video_path, num_frames=VERIFY_SAMPLE_FRAMES):
+    meta = probe_video(video_path)
+    keyframes = meta["keyframes"]
+    step = len(keyframes) / max(1, min(num_frames, len(keyframes)))
+    selected = sorted({int(i * step) for i in range(min(num_frames, len(keyframes)))})
+
+    width, height = meta["width"], meta["height"]
+    frames = []
+    for k in selected:
+        command = [
+            ffmpeg.get_ffmpeg_exe(),
+            "-loglevel", "error",
+            "-skip_frame", "nokey",
+            # lands on the keyframe itself, an accurate seek would drop it
+            "-noaccurate_seek", "-ss", f"{meta['keyframe_times'][k]:.6f}",
+            "-i", video_path,
+            "-map", "0:v:0",
+            "-frames:v", "1",
+            "-f", "rawvideo",
+            "-pix_fmt", "gray",
+            "-"
+        ]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if len(result.stdout) >= width * height:
+            frames.append(np.frombuffer(result.stdout[:width * height], dtype=np.uint8).reshape(height, width))
+    if not frames:
+        raise RuntimeError(f"no keyframes could be decoded from {video_path}")
+    return np.stack(frames)
+
+
+def _confidence(score):
+    # probability that a file without the watermark scores lower
+    return 0.5 * (1 + math.erf(score / math.sqrt(2)))
+
+
+'''
+Correlate the keyframes with the payload of job_id. size is the (width, height) of the
+original video, None for the size of the frames. Returns the z-score of the correlation and
+the fraction of the payload bits that are read back correctly (about half without watermark).
+'''
+def detect_invisible(frames, job_id, size=None):
+    height, width = frames.shape[1:]
+    if size is not None and tuple(size) != (width, height):
+        width, height = size
+        frames = np.stack([cv2.resize(frame, (width, height), interpolation=cv2.INTER_CUBIC) for frame in frames])
+
+    bit_of_block, signs = invisible_watermark.embedding_layout(job_id, height, width)
+    blocks_y, blocks_x = bit_of_block.shape
+    # the averaged frames, the DCT is linear
+    luma = frames[:, :blocks_y * BLOCK, :blocks_x * BLOCK].mean(axis=0, dtype=np.float32)
+    rows, columns = zip(*COEFFICIENTS)
+    correlation = (invisible_watermark.block_dct(luma)[..., rows, columns] * signs).sum(axis=-1)
+
+    symbols = invisible_watermark.payload_bits(job_id).astype(np.int8) * 2 - 1
+    aligned = (correlation * symbols[bit_of_block]).ravel()
+    score = aligned.mean() / (aligned.std(ddof=1) / math.sqrt(aligned.size) + 1e-12)
+
+    per_bit = np.bincount(bit_of_block.ravel(), weights=correlation.ravel(), minlength=PAYLOAD_BITS)
+    bits_matched = float(((per_bit > 0) == (symbols > 0)).mean())
+    return float(score), bits_matched
+
+
+'''
+Match the watermark image against the averaged keyframes. spec is the placement of the job
+(see job_options.parse_placement), None for the centered default; a tiled placement is
+checked at its first cell. Both are high-passed first: a plain match is dominated by the
+brightness of the content around the watermark. Returns the peak-to-sidelobe ratio: the match
+at the placement minus the mean of the sidelobes, in standard deviations of the sidelobes.
+The sidelobes are all positions except those where the watermark still matches itself (its
+main lobe) around the placement and every other cell of a tiled placement.
+'''
+def detect_visible(frames, watermark_path, spec=None):
+    height, width = frames.shape[1:]
+    spec = spec or parse_placement({})
+    if spec["path"] is not None:
+        raise ValueError("moving placements can't be verified")
+    watermark_image = cv2.imread(watermark_path, cv2.IMREAD_UNCHANGED)
+    if watermark_image is None:
+        raise ValueError(f"can't load watermark image {watermark_path}")
+    table = compile_placement(watermark_image, spec, width, height, 1.0)
+    cells = table["tiles"] + table["offsets"][0]
+    template = cv2.cvtColor(table["sprite_rgb"], cv2.COLOR_BGR2GRAY).astype(np.float32) * (table["sprite_alpha"] / 255)
+
+    scale = min(1.0, VISIBLE_MATCH_WIDTH / width)
+    average = frames.mean(axis=0, dtype=np.float32)
+    average = cv2.resize(average, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    template = cv2.resize(template.astype(np.float32), (max(1, round(template.shape[1] * scale)), max(1, round(template.shape[0] * scale))),
+                          interpolation=cv2.INTER_AREA)
+    if template.shape[0] >= average.shape[0] or template.shape[1] >= average.shape[1]:
+        raise ValueError("the watermark is as large as the frame")
+
+    average, template = _high_pass(average), _high_pass(template)
+    matches = cv2.matchTemplate(average, template, cv2.TM_CCOEFF_NORMED)
+    lobe_height, lobe_width = _main_lobe(template)
+    sidelobes = np.ones(matches.shape, dtype=bool)
+    positions = [(min(max(round(y * scale), 0), matches.shape[0] - 1), min(max(round(x * scale), 0), matches.shape[1] - 1))
+                 for x, y in cells]
+    for y, x in positions:
+        sidelobes[max(y - lobe_height, 0):y + lobe_height + 1, max(x - lobe_width, 0):x + lobe_width + 1] = False
+    if sidelobes.sum() < 100:
+        raise ValueError("the watermark leaves too little of the frame to compare it with")
+    reference = matches[sidelobes]
+    return float((matches[positions[0]] - reference.mean()) / (reference.std() + 1e-12))
+
+
+def _high_pass(image):
+    return image - cv2.GaussianBlur(image, (0, 0), VISIBLE_HIGH_PASS_SIGMA)
+
+
+# Half height and width of the area where the template matches itself by more than 0.5
+def _main_lobe(template):
+    height, width = template.shape
+    padded = cv2.copyMakeBorder(template, height, height, width, width, cv2.BORDER_CONSTANT, value=0)
+    ys, xs = np.nonzero(cv2.matchTemplate(padded, template, cv2.TM_CCOEFF_NORMED) > 0.5)
+    return (ys.max() - ys.min()) // 2 + 1, (xs.max() - xs.min()) // 2 + 1
+
+
+'''
+Check one file. threshold is the score from which it is detected, None for VERIFY_THRESHOLD
+or VERIFY_VISIBLE_THRESHOLD. Returns a dict with the path, the score, whether it is detected
+and the number of keyframes, and for the invisible watermark the confidence; or the error
+when the file can't be checked.
+'''
+def verify_file(video_path, job_id=None, watermark_path=None, size=None, num_frames=VERIFY_SAMPLE_FRAMES,
+                threshold=None, placement=None):
+    result = {"path": video_path, "mode": "invisible" if job_id is not None else "visible"}
+    try:
+        frames = sample_keyframes(video_path, num_frames)
+        if job_id is not None:
+            score, result["bits_matched"] = detect_invisible(frames, job_id, size)
+            result["confidence"] = _confidence(score)
+        else:
+            score = detect_visible(frames, watermark_path, placement)
+    except Exception as e:
+        # a file that can't be checked must not stop the batch
+        return {**result, "error": f"{type(e).__name__}: {e}"}
+    if threshold is None:
+        threshold = VERIFY_THRESHOLD if job_id is not None else VERIFY_VISIBLE_THRESHOLD
+    return {**result, "score": round(score, 2), "detected": score >= threshold, "frames": len(frames)}
+
+
+def _verify_file(args):
+    video_path, kwargs = args
+    return verify_file(video_path, **kwargs)
+
+
+'''
+verify_file for many files, in workers processes (default all cores). Returns the results in
+the order of the files.
+'''
+def verify_files(video_paths, job_id=None, watermark_path=None, size=None, num_frames=VERIFY_SAMPLE_FRAMES,
+                 threshold=None, workers=None, placement=None):
+    if (job_id is None) == (watermark_path is None):
+        raise ValueError("give either a job id (invisible) or a watermark image (visible)")
+    kwargs = {"job_id": job_id, "watermark_path": watermark_path, "size": size, "num_frames": num_frames,
+              "threshold": threshold, "placement": placement}
+    args = [(video_path, kwargs) for video_path in video_paths]
+    workers = min(workers or os.cpu_count() or 1, len(args))
+    if workers <= 1:
+        return [_verify_file(arg) for arg in args]
+    with Pool(processes=workers) as pool:
+        return pool.map(_verify_file, args, chunksize=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check video files for the watermark")
+    parser.add_argument("files", nargs="+")
+    key = parser.add_mutually_exclusive_group(required=True)
+    key.add_argument("--job-id", help="job whose invisible watermark to look for")
+    key.add_argument("--watermark", help="image of the visible watermark")
+    parser.add_argument("--placement", type=json.loads, help="placement option of the job as json, for --watermark")
+    parser.add_argument("--size", help="WxH of the original video, for renditions of invisible jobs")
+    parser.add_argument("--frames", type=int, default=VERIFY_SAMPLE_FRAMES, help="keyframes decoded per file")
+    parser.add_argument("--workers", type=int, help="processes, default all cores")
+    parser.add_argument("--threshold", type=float, help="score from which a file is detected, default "
+                        f"{VERIFY_THRESHOLD} for --job-id and {VERIFY_VISIBLE_THRESHOLD} for --watermark")
+    parser.add_argument("--json", action="store_true", help="print the results as json lines")
+    args = parser.parse_args()
+
+    size = tuple(int(value) for value in args.size.lower().split("x")) if args.size else None
+    placement = parse_placement({"placement": args.placement}) if args.placement else None
+    results = verify_files(args.files, job_id=args.job_id, watermark_path=args.watermark, size=size,
+                           num_frames=args.frames, threshold=args.threshold, workers=args.workers, placement=placement)
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        elif "error" in result:
+            print(f"{result['path']}: error: {result['error']}")
+        else:
+            confidence = f", confidence {result['confidence']:.4f}" if "confidence" in result else ""
+            print(f"{result['path']}: {'DETECTED' if result['detected'] else 'not detected'}, "
+                  f"score {result['score']:.1f}{confidence}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import subprocess
+import imageio_ffmpeg as ffmpeg
+
+'''
+Probe a video once without decoding it. ffmpeg copies the video stream into the framecrc
+muxer, which writes one line per packet with its timestamps and flags. From that we know
+the exact number of frames and which frames are keyframes (CAP_PROP_FRAME_COUNT is only
+an estimate). imageio_ffmpeg does not ship ffprobe, so the ffmpeg binary is used for this.
+Returns a dict with:
+* frame_count
+* fps
+* time_base: [num, den]
+* width, height
+* codec
+* keyframes: sorted frame indices (display order) of all keyframes
+* keyframe_times: for every keyframe the time in seconds where ffmpeg -ss (before -i) lands on
+  it: halfway between its timestamp and that of the next frame, so rounding can't land on the
+  keyframe before. From the real timestamps, relative to the start of the file like -ss, so
+  also right for a variable frame rate or a video that does not start at 0.
+'''
+def probe_video(video_path):
+    command = [
+        ffmpeg.get_ffmpeg_exe(),
+        "-hide_banner",
+        "-loglevel", "error",
+        "-i", video_path,
+        "-map", "0:v:0",
+        "-c", "copy",
+        "-f", "framecrc",
+        "-"
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"probe_video failed for {video_path}: {result.stderr.strip()}")
+
+    time_base = None
+    width = height = None
+    codec = None
+    packets = []  # (pts, duration, is_keyframe)
+    for line in result.stdout.splitlines():
+        if line.startswith("#"):
+            if line.startswith("#tb 0:"):
+                num, den = line.split(":", 1)[1].strip().split("/")
+                time_base = [int(num), int(den)]
+            elif line.startswith("#dimensions 0:"):
+                width, height = (int(v) for v in line.split(":", 1)[1].strip().split("x"))
+            elif line.startswith("#codec_id 0:"):
+                codec = line.split(":", 1)[1].strip()
+            continue
+
+        fields = [f.strip() for f in line.split(",")]
+        if len(fields) < 6:
+            continue
+        flags = 1  # no F= field means the packet only has the keyframe flag
+        if len(fields) > 6 and fields[6].startswith("F="):
+            flags = int(fields[6][2:], 16)
+        # a packet without pts (NOPTS) is ordered by its dts, one without both is skipped
+        timestamp = _timestamp(fields[2])
+        if timestamp is None:
+            timestamp = _timestamp(fields[1])
+        if timestamp is None:
+            continue
+        packets.append((timestamp, int(fields[3]), bool(flags & 1)))
+
+    if not packets or time_base is None:
+        raise RuntimeError(f"probe_video: no video packets found in {video_path}")
+
+    # packets are in decode order, frame indices are in display order
+    packets.sort(key=lambda p: p[0])
+    keyframes = [i for i, p in enumerate(packets) if p[2]]
+
+    durations = sorted(p[1] for p in packets if p[1] > 0)
+    if durations:
+        frame_duration = durations[len(durations) // 2]
+    else:
+        frame_duration = (packets[-1][0] - packets[0][0]) / max(len(packets) - 1, 1)
+    fps = time_base[1] / (time_base[0] * frame_duration)
+
+    seconds = time_base[0] / time_base[1]
+    keyframe_times = [(packets[i][0] + (packets[i + 1][0] if i + 1 < len(packets) else packets[i][0] + frame_duration)) / 2 * seconds
+                      for i in keyframes]
+
+    return {
+        "frame_count": len(packets),
+        "fps": fps,
+        "time_base": time_base,
+        "width": width,
+        "height": height,
+        "codec": codec,
+        "keyframes": keyframes,
+        "keyframe_times": keyframe_times,
+    }
+
+
+# AV_NOPTS_VALUE, written as a number or as NOPTS depending on the version of ffmpeg
+NOPTS_VALUE = -2 ** 63
+
+
+def _timestamp(field):
+    try:
+        value = int(field)
+    except ValueError:
+        return None
+    return None if value == NOPTS_VALUE else value
+
+
+'''
+Plan the chunks of a video from its keyframe index. The chunks are planned in frames, and
+the ends are snapped to keyframes where there is one: a chunk ends at the first keyframe that
+is at least chunk_size frames after its start. When the keyframes are too far apart (more than
+2 * chunk_size) the chunk is cut at chunk_size frames anyway, so the next chunk does not start
+at a keyframe. Such chunks can't be stream-copied and are re-encoded by the split (see
+splitting.split_range), which makes every chunk decodable on its own either way.
+Returns a list of (chunk_id, start_frame, end_frame), end_frame exclusive.
+'''
+def plan_chunks(keyframes, frame_count, chunk_size):
+    keyframes = sorted(set(k for k in keyframes if 0 < k < frame_count))
+    chunks = []
+    start = 0
+    k = 0
+    while start < frame_count:
+        while k < len(keyframes) and keyframes[k] < start + chunk_size:
+            k += 1
+        if k < len(keyframes) and keyframes[k] <= start + 2 * chunk_size:
+            end = keyframes[k]
+        else:
+            end = min(start + chunk_size, frame_count)
+        chunks.append((len(chunks), start, end))
+        start = end
+    return chunks
+
+
+'''
+Divide the planned chunks into num_ranges contiguous ranges with about the same number of
+frames, so every range can be split by its own process.
+'''
+def plan_ranges(chunks, num_ranges):
+    if not chunks:
+        return []
+    num_ranges = max(1, min(num_ranges, len(chunks)))
+    total_frames = chunks[-1][2]
+    ranges = []
+    current = []
+    for chunk in chunks:
+        current.append(chunk)
+        # close the range once it reaches its share of the frames
+        if chunk[2] >= total_frames * (len(ranges) + 1) / num_ranges and len(ranges) < num_ranges - 1:
+            ranges.append(current)
+            current = []
+    if current:
+        ranges.append(current)
+    return ranges
+
@@ -5,11 +5,40 @@ import imageio_ffmpeg as ffmpeg
 import os
 import tempfile
 import math
+import bisect
+from fractions import Fraction
 from multiprocessing import Pool, cpu_count
 import logging
 import storage_functions
-
-def process_video_chunk(job_id, video_path, watermark_path, chunk_id, alpha=0.5):
+from job_options import overlaps_frame_ranges
+from video_probe import probe_video
+import frame_ring
+import metrics
+import invisible_watermark
+import placement as watermark_placement
+from job_options import parse_placement
+
+# libx264 settings of the x264 intermediate format, fast to encode and decode
+X264_INTERMEDIATE_PARAMS = ["-preset", "ultrafast", "-tune", "zerolatency", "-crf", "20"]
+# libx264 settings of the output when the concat has to re-encode the chunks
+DELIVERY_PARAMS = ["-preset", "veryfast", "-crf", "20", "-pix_fmt", "yuv420p"]
+
+'''
+Watermark one chunk. Every frame is decoded and blended once and then written to one encoder
+per rendition. Without renditions the chunk is only written in its original size.
+renditions is a list of dicts with name, height and bitrate (see job_options.parse_renditions).
+meta is the chunk info from the queue message (start_frame, fps, width, height, num_frames).
+When it is given the chunk is not probed and the frame buffers are allocated up front.
+blend_ranges is a list of (start_frame, end_frame) in frames of the whole video (see
+job_options.watermark_frame_ranges), only frames inside them get the watermark. This needs
+the start_frame from meta. None blends every frame.
+intermediate is the chunk format of the job (see job_options.parse_intermediate).
+placement is the prepared placement of the job (see placement.load_job_placement). Without it
+the watermark image at watermark_path is centered at half the frame width with opacity alpha.
+Returns a dict from rendition name (None for the original size) to the output file.
+'''
+def process_video_chunk(job_id, video_path, watermark_path, chunk_id, alpha=0.5, renditions=None, meta=None, blend_ranges=None,
+                        intermediate="mp4v", mode="visible", placement=None):
     video_capture = cv2.VideoCapture(video_path)
     if not video_capture.isOpened():
         print("Can't open input video.")
@@ -21,65 +50,183 @@ def process_video_chunk(job_id, video_path, watermark_path, chunk_id, alpha=0.5)
     #audio_path = f"audio_{chunk_id}"
     #extract_audio(video_path, audio_path)
 
-    total_frames = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    video_fps = video_capture.get(cv2.CAP_PROP_FPS)
-    frame_width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    watermark_image = cv2.imread(watermark_path, cv2.IMREAD_UNCHANGED)
-    if watermark_image is None:
-        print("Can't load watermark image.")
-        return None
-
-    watermark_scale_ratio = 0.5
-    watermark_width = int(frame_width * watermark_scale_ratio)
-    watermark_aspect_ratio = watermark_image.shape[0] / watermark_image.shape[1]
-    watermark_height = int(watermark_width * watermark_aspect_ratio)
-
-    resized_watermark = cv2.resize(watermark_image, (watermark_width, watermark_height))
-
-    if resized_watermark.shape[2] == 4:
-        watermark_alpha = resized_watermark[:, :, 3] / 255.0
-        watermark_rgb = resized_watermark[:, :, :3]
+    if meta is not None:
+        video_fps = meta["fps"]
+        frame_width = meta["width"]
+        frame_height = meta["height"]
+        num_frames = meta["num_frames"]
+        start_frame = meta["start_frame"]
     else:
-        watermark_alpha = np.ones((watermark_height, watermark_width))
-        watermark_rgb = resized_watermark
-
-    output_filename =  storage_functions._unique_filepath_tmp('mp4')
-    video_codec = cv2.VideoWriter_fourcc(*'mp4v')
-    video_writer = cv2.VideoWriter(output_filename, video_codec, video_fps, (frame_width, frame_height))
-
-    while True:
-        success, video_frame = video_capture.read()
-        if not success:
-            break
+        video_fps = video_capture.get(cv2.CAP_PROP_FPS)
+        frame_width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frame_height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        num_frames = None
+        start_frame = 0
+        blend_ranges = None  # the position of the chunk in the video is unknown
+
+    pattern = None
+    if mode == "invisible":
+        # the job id is embedded in the frames instead of the watermark image
+        placement = None
+        pattern = invisible_watermark.embedding_pattern(job_id, frame_height, frame_width)
+    elif placement is None:
+        watermark_image = cv2.imread(watermark_path, cv2.IMREAD_UNCHANGED)
+        if watermark_image is None:
+            print("Can't load watermark image.")
+            return None
+        placement = watermark_placement.prepare_placement(watermark_placement.compile_placement(
+            watermark_image, parse_placement({}), frame_width, frame_height, alpha))
+
+    # one writer per rendition: (output_path, fps, size, bitrate, intermediate)
+    outputs = {}
+    writer_specs = []
+    for rendition in renditions or [None]:
+        output_filename = storage_functions._unique_filepath_tmp('mp4')
+        if rendition is None:
+            name, size, bitrate = None, (frame_width, frame_height), None
+        else:
+            name, bitrate = rendition["name"], rendition["bitrate"]
+            size = rendition_size(frame_width, frame_height, rendition["height"])
+        outputs[name] = output_filename
+        writer_specs.append((output_filename, video_fps, size, bitrate, intermediate))
+
+    blend = (placement, blend_ranges, pattern)
+
+    # Large frames are decoded, blended and encoded by separate processes
+    blend_processes = frame_ring.blend_processes_for(frame_width, frame_height)
+    if blend_processes > 0:
+        video_capture.release()
+        frames_read = frame_ring.run_frame_ring(video_path, (frame_height, frame_width), start_frame, num_frames,
+                                                writer_specs, blend, blend_processes)
+    else:
+        writers = open_rendition_writers(writer_specs)
 
-        x_offset = (frame_width - watermark_width) // 2
-        y_offset = (frame_height - watermark_height) // 2
-        roi = video_frame[y_offset:y_offset+watermark_height, x_offset:x_offset+watermark_width]
+        # frames are decoded into the same buffer
+        video_frame = np.empty((frame_height, frame_width, 3), dtype=np.uint8)
+        frames_read = 0
+        while num_frames is None or frames_read < num_frames:
+            success, video_frame = video_capture.read(video_frame)
+            if not success:
+                break
+            blend_frame(video_frame, start_frame + frames_read, blend)
+            frames_read += 1
 
-        for channel in range(3):
-            roi[:, :, channel] = (
-                roi[:, :, channel] * (1 - watermark_alpha * alpha) +
-                watermark_rgb[:, :, channel] * (watermark_alpha * alpha)
-            )
+            write_renditions(writers, video_frame)
 
-        video_frame[y_offset:y_offset+watermark_height, x_offset:x_offset+watermark_width] = roi
-        video_writer.write(video_frame)
+        video_capture.release()
+        for size, scaled_frame, video_writer in writers:
+            video_writer.release()
 
-    video_capture.release()
-    video_writer.release()
 
+    metrics.inc("frames_total", frames_read, stage="watermark")
 
     # Combine audio and video again
     #combine_audio_video(output_filename, audio_path, output_filename)
 
-    print(f"Watermarked chunk saved to: {output_filename}")
-    return output_filename
+    print(f"Watermarked chunk saved to: {outputs}")
+    return outputs
 
 
-def concat_chunks(chunk_paths, output_path):
+'''
+Blend the watermark into the frame with the given global frame index, in place, if the index
+is inside the blend ranges. blend is (placement, blend_ranges, pattern), with the pattern of
+invisible_watermark instead of the placement for invisible jobs.
+'''
+def blend_frame(video_frame, frame_index, blend):
+    placement, blend_ranges, pattern = blend
+    if not overlaps_frame_ranges(blend_ranges, frame_index, frame_index + 1):
+        return
+    if pattern is not None:
+        invisible_watermark.embed_frame(video_frame, pattern)
+    else:
+        watermark_placement.blend_placement(video_frame, placement, frame_index)
+
+
+'''
+Size of a rendition with the given height, keeping the aspect ratio of the frame.
+Renditions are never upscaled and the width is rounded to an even number for the encoder.
+'''
+def rendition_size(frame_width, frame_height, height):
+    height = min(height, frame_height - frame_height % 2)
+    width = int(round(frame_width * height / frame_height / 2)) * 2
+    return (width, height)
+
+
+'''
+Open the writers of all renditions of a chunk from (output_path, fps, size, bitrate, intermediate)
+specs. Returns a list of (size, scaled frame buffer, writer).
+'''
+def open_rendition_writers(writer_specs):
+    writers = []
+    for output_path, fps, size, bitrate, intermediate in writer_specs:
+        scaled_frame = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        writers.append((size, scaled_frame, open_video_writer(output_path, fps, size, bitrate, intermediate)))
+    return writers
+
+
+'''
+Write a blended frame to every rendition. The blend is done once, the renditions are scaled
+from the blended frame.
+'''
+def write_renditions(writers, video_frame):
+    frame_height, frame_width = video_frame.shape[:2]
+    for size, scaled_frame, video_writer in writers:
+        if size == (frame_width, frame_height):
+            video_writer.write(video_frame)
+        else:
+            video_writer.write(cv2.resize(video_frame, size, dst=scaled_frame, interpolation=cv2.INTER_AREA))
+
+
+'''
+Writer for a chunk of a rendition. With a bitrate ffmpeg encodes the chunk with libx264 at
+that bitrate. Otherwise the chunk is written in the intermediate format of the job: libx264
+ultrafast for x264, the mp4v codec of OpenCV for mp4v and copy (the chunks of a copy job that
+have to be encoded are mp4v). Both writers have write(frame) and release().
+'''
+def open_video_writer(output_path, fps, size, bitrate=None, intermediate="mp4v"):
+    if bitrate is not None:
+        return FFmpegWriter(output_path, fps, size, bitrate=bitrate)
+    if intermediate == "x264":
+        return FFmpegWriter(output_path, fps, size, output_params=X264_INTERMEDIATE_PARAMS)
+    return cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+
+
+'''
+Write BGR frames to a video file through an ffmpeg process.
+'''
+class FFmpegWriter:
+    def __init__(self, output_path, fps, size, bitrate=None, codec="libx264", output_params=None):
+        self._frames = ffmpeg.write_frames(
+            output_path,
+            size,
+            fps=fps,
+            codec=codec,
+            bitrate=bitrate,
+            pix_fmt_in="bgr24",
+            macro_block_size=2,
+            ffmpeg_log_level="error",
+            output_params=output_params or ["-preset", "veryfast"],
+        )
+        self._frames.send(None)  # starts ffmpeg
+
+    def write(self, frame):
+        self._frames.send(frame.tobytes())
+
+    def release(self):
+        self._frames.close()
+
+
+'''
+Concatenate the chunks into the final video. The chunks are stream-copied, unless reencode is
+set: then the chunks can have different codecs (e.g. source GOPs and watermarked chunks) and
+are decoded and encoded with libx264 (see concat_chunks_reencode). fps is the frame rate of
+the video, the first chunk is probed for it when it is not given.
+'''
+def concat_chunks(chunk_paths, output_path, reencode=False, fps=None):
     ffmpeg_executable = ffmpeg.get_ffmpeg_exe()
+    if reencode:
+        concat_chunks_reencode(ffmpeg_executable, chunk_paths, output_path, fps)
+        return
 
     # Create file list
     concat_list_file = tempfile.NamedTemporaryFile(delete=False, suffix=".txt", mode="w")
@@ -101,6 +248,45 @@ def concat_chunks(chunk_paths, output_path):
     os.remove(concat_list_file.name)
 
 
+'''
+The concat demuxer can't decode chunks with different codecs, and a concat filter with one
+input per chunk opens every chunk at once. Instead one encoder reads raw frames from its
+stdin, and the chunks are decoded into it one after the other, each by its own ffmpeg, so
+only two processes and two files are open at any time. Every decoded frame is kept
+(-fps_mode passthrough), the encoder gives them the timestamps of fps.
+'''
+def concat_chunks_reencode(ffmpeg_executable, chunk_paths, output_path, fps=None):
+    meta = probe_video(chunk_paths[0])
+    # yuv420p needs an even size
+    width, height = meta["width"] // 2 * 2, meta["height"] // 2 * 2
+    rate = Fraction(fps or meta["fps"]).limit_denominator(1001)
+
+    encoder = subprocess.Popen([
+        ffmpeg_executable, "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "yuv420p", "-s", f"{width}x{height}", "-r", f"{rate.numerator}/{rate.denominator}",
+        "-i", "-",
+        "-c:v", "libx264", *DELIVERY_PARAMS,
+        "-y", output_path
+    ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for path in chunk_paths:
+            subprocess.run([
+                ffmpeg_executable, "-loglevel", "error",
+                "-i", path,
+                "-map", "0:v:0",
+                "-vf", f"scale={width}:{height}",
+                "-fps_mode", "passthrough",
+                "-f", "rawvideo", "-pix_fmt", "yuv420p", "-"
+            ], check=True, stdout=encoder.stdin, stderr=subprocess.DEVNULL)
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, "concat encoder")
+    finally:
+        if encoder.poll() is None:
+            encoder.kill()
+            encoder.wait()
+
+
 def split_and_process_video(video_path, watermark_path, chunk_size=100):
     video_capture = cv2.VideoCapture(video_path)
     total_frames = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -159,51 +345,81 @@ def extract_audio(video_input_path, audio_output_path):
 
     print("Audio extracted to:", audio_output_path)
 
+'''
+Decode the thumbnails of one contiguous range of keyframes, runs in a worker process of
+generate_chunked_thumbnail_parallel. args is (video_path, keyframes, frame_indices, seek_time,
+thumb_size) with keyframes all keyframes of the range in order, frame_indices the ones that are
+wanted and seek_time where a seek lands on the first keyframe (keyframe_times of
+video_probe.probe_video, from the real timestamps, so also right for a variable frame rate or a
+video that does not start at 0).
+One ffmpeg process demuxes the whole range and only decodes its keyframes (-skip_frame nokey),
+scaled to thumb_size (width, height), so no frame between the keyframes is ever decoded.
+Returns the thumbnails of frame_indices in order.
+'''
 def process_thumbnail_chunk(args):
-    video_path, frame_indices, thumb_height = args
-    thumbnails = []
+    video_path, keyframes, frame_indices, seek_time, thumb_size = args
+    wanted = set(frame_indices)
+    thumb_width, thumb_height = thumb_size
+    frame_bytes = thumb_width * thumb_height * 3
 
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    command = [
+        ffmpeg.get_ffmpeg_exe(),
+        "-loglevel", "error",
+        "-skip_frame", "nokey",
+        # lands on the first keyframe itself, an accurate seek would drop it
+        "-noaccurate_seek", "-ss", f"{seek_time:.6f}",
+        "-i", video_path,
+        "-map", "0:v:0",
+        "-frames:v", str(len(keyframes)),
+        "-vf", f"scale={thumb_width}:{thumb_height}",
+        "-fps_mode", "passthrough",
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "-"
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
 
-    for frame_index in frame_indices:
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        success, frame = cap.read()
-        if not success:
-            continue
-        h, w = frame.shape[:2]
-        new_w = int(thumb_height * w / h)
-        resized = cv2.resize(frame, (new_w, thumb_height))
-        thumbnails.append(resized)
+    thumbnails = []
+    try:
+        # the decoded frames are the keyframes of the range, in order
+        for frame_index in keyframes:
+            data = process.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            if frame_index in wanted:
+                thumbnails.append(np.frombuffer(data, dtype=np.uint8).reshape(thumb_height, thumb_width, 3))
+    finally:
+        process.stdout.close()
+        process.wait()
 
-    cap.release()
     return thumbnails
 
-def extract_first_frame_chunk(args):
-    video_path, start_frame, thumb_height = args
-    cap = cv2.VideoCapture(video_path)
-    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-    success, frame = cap.read()
-    cap.release()
-
-    if not success:
-        return None
-
-    h, w = frame.shape[:2]
-    new_w = int(thumb_height * w / h)
-    resized = cv2.resize(frame, (new_w, thumb_height))
-    return resized
 
+'''
+Thumbnail strip of a whole video with a tile about every chunk_size frames. The keyframe index
+is read once (video_probe.probe_video, no decoding) and every tile is the keyframe nearest to
+its position, tiles that land on the same keyframe are only used once. The tiles are divided
+into n_workers contiguous ranges and every worker decodes only the keyframes of its range.
+'''
 def generate_chunked_thumbnail_parallel(video_path, output_image_path, chunk_size=150, thumb_height=120, n_workers=4):
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.release()
+    meta = probe_video(video_path)
+    keyframes = meta["keyframes"]
+    thumb_size = (int(thumb_height * meta["width"] / meta["height"]), thumb_height)
 
-    start_frames = list(range(0, total_frames, chunk_size))
-    args = [(video_path, sf, thumb_height) for sf in start_frames]
+    selected = sorted({nearest_keyframe(keyframes, f) for f in range(0, meta["frame_count"], chunk_size)})
+    if not selected:
+        print("No thumbnails extracted.")
+        return
+    group_size = math.ceil(len(selected) / n_workers)
+    args = []
+    for i in range(0, len(selected), group_size):
+        group = selected[i:i + group_size]
+        first = bisect.bisect_left(keyframes, group[0])
+        last = bisect.bisect_right(keyframes, group[-1])
+        args.append((video_path, keyframes[first:last], group, meta["keyframe_times"][first], thumb_size))
 
-    with Pool(processes=n_workers) as pool:
-        thumbnails = pool.map(extract_first_frame_chunk, args)
+    with Pool(processes=min(n_workers, len(args))) as pool:
+        thumbnails = [thumb for result in pool.map(process_thumbnail_chunk, args) for thumb in result]
 
     thumbnails = [thumb for thumb in thumbnails if thumb is not None]
     if not thumbnails:
@@ -222,6 +438,15 @@ def generate_chunked_thumbnail_parallel(video_path, output_image_path, chunk_siz
     print("Thumbnail saved to:", output_image_path)
 
 
+'''
+The keyframe closest to frame_index, keyframes is sorted.
+'''
+def nearest_keyframe(keyframes, frame_index):
+    i = bisect.bisect_left(keyframes, frame_index)
+    candidates = keyframes[max(i - 1, 0):i + 1]
+    return min(candidates, key=lambda k: abs(k - frame_index))
+
+
 def extract_audio(video_path, audio_output_path):
     ffmpeg_executable = ffmpeg.get_ffmpeg_exe()
 
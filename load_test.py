@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+import imageio_ffmpeg as ffmpeg
+import api
+
+'''
+Load test of the whole pipeline: starts jobs at a given arrival rate against a Functions host,
+through the client functions of api.py, and reports
+* end-to-end latency percentiles per job (upload to downloaded output),
+* the latency of every stage (upload, split, watermark, thumbnails, concat, download),
+* throughput in chunks per second,
+* the backlog of the queues over time,
+* the error rate per stage.
+
+Local setup, see instruction.txt:
+    azurite --silent --location ./azurite
+    cd backend && func start     # with AZURE_STORAGE_BLOB_ENDPOINT=http://127.0.0.1:10000/devstoreaccount1
+    python load_test.py --jobs 20 --rate 0.5 --sizes 640x360:10 1280x720:20
+
+The test videos are generated with the ffmpeg test source, one per size, so the test needs no
+input files. The queue backlog is read directly from the storage of
+AZURE_STORAGE_CONNECTION_STRING (Azurite by default).
+'''
+
+DEFAULT_BASE_URL = os.environ.get("WATERMARK_API_URL", "http://localhost:7071/api/")
+# Queues of the pipeline, in the order of the stages
+QUEUES = ["splitqueue", "watermarkqueue", "thumbnailqueue", "watermarkdone", "thumbnaildone"]
+PERCENTILES = [50, 90, 95, 99]
+
+
+def generate_video(size, seconds, fps, output_path):
+    width, height = size
+    command = [ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+               "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={seconds}",
+               "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-y", output_path]
+    subprocess.run(command, check=True)
+
+
+def generate_watermark(output_path):
+    command = [ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+               "-f", "lavfi", "-i", "testsrc=size=320x120", "-frames:v", "1", "-y", output_path]
+    subprocess.run(command, check=True)
+
+
+def parse_size(text):
+    # WIDTHxHEIGHT:SECONDS
+    resolution, seconds = text.split(":")
+    width, height = resolution.lower().split("x")
+    return (int(width), int(height)), float(seconds)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+'''
+Samples the approximate number of messages of every queue every interval seconds.
+'''
+class BacklogSampler(threading.Thread):
+    def __init__(self, connection_string, interval):
+        super().__init__(daemon=True)
+        from azure.storage.queue import QueueClient
+        # a sample that fails is skipped, retrying would only delay the next one
+        self.clients = {name: QueueClient.from_connection_string(connection_string, name, retry_total=0, connection_timeout=2)
+                        for name in QUEUES}
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.start_time = time.monotonic()
+
+    def run(self):
+        while not self.stopped.is_set():
+            sample = {"t": time.monotonic() - self.start_time}
+            for name, client in self.clients.items():
+                try:
+                    sample[name] = client.get_queue_properties().approximate_message_count
+                except Exception:
+                    sample[name] = None  # the queue does not exist yet
+            self.samples.append(sample)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+'''
+Runs one job through the pipeline like a client does and records when every stage was seen
+done. Stages are observed by polling check_progress_func, so their times are accurate to the
+poll interval.
+'''
+def run_job(index, video_path, image_path, args):
+    result = {"index": index, "video": os.path.basename(video_path), "stages": {}, "error": None}
+    stage = "upload"
+    start = time.monotonic()
+    # the stages are in seconds since the start of the job
+    result["started_at"] = start
+
+    def mark(name):
+        result["stages"].setdefault(name, time.monotonic() - start)
+
+    try:
+        video_sas = api.get_upload_url()
+        image_sas = api.get_upload_url()
+        api.upload_file(video_sas, video_path)
+        api.upload_file(image_sas, image_path)
+        mark("upload")
+
+        stage = "start"
+        job_id = api.start_process_sync(video_sas, image_sas, args.options)
+        result["job_id"] = job_id
+        mark("start")
+
+        stage = "process"
+        deadline = time.monotonic() + args.timeout
+        while True:
+            progress = api.get_progress(job_id)
+            total = progress.get("total_chunks", 0)
+            result["total_chunks"] = total
+            if total > 0:
+                mark("split_started")
+            if progress.get("split_done"):
+                mark("split")
+            if total > 0 and progress.get("watermarked", 0) >= total:
+                mark("watermark")
+            if total > 0 and progress.get("thumbnailed", 0) >= total:
+                mark("thumbnail")
+            if progress.get("concat"):
+                mark("concat")
+            if progress.get("thumbnail_concat"):
+                mark("thumbnail_concat")
+            if progress["done"]:
+                mark("done")
+                break
+            if progress.get("failed"):
+                raise RuntimeError(f"job failed: {progress.get('error')}")
+            if time.monotonic() > deadline:
+                stage = "timeout"
+                raise TimeoutError(f"job not done after {args.timeout} seconds, progress {progress['progress_value']}%")
+            time.sleep(args.poll_interval)
+
+        stage = "download"
+        download_fd, download_path = tempfile.mkstemp(suffix=".mp4")
+        os.close(download_fd)
+        try:
+            api.download_file(api.get_download_link(job_id, "output_video"), download_path)
+            result["output_bytes"] = os.path.getsize(download_path)
+        finally:
+            os.remove(download_path)
+        mark("download")
+
+        if args.cleanup:
+            api.cleanup(job_id)
+    except Exception as e:
+        result["error"] = {"stage": stage, "message": str(e),
+                           "status": e.response.status_code if isinstance(e, requests.HTTPError) else None}
+    result["latency"] = time.monotonic() - start
+    return result
+
+
+def stage_durations(result):
+    stages = result["stages"]
+    durations = {}
+
+    def between(name, first, last):
+        if first in stages and last in stages:
+            durations[name] = stages[last] - stages[first]
+
+    durations["upload"] = stages.get("upload")
+    between("split", "start", "split")
+    between("watermark", "start", "watermark")
+    between("thumbnail", "start", "thumbnail")
+    between("concat", "watermark", "concat")
+    between("processing", "start", "done")
+    between("download", "done", "download")
+    return {name: value for name, value in durations.items() if value is not None}
+
+
+def print_report(results, samples, wall_seconds):
+    ok = [r for r in results if r["error"] is None]
+    failed = [r for r in results if r["error"] is not None]
+
+    print()
+    print(f"Jobs: {len(results)}, ok {len(ok)}, failed {len(failed)}, "
+          f"error rate {len(failed) / max(1, len(results)) * 100:.1f}%, wall time {wall_seconds:.1f}s")
+    errors = {}
+    for r in failed:
+        errors[r["error"]["stage"]] = errors.get(r["error"]["stage"], 0) + 1
+    for stage, count in sorted(errors.items()):
+        print(f"  errors in {stage}: {count}")
+    for r in failed[:5]:
+        print(f"  job {r['index']} ({r.get('job_id', '-')}): {r['error']['message']}")
+
+    print()
+    print(f"{'latency (s)':<16}" + "".join(f"{'p' + str(p):>9}" for p in PERCENTILES) + f"{'max':>9}{'n':>6}")
+    rows = [("end-to-end", [r["latency"] for r in ok])]
+    durations = [stage_durations(r) for r in ok]
+    for name in ["upload", "split", "watermark", "thumbnail", "concat", "processing", "download"]:
+        rows.append((name, [d[name] for d in durations if name in d]))
+    for name, values in rows:
+        if not values:
+            continue
+        print(f"{name:<16}" + "".join(f"{percentile(values, p):>9.2f}" for p in PERCENTILES)
+              + f"{max(values):>9.2f}{len(values):>6}")
+
+    # chunks per second over the time any job was being processed
+    chunks = sum(r.get("total_chunks", 0) for r in ok)
+    if ok:
+        busy = max(r["started_at"] + r["stages"]["done"] for r in ok) - min(r["started_at"] + r["stages"]["start"] for r in ok)
+        print()
+        print(f"Throughput: {chunks} chunks in {busy:.1f}s, {chunks / max(busy, 1e-9):.2f} chunks/s, "
+              f"{len(ok) / max(busy, 1e-9) * 60:.2f} jobs/min")
+
+    if any(sample[name] is not None for sample in samples for name in QUEUES):
+        print()
+        print("Queue backlog (approximate messages):")
+        print(f"{'t (s)':>8}" + "".join(f"{name:>16}" for name in QUEUES))
+        step = max(1, len(samples) // 20)
+        for sample in samples[::step]:
+            print(f"{sample['t']:>8.1f}" + "".join(f"{'-' if sample[name] is None else sample[name]:>16}" for name in QUEUES))
+        print(f"{'peak':>8}" + "".join(f"{max((s[name] or 0) for s in samples):>16}" for name in QUEUES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the watermark pipeline")
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL, help="url of the functions, ending in /api/")
+    parser.add_argument("--jobs", type=int, default=10, help="number of jobs to start")
+    parser.add_argument("--rate", type=float, default=0.5, help="mean arrival rate in jobs per second (Poisson)")
+    parser.add_argument("--concurrency", type=int, default=0, help="maximum jobs in flight, 0 is unlimited")
+    parser.add_argument("--sizes", nargs="+", default=["640x360:10"], metavar="WxH:SECONDS",
+                        help="test videos, the jobs use them in turn")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--options", type=json.loads, default={}, help="job options as json")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--sample-interval", type=float, default=2.0, help="seconds between queue backlog samples")
+    parser.add_argument("--no-backlog", dest="backlog", action="store_false", help="do not sample the queue backlog")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds a job may take")
+    parser.add_argument("--keep", dest="cleanup", action="store_false", help="do not clean up the jobs")
+    parser.add_argument("--seed", type=int, help="seed of the arrival times")
+    parser.add_argument("--output", help="write the results of every job and the backlog samples as json")
+    args = parser.parse_args()
+
+    api.set_base_url(args.base_url)
+    rng = random.Random(args.seed)
+
+    work_dir = tempfile.mkdtemp(prefix="loadtest-")
+    videos = []
+    for text in args.sizes:
+        size, seconds = parse_size(text)
+        path = os.path.join(work_dir, f"{size[0]}x{size[1]}_{seconds:g}s.mp4")
+        generate_video(size, seconds, args.fps, path)
+        videos.append(path)
+    image_path = os.path.join(work_dir, "watermark.jpg")
+    generate_watermark(image_path)
+
+    sampler = None
+    try:
+        if args.backlog:
+            sampler = BacklogSampler(os.environ.get("AZURE_STORAGE_CONNECTION_STRING", "UseDevelopmentStorage=true"),
+                                     args.sample_interval)
+            sampler.start()
+    except Exception as e:
+        print(f"Not sampling the queue backlog: {e}")
+        sampler = None
+
+    results = []
+    lock = threading.Lock()
+    slots = threading.Semaphore(args.concurrency) if args.concurrency > 0 else None
+
+    def worker(index, video_path):
+        try:
+            result = run_job(index, video_path, image_path, args)
+        finally:
+            if slots is not None:
+                slots.release()
+        with lock:
+            results.append(result)
+            status = "ok" if result["error"] is None else f"failed in {result['error']['stage']}"
+            print(f"job {index} {result['video']}: {status} after {result['latency']:.1f}s", file=sys.stderr)
+
+    start = time.monotonic()
+    threads = []
+    for index in range(args.jobs):
+        if index > 0 and args.rate > 0:
+            time.sleep(rng.expovariate(args.rate))
+        if slots is not None:
+            slots.acquire()
+        thread = threading.Thread(target=worker, args=(index, videos[index % len(videos)]), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.monotonic() - start
+
+    samples = []
+    if sampler is not None:
+        sampler.stop()
+        samples = sampler.samples
+    for result in results:
+        result["started_at"] -= start
+
+    results.sort(key=lambda r: r["index"])
+    print_report(results, samples, wall_seconds)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "wall_seconds": wall_seconds, "jobs": results, "backlog": samples}, f, indent=2)
+
+    for path in videos + [image_path]:
+        os.remove(path)
+    os.rmdir(work_dir)
+    sys.exit(1 if any(r["error"] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
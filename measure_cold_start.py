@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+'''
+Measure the cold start of the function app: every endpoint is invoked once in a fresh Python
+process, like the first request on a new instance, and the import time of function_app plus
+the first invocation is checked against the budget of the endpoint.
+The codec stack is imported lazily (see CODEC_MODULES in backend/function_app.py), so the
+lightweight endpoints must not load it; an endpoint that does fails the check as well.
+Usage:
+    python measure_cold_start.py [--runs 5] [--with-storage] [--importtime 20]
+        [--budget get-upload-url=0.8]
+--with-storage also measures the endpoints that read the job table, against the storage of
+AZURE_STORAGE_CONNECTION_STRING (Azurite by default), start Azurite first.
+--importtime prints the slowest modules of `import function_app`.
+aiohttp counts as heavy as well: only the async storage layer (backend/storage_async.py) uses
+it, but azure.storage.blob imports it whenever it is installed (about 150-200 ms), unless the
+SDK is imported through backend/sdk_imports.py.
+Exits with 1 when an endpoint is over its budget.
+'''
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+# Modules the lightweight endpoints must not import
+HEAVY_MODULES = ["numpy", "cv2", "imageio_ffmpeg", "multiprocessing", "watermarking", "splitting", "preview",
+                 "aiohttp"]
+
+# Seconds for importing function_app plus the first invocation, per endpoint
+COLD_START_BUDGETS = {
+    "get-upload-url": 1.0,
+    "get-download-url": 1.0,
+    "check_progress_func": 1.5,
+    "metrics_func": 1.5,
+}
+# Endpoints that need the job or metrics table
+STORAGE_ENDPOINTS = ["check_progress_func", "metrics_func"]
+# Query parameters of the request to every endpoint
+ENDPOINT_PARAMS = {
+    "get-upload-url": {},
+    "get-download-url": {"job_id": "cold-start", "type": "output_video"},
+    "check_progress_func": {"job_id": "cold-start"},
+    "metrics_func": {},
+}
+
+# The well known account of Azurite, so the SAS endpoints can sign without a real account
+AZURITE_ENV = {
+    "AZURE_STORAGE_CONNECTION_STRING": "UseDevelopmentStorage=true",
+    "AZURE_STORAGE_ACCOUNT": "devstoreaccount1",
+    "AZURE_STORAGE_KEY": "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==",
+}
+
+# Runs in the fresh process, prints the measurement as json on the last line
+CHILD = '''
+import sys, json, time
+start = time.perf_counter()
+import function_app
+imported = time.perf_counter()
+name, params = sys.argv[1], json.loads(sys.argv[2])
+before = set(sys.modules)
+if name == "preload_codecs":
+    function_app.preload_codecs()
+    status = 200
+else:
+    import azure.functions as func
+    handler = next(f for f in function_app.app.get_functions() if f.get_function_name() == name).get_user_function()
+    status = handler(req=func.HttpRequest("GET", "http://localhost/api/" + name, params=params, body=b"")).status_code
+done = time.perf_counter()
+heavy = [m for m in json.loads(sys.argv[3]) if m in sys.modules]
+print(json.dumps({"import": imported - start, "call": done - imported, "status": status, "heavy": heavy,
+                  "new_modules": len(set(sys.modules) - before)}))
+'''
+
+
+def run_child(name, params, importtime=False):
+    env = {**AZURITE_ENV, **os.environ}
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + \
+              ["-c", CHILD, name, json.dumps(params), json.dumps(HEAVY_MODULES)]
+    result = subprocess.run(command, cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{name}: {result.stderr.strip()}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+# (cumulative microseconds, module) of every import in the -X importtime output of a child
+def import_times(stderr):
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), module.strip()))
+    return modules
+
+
+def print_importtime(top):
+    _, stderr = run_child("preload_codecs", {}, importtime=True)
+    modules = import_times(stderr)
+    print("Slowest imports (cumulative, including preload_codecs):")
+    for cumulative, module in sorted(modules, reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start of the function app per endpoint")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per endpoint, the median is reported")
+    parser.add_argument("--with-storage", action="store_true", help="also measure the endpoints that need storage")
+    parser.add_argument("--importtime", type=int, metavar="N", help="print the N slowest imports")
+    parser.add_argument("--budget", action="append", default=[], metavar="ENDPOINT=SECONDS",
+                        help="override the budget of an endpoint")
+    args = parser.parse_args()
+
+    budgets = dict(COLD_START_BUDGETS)
+    for budget in args.budget:
+        name, seconds = budget.split("=")
+        budgets[name] = float(seconds)
+
+    if args.importtime:
+        print_importtime(args.importtime)
+
+    endpoints = [name for name in budgets if args.with_storage or name not in STORAGE_ENDPOINTS]
+    failed = False
+    print(f"{'endpoint':<22}{'import':>9}{'call':>9}{'total':>9}{'budget':>9}  result")
+    for name in endpoints + ["preload_codecs"]:
+        results = [run_child(name, ENDPOINT_PARAMS.get(name, {}))[0] for _ in range(args.runs)]
+        import_seconds = statistics.median(r["import"] for r in results)
+        call_seconds = statistics.median(r["call"] for r in results)
+        total = statistics.median(r["import"] + r["call"] for r in results)
+        heavy = sorted(set(m for r in results for m in r["heavy"]))
+
+        # preload_codecs is the cost the warmup trigger takes off the first chunk, it has no budget
+        budget = budgets.get(name)
+        if budget is None:
+            result = "codec stack"
+        elif heavy:
+            result = f"FAIL loads {', '.join(heavy)}"
+        elif total > budget:
+            result = "FAIL over budget"
+        else:
+            result = f"ok (status {results[0]['status']})"
+        failed = failed or result.startswith("FAIL")
+
+        budget_text = f"{budget:.2f}s" if budget is not None else "-"
+        print(f"{name:<22}{import_seconds:>8.3f}s{call_seconds:>8.3f}s{total:>8.3f}s{budget_text:>9}  {result}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
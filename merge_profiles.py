@@ -0,0 +1,100 @@
+import os
+import io
+import sys
+import json
+import pstats
+import argparse
+import tempfile
+from azure.storage.blob import ContainerClient
+
+'''
+Merge the profiles of one job from the 'profiles' container (see backend/profiling.py), per
+function, so the hot spots of all chunks can be compared at once: e.g. the blend loop against
+the storage I/O of process_chunk_func.
+Usage:
+    AZURE_STORAGE_CONNECTION_STRING=... python merge_profiles.py <job_id> [--function process_chunk_func]
+        [--sort cumulative] [--top 30] [--output-dir merged]
+Writes a merged <function>.pstats per function to output-dir when it is given, these can be
+opened with any pstats viewer (e.g. snakeviz).
+'''
+
+PROFILES_CONTAINER = "profiles"
+
+
+'''
+Download the profiles of a job, the .pstats files to tmp_dir.
+'''
+def download_profiles(job_id, tmp_dir, function=None):
+    container = ContainerClient.from_connection_string(os.environ["AZURE_STORAGE_CONNECTION_STRING"], PROFILES_CONTAINER)
+    prefix = f"{job_id}/" if function is None else f"{job_id}/{function}/"
+
+    # {function: {"stats": [paths], "memory": [summaries]}}
+    profiles = {}
+    for blob in container.list_blobs(name_starts_with=prefix):
+        function_name = blob.name.split("/")[1]
+        entry = profiles.setdefault(function_name, {"stats": [], "memory": []})
+        data = container.download_blob(blob.name).readall()
+        if blob.name.endswith(".pstats"):
+            path = os.path.join(tmp_dir, blob.name.replace("/", "_"))
+            with open(path, "wb") as f:
+                f.write(data)
+            entry["stats"].append(path)
+        elif blob.name.endswith(".mem.json"):
+            entry["memory"].append(json.loads(data))
+    return profiles
+
+
+def print_memory(summaries, top):
+    if not summaries:
+        return
+    peaks = [s["peak_bytes"] for s in summaries]
+    durations = [s["duration_seconds"] for s in summaries]
+    print(f"  invocations: {len(summaries)}, duration avg {sum(durations) / len(durations):.2f}s max {max(durations):.2f}s")
+    print(f"  peak memory avg {sum(peaks) / len(peaks) / 2**20:.1f} MiB max {max(peaks) / 2**20:.1f} MiB")
+
+    # the allocation sites that still held the most memory at the end of the invocations
+    sites = {}
+    for summary in summaries:
+        for allocation in summary["retained_allocations"]:
+            sites[allocation["site"]] = sites.get(allocation["site"], 0) + allocation["bytes"]
+    print("  retained allocation sites (summed over invocations):")
+    for site, size in sorted(sites.items(), key=lambda item: -item[1])[:top]:
+        print(f"    {size / 2**20:10.1f} MiB  {site}")
+
+
+def print_profiles(profiles, args):
+    for function_name, entry in sorted(profiles.items()):
+        print(f"=== {function_name}: {len(entry['stats'])} profiles ===")
+        print_memory(entry["memory"], args.top)
+        if not entry["stats"]:
+            continue
+
+        output = io.StringIO()
+        stats = pstats.Stats(*entry["stats"], stream=output)
+        stats.sort_stats(args.sort).print_stats(args.top)
+        print(output.getvalue())
+
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            stats.dump_stats(os.path.join(args.output_dir, f"{function_name}.pstats"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the profiles of a job per function")
+    parser.add_argument("job_id")
+    parser.add_argument("--function", help="only merge the profiles of this function")
+    parser.add_argument("--sort", default="cumulative", help="pstats sort key, e.g. cumulative or tottime")
+    parser.add_argument("--top", type=int, default=30, help="number of functions to print")
+    parser.add_argument("--output-dir", help="write the merged <function>.pstats here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="profiles-") as tmp_dir:
+        profiles = download_profiles(args.job_id, tmp_dir, args.function)
+        if not profiles:
+            print(f"No profiles found for job {args.job_id}")
+            sys.exit(1)
+        print_profiles(profiles, args)
+
+
+if __name__ == "__main__":
+    main()